@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+
+"""
+Benchmark for loading the activity list.
+
+Compares loading every activity as ORM objects, with their sports loaded
+eagerly, with the plain tuples of list_activities, on a temporary
+database of ACTIVITIES activities. Run with something like:
+
+    PYTHONPATH=src python bench/list-bench.py
+"""
+
+import os
+import time
+import tempfile
+
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import joinedload
+
+from granola.model import *
+
+ACTIVITIES = 10000
+REPEAT = 3
+
+
+def build_activities(session):
+    sport_ids = [SPORTS.get_id(session, name) for name in
+            (SPORTNAME_RUNNING, SPORTNAME_BIKING)]
+    activities = []
+    for number in range(ACTIVITIES):
+        start_time = datetime(1990, 1, 1) + timedelta(hours=number * 12)
+        activities.append({
+            'start_time': start_time,
+            'sport_id': sport_ids[number % 2],
+            'laps': [{
+                'start_time': start_time,
+                'duration': 1800.0 + number % 600,
+                'distance': 5000.0 + number % 1000,
+                'speed_max': 4.5,
+                'calories': 300,
+                'heart_rate_max': 170,
+                'heart_rate_avg': 150,
+                'tracks': [],
+            }],
+        })
+    bulk_insert_activities(session, activities)
+    session.commit()
+
+
+def load_objects(engine):
+    session = Session(bind=engine)
+    q = session.query(Activity).options(joinedload(Activity.sport))
+    for activity in q.order_by(Activity.start_time.desc()):
+        (activity.id, activity.start_time, activity.sport.name,
+            activity.distance, activity.duration, activity.heart_rate_avg)
+    session.close()
+
+
+def load_rows(engine):
+    session = Session(bind=engine)
+    for row in list_activities(session):
+        (row.id, row.start_time, row.sport_name, row.distance, row.duration,
+            row.heart_rate_avg)
+    session.close()
+
+
+def main():
+    (fd, db_file) = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    engine = connect_to_db("sqlite:///%s" % db_file)
+    try:
+        initialize_db(engine)
+        session = Session(bind=engine)
+        build_activities(session)
+        session.close()
+
+        print "Listing %d activities, best of %d:" % (ACTIVITIES, REPEAT)
+        for name, load in (("ORM objects", load_objects),
+                ("list_activities", load_rows)):
+            times = []
+            for i in range(REPEAT):
+                start = time.time()
+                load(engine)
+                times.append(time.time() - start)
+            print "   %-18s %8.1f ms" % (name, min(times) * 1000)
+    finally:
+        engine.dispose()
+        os.remove(db_file)
+
+if __name__ == "__main__":
+    main()
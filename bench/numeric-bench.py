@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+
+"""
+Benchmark for float versus Decimal numbers on the list, metrics and map
+paths.
+
+Times loading trackpoint columns through SQLAlchemy as Numeric (Decimal)
+and Float, and the per-row arithmetic of the activity list, metrics
+totals and map generation on Decimal and float values. Run with something
+like:
+
+    PYTHONPATH=src python bench/numeric-bench.py
+"""
+
+import time
+
+from decimal import Decimal
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, \
+        Numeric, Float, select
+
+from granola.util import calculate_speed, calculate_pace, format_time_str
+
+ACTIVITIES = 2000
+TRACKPOINTS = 50000
+REPEAT = 3
+
+
+def best_time(func, *args):
+    """ Return the best of REPEAT runs of func, in seconds. """
+    times = []
+    for i in range(REPEAT):
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def build_trackpoint_tables():
+    engine = create_engine("sqlite://")
+    engine.execute("CREATE TABLE trackpoint (id INTEGER PRIMARY KEY, "
+            "latitude REAL, longitude REAL, altitude REAL, distance REAL)")
+    engine.execute("INSERT INTO trackpoint VALUES (?, ?, ?, ?, ?)",
+            [(i, 45 + i / 1e6, -75 - i / 1e6, 100 + i % 50 / 10.0, i * 3.1)
+                for i in range(TRACKPOINTS)])
+    tables = {}
+    for name, type in (("Decimal", Numeric(12, 6)), ("float", Float)):
+        tables[name] = Table("trackpoint", MetaData(),
+                Column("id", Integer, primary_key=True),
+                Column("latitude", type), Column("longitude", type),
+                Column("altitude", type), Column("distance", type))
+    return engine, tables
+
+
+def load(engine, table):
+    engine.execute(select([table])).fetchall()
+
+
+def build_list(rows):
+    for distance, duration in rows:
+        ("%.2f" % (distance / 1000), format_time_str(duration),
+            "%.2f" % calculate_speed(None, distance, duration),
+            "%.2f" % (calculate_pace(None, distance, duration) / 60))
+
+
+def total_metrics(rows, zero):
+    total_distance = zero
+    total_duration = zero
+    for distance, duration in rows:
+        total_distance += distance
+        total_duration += duration
+    calculate_speed(None, total_distance, total_duration)
+    calculate_pace(None, total_distance, total_duration)
+
+
+def build_map(coords):
+    latitudes = [latitude for (latitude, longitude) in coords]
+    longitudes = [longitude for (latitude, longitude) in coords]
+    (min(latitudes), max(latitudes), min(longitudes), max(longitudes))
+    "".join(["new GLatLng(%s, %s)," % coord for coord in coords])
+
+
+def main():
+    (engine, tables) = build_trackpoint_tables()
+    float_rows = [(5000 + i * 1.25, 1800 + i * 0.5)
+            for i in range(ACTIVITIES)]
+    float_coords = [(45 + i / 1e6, -75 - i / 1e6)
+            for i in range(TRACKPOINTS)]
+    values = {
+        "float": (float_rows, float_coords, 0.0),
+        "Decimal": ([(Decimal(str(distance)), Decimal(str(duration)))
+                for (distance, duration) in float_rows],
+            [(Decimal(str(latitude)), Decimal(str(longitude)))
+                for (latitude, longitude) in float_coords],
+            Decimal("0")),
+    }
+
+    print "%d activities, %d trackpoints, best of %d:" % (ACTIVITIES,
+        TRACKPOINTS, REPEAT)
+    print "   %-16s %10s %10s" % ("", "Decimal", "float")
+    results = [
+        ("load trackpoints", [best_time(load, engine, tables[name])
+            for name in ("Decimal", "float")]),
+        ("activity list", [best_time(build_list, values[name][0])
+            for name in ("Decimal", "float")]),
+        ("metrics", [best_time(total_metrics, values[name][0],
+            values[name][2]) for name in ("Decimal", "float")]),
+        ("map", [best_time(build_map, values[name][1])
+            for name in ("Decimal", "float")]),
+    ]
+    for name, (decimal_time, float_time) in results:
+        print "   %-16s %9.3fs %9.3fs %6.1fx" % (name, decimal_time,
+            float_time, decimal_time / float_time)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+
+"""
+Benchmark for the SQLite storage profiles.
+
+Times an import workload, activities written in batched transactions as
+the importer does, and a list workload, building the activity list and
+metrics and loading tracks, against a new database for each profile in
+granola.model.STORAGE_PROFILES. Run with something like:
+
+    PYTHONPATH=src python bench/storage-bench.py [PROFILE ...]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from granola.model import *
+
+ACTIVITIES = 100
+LAPS = 3
+TRACKPOINTS = 300 # per lap
+BATCH_SIZE = 10 # activities per transaction
+LIST_REPEAT = 10
+LOADED_TRACKS = 5 # activities whose tracks the list workload loads
+
+
+def build_activity(number, sport_id):
+    start_time = datetime(2009, 1, 1) + timedelta(days=number)
+    laps = []
+    for lap in range(LAPS):
+        lap_start = start_time + timedelta(minutes=lap * 10)
+        laps.append({
+            'start_time': lap_start,
+            'duration': 600.0,
+            'distance': 1500.0,
+            'speed_max': 4.0,
+            'calories': 100,
+            'heart_rate_max': 170,
+            'heart_rate_avg': 150,
+            'tracks': [[{
+                'time': lap_start + timedelta(seconds=i),
+                'latitude': 45 + i / 10000.0,
+                'longitude': -75 + i / 10000.0,
+                'altitude': 100 + i % 10,
+                'distance': i * 3.0,
+                'heart_rate': 150 + i % 20,
+            } for i in range(TRACKPOINTS)]],
+        })
+    return {'start_time': start_time, 'sport_id': sport_id, 'laps': laps}
+
+
+def import_workload(engine):
+    session = Session(bind=engine)
+    sport_id = SPORTS.get_id(session, SPORTNAME_RUNNING)
+    for first in range(0, ACTIVITIES, BATCH_SIZE):
+        bulk_insert_activities(session, [build_activity(number, sport_id)
+            for number in range(first, first + BATCH_SIZE)])
+        session.commit()
+    session.close()
+
+
+def list_workload(engine):
+    for i in range(LIST_REPEAT):
+        session = Session(bind=engine)
+        running = SPORTS.get(session, SPORTNAME_RUNNING)
+        activities = session.query(Activity).filter(Activity.sport ==
+                running).order_by(Activity.start_time.desc()).all()
+        for activity in activities:
+            (activity.distance, activity.duration, activity.heart_rate_avg)
+        session.query(func.count(Activity.id), func.sum(Activity.distance),
+                func.sum(Activity.duration)).filter(Activity.sport ==
+                        running).one()
+        for activity in activities[:LOADED_TRACKS]:
+            for lap in activity.laps:
+                for track in lap.tracks:
+                    track.get_samples()
+        session.close()
+
+
+def run_profile(profile):
+    (fd, db_file) = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    set_storage_settings(get_storage_settings(profile))
+    engine = connect_to_db("sqlite:///%s" % db_file)
+    try:
+        initialize_db(engine)
+        timings = []
+        for workload in (import_workload, list_workload):
+            start = time.time()
+            workload(engine)
+            timings.append(time.time() - start)
+        return timings
+    finally:
+        engine.dispose()
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(db_file + suffix):
+                os.remove(db_file + suffix)
+
+
+def main():
+    profiles = sys.argv[1:] or sorted(STORAGE_PROFILES.keys())
+    print "%d activities of %d trackpoints, %d per transaction:" % (
+            ACTIVITIES, LAPS * TRACKPOINTS, BATCH_SIZE)
+    print "   %-12s %10s %10s" % ("profile", "import", "list")
+    for profile in profiles:
+        (import_time, list_time) = run_profile(profile)
+        print "   %-12s %9.2fs %9.2fs" % (profile, import_time, list_time)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+"""
+Micro-benchmark for trackpoint timestamp parsing.
+
+Compares granola.util.parse_timestamp against dateutil's generic parser
+on the formats found in TCX files. Run with something like:
+
+    PYTHONPATH=src python bench/timestamp-bench.py
+"""
+
+import timeit
+
+TIMESTAMPS = [
+    "2009-05-02T12:37:25Z",
+    "2009-05-02T12:37:25.123Z",
+    "2009-05-02T12:37:25-03:00",
+]
+NUMBER = 20000
+
+
+def main():
+    for timestamp in TIMESTAMPS:
+        print "%s:" % timestamp
+        for name, func in [("dateutil", "dateutil.parser.parse"),
+                ("parse_timestamp", "parse_timestamp")]:
+            timer = timeit.Timer("%s(%r)" % (func, timestamp),
+                    "import dateutil.parser; "
+                    "from granola.util import parse_timestamp")
+            best = min(timer.repeat(3, NUMBER))
+            print "   %-16s %8.2f usec per point" % (name,
+                best / NUMBER * 1000000)
+
+if __name__ == "__main__":
+    main()
@@ -142,7 +142,7 @@ setup(
 
     package_dir = {'granola': 'src/granola'},
     packages = ['granola'],
-    scripts = ['bin/granola'],
+    scripts = ['bin/granola', 'bin/granola-import'],
     include_package_data = True,
 
 # Commenting these out, doesn't seem to work out of the box, will stick to
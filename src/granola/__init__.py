@@ -28,7 +28,8 @@ import ConfigParser
 
 from granola.log import log
 from granola.const import DATA_DIR, SQLITE_DB
-from granola.model import initialize_db
+from granola.model import initialize_db, get_storage_settings, \
+        set_storage_settings, STORAGE_PRAGMAS, DEFAULT_STORAGE_PROFILE
 
 GRANOLARC = os.path.join(DATA_DIR, "granolarc")
 
@@ -63,6 +64,18 @@ def read_or_create_config():
     Read configuration from granolarc, or create it with default
     settings if necessary.
     """
+    config = read_config()
+    # Write the config back out now that we've added a default for anything
+    # that was missing:
+    write_config(config)
+    return config
+
+
+def read_config():
+    """
+    Read configuration from granolarc, if there is one, with defaults for
+    any missing settings. Nothing is written to disk.
+    """
     config = ConfigParser.ConfigParser()
     if os.path.exists(GRANOLARC):
         # Read in existing settings:
@@ -72,20 +85,51 @@ def read_or_create_config():
     default_import_settings = {
             'import_folder': os.path.join(os.path.expanduser("~/"),
                 "exports"),
+            # Number of processes used to parse files during import:
+            'workers': '1',
+            # Number of files imported per database transaction:
+            'batch_size': '50',
+            # Import new files as they appear in import_folder while running:
+            'watch': 'true',
+            # Store each track's trackpoints packed into one compressed row
+            # rather than a row each, smaller and faster to load:
+            'packed_tracks': 'false',
+    }
+    _add_default_settings(config, "import", default_import_settings)
+
+    default_storage_settings = {
+            # SQLite tuning, one of granola.model.STORAGE_PROFILES. Any of
+            # its settings (journal_mode, synchronous, cache_size,
+            # mmap_size, temp_store) can also be set here to override it:
+            'profile': DEFAULT_STORAGE_PROFILE,
     }
-    if not config.has_section("import"):
-        config.add_section("import")
-    for setting in default_import_settings.keys():
-        if not config.has_option("import", setting):
-            default_value = default_import_settings[setting]
+    _add_default_settings(config, "storage", default_storage_settings)
+    return config
+
+
+def _add_default_settings(config, section, defaults):
+    """ Add any of the given default settings missing from the section. """
+    if not config.has_section(section):
+        config.add_section(section)
+    for setting in defaults.keys():
+        if not config.has_option(section, setting):
+            default_value = defaults[setting]
             log.warn("Missing setting in granolarc, adding %s = %s" %
                     (setting, default_value))
-            config.set("import", setting, default_value)
+            config.set(section, setting, default_value)
 
-    # Write the config back out now that we've added a default for anything
-    # that was missing:
-    write_config(config)
-    return config
+
+def configure_storage(config):
+    """
+    Apply the storage profile from the [storage] section of the given
+    config, and any settings overriding it, to the database.
+    """
+    overrides = {}
+    for name in STORAGE_PRAGMAS:
+        if config.has_option("storage", name):
+            overrides[name] = config.get("storage", name)
+    set_storage_settings(get_storage_settings(
+        config.get("storage", "profile"), overrides))
 
 
 def write_config(config):
@@ -0,0 +1,220 @@
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+"""
+Decoder for Garmin's binary FIT format.
+
+Only what's needed to read activities: messages are returned as dicts of
+field number to raw value, scaling and units are left to the caller.
+
+Each definition message is compiled into a struct.Struct covering the
+whole data message, so decoding a data message (i.e. every trackpoint) is
+a single unpack_from call on the file's contents.
+
+See the FIT SDK: http://www.thisisant.com/
+"""
+
+import struct
+
+from datetime import datetime, timedelta
+
+from granola.util import UTC
+
+# Global message numbers:
+MESG_FILE_ID = 0
+MESG_SESSION = 18
+MESG_LAP = 19
+MESG_RECORD = 20
+
+# Field number of the timestamp, common to all messages:
+FIELD_TIMESTAMP = 253
+
+# FIT timestamps are seconds since this:
+FIT_EPOCH = datetime(1989, 12, 31, tzinfo=UTC)
+
+# Base type number to (struct format, invalid value):
+BASE_TYPES = {
+    0x00: ("B", 0xFF),                  # enum
+    0x01: ("b", 0x7F),                  # sint8
+    0x02: ("B", 0xFF),                  # uint8
+    0x83: ("h", 0x7FFF),                # sint16
+    0x84: ("H", 0xFFFF),                # uint16
+    0x85: ("i", 0x7FFFFFFF),            # sint32
+    0x86: ("I", 0xFFFFFFFF),            # uint32
+    0x88: ("f", None),                  # float32
+    0x89: ("d", None),                  # float64
+    0x0A: ("B", 0x00),                  # uint8z
+    0x8B: ("H", 0x0000),                # uint16z
+    0x8C: ("I", 0x00000000),            # uint32z
+    0x0D: ("B", 0xFF),                  # byte
+    0x8E: ("q", 0x7FFFFFFFFFFFFFFF),    # sint64
+    0x8F: ("Q", 0xFFFFFFFFFFFFFFFF),    # uint64
+    0x90: ("Q", 0x0000000000000000),    # uint64z
+}
+
+_FILE_HEADER = struct.Struct("<BBHI4s")
+_DEFINITION_HEADER = struct.Struct("<xBHB")
+
+
+def to_datetime(timestamp):
+    """ Return a timezone aware datetime for the given FIT timestamp. """
+    return FIT_EPOCH + timedelta(seconds=timestamp)
+
+
+class FitDefinition(object):
+    """
+    A message definition, how to decode the data messages of one local
+    message type.
+    """
+
+    def __init__(self, global_number, endian, fields, developer_size=0):
+        """
+        Fields is a list of (field number, size, base type) tuples, as they
+        appear in the definition message.
+        """
+        self.global_number = global_number
+        self.field_numbers = []
+        # Invalid value for each decoded field, None if there isn't one:
+        self.invalid = []
+
+        fmt = [endian]
+        for number, size, base_type in fields:
+            type_fmt, invalid = BASE_TYPES.get(base_type & 0x9F,
+                    ("B", None))
+            if struct.calcsize("<" + type_fmt) != size:
+                # Strings, arrays and anything else we don't understand
+                # come back as raw bytes:
+                type_fmt = "%ds" % size
+                invalid = None
+            fmt.append(type_fmt)
+            self.field_numbers.append(number)
+            self.invalid.append(invalid)
+        if developer_size:
+            fmt.append("%dx" % developer_size)
+
+        self.struct = struct.Struct("".join(fmt))
+        self.size = self.struct.size
+
+    def decode(self, data, offset):
+        """
+        Return a dict of field number to value for the data message at the
+        given offset. Fields holding their type's invalid value are left
+        out.
+        """
+        values = self.struct.unpack_from(data, offset)
+        fields = {}
+        for number, value, invalid in zip(self.field_numbers, values,
+                self.invalid):
+            if value != invalid:
+                fields[number] = value
+        return fields
+
+
+def read_messages(data, wanted=None):
+    """
+    Decode the given FIT file contents, yielding (global message number,
+    fields) for each data message. Fields is as for FitDefinition.decode.
+
+    If wanted is given only messages with those global numbers are decoded,
+    the rest are skipped over.
+    """
+    if len(data) < _FILE_HEADER.size:
+        raise Exception("Not a FIT file: too short.")
+    (header_size, protocol, profile, data_size,
+            signature) = _FILE_HEADER.unpack_from(data, 0)
+    if signature != ".FIT":
+        raise Exception("Not a FIT file: bad signature.")
+
+    offset = header_size
+    end = header_size + data_size
+    if len(data) < end:
+        raise Exception("Truncated FIT file: expected %d bytes, got %d." %
+                (end, len(data)))
+
+    definitions = {}
+    last_timestamp = 0
+    while offset < end:
+        header = ord(data[offset])
+        offset += 1
+
+        timestamp = None
+        if header & 0x80:
+            # Compressed timestamp header, a 5 bit offset from the last
+            # timestamp seen:
+            local_type = (header >> 5) & 0x03
+            time_offset = header & 0x1F
+            timestamp = (last_timestamp & ~0x1F) + time_offset
+            if time_offset < last_timestamp & 0x1F:
+                timestamp += 0x20
+            last_timestamp = timestamp
+        elif header & 0x40:
+            offset = _read_definition(data, offset, header, definitions)
+            continue
+        else:
+            local_type = header & 0x0F
+
+        definition = definitions.get(local_type)
+        if definition is None:
+            raise Exception("FIT data message for undefined local type %d "
+                    "at offset %d." % (local_type, offset - 1))
+
+        if wanted is None or definition.global_number in wanted or \
+                FIELD_TIMESTAMP in definition.field_numbers:
+            fields = definition.decode(data, offset)
+            if FIELD_TIMESTAMP in fields:
+                last_timestamp = fields[FIELD_TIMESTAMP]
+            elif timestamp is not None:
+                fields[FIELD_TIMESTAMP] = timestamp
+            if wanted is None or definition.global_number in wanted:
+                yield definition.global_number, fields
+        offset += definition.size
+
+
+def _read_definition(data, offset, header, definitions):
+    """
+    Read the definition message at the given offset, storing it in the
+    definitions dict under its local type. Returns the offset after it.
+    """
+    architecture, global_number, field_count = \
+            _DEFINITION_HEADER.unpack_from(data, offset)
+    endian = "<"
+    if architecture == 1:
+        endian = ">"
+        global_number = struct.unpack(">H", struct.pack("<H",
+            global_number))[0]
+    offset += _DEFINITION_HEADER.size
+
+    fields = []
+    for i in range(field_count):
+        fields.append(struct.unpack_from("BBB", data, offset))
+        offset += 3
+
+    developer_size = 0
+    if header & 0x20:
+        # Developer fields, we don't decode these but need to skip them:
+        developer_count = ord(data[offset])
+        offset += 1
+        for i in range(developer_count):
+            developer_size += ord(data[offset + 1])
+            offset += 3
+
+    definitions[header & 0x0F] = FitDefinition(global_number, endian, fields,
+            developer_size)
+    return offset
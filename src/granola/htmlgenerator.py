@@ -22,7 +22,6 @@
 
 import math
 
-from decimal import Decimal
 from granola.log import log
 
 HTML_HEADER = """
@@ -71,11 +70,11 @@ def distance_between_coords(lat1, lon1, lat2, lon2):
     Based on http://snipplr.com/view/2531/, sorry for the terrible variable
     names.
     """
-    pi180 = Decimal(str(math.pi / 180))
-    temp_lat1 = lat1
-    temp_lon1 = lon1
-    temp_lat2 = lat2
-    temp_lon2 = lon1
+    pi180 = math.pi / 180
+    temp_lat1 = float(lat1)
+    temp_lon1 = float(lon1)
+    temp_lat2 = float(lat2)
+    temp_lon2 = float(lon1)
 
     temp_lat1 *= pi180
     temp_lon1 *= pi180
@@ -138,21 +137,14 @@ class HtmlGenerator(object):
                 self.activity.sport.name)
         f = open(filepath, "w")
 
-        if len(self.activity.laps) == 0:
-            f.write("<html><body>No trackpoints</body></html>")
-            f.close()
-            return filepath
-        elif len(self.activity.laps[0].tracks) == 0:
-            f.write("<html><body>No trackpoints</body></html>")
-            f.close()
-            return filepath
-        elif len(self.activity.laps[0].tracks[0].trackpoints) == 0:
+        coords = self._get_coords(self.activity)
+        if len(coords) == 0:
             f.write("<html><body>No trackpoints</body></html>")
             f.close()
             return filepath
 
         (maxLat, maxLon, minLat, minLon, centerLat, centerLon) = \
-                self._calculate_center_coords(self.activity)
+                self._calculate_center_coords(self.activity, coords)
         span_km = distance_between_coords(maxLat, maxLon, minLat, minLon)
         log.debug("Distance between coordinates: %s" % span_km)
         zoom_level = get_zoom_level(span_km)
@@ -160,21 +152,10 @@ class HtmlGenerator(object):
 
         title = "Granola Activity Map: %s (%s)" % (self.activity.start_time,
                 self.activity.sport.name)
-        center_coords = self.activity.laps[0].tracks[0].trackpoints[0]
 
         f.write(HTML_HEADER % (title, centerLat, centerLon, zoom_level))
 
-        # TODO: iterating trackpoints a second time but probably faster
-        # than doing the string concatenation we'd have to do otherwise.
-        for lap in self.activity.laps:
-            for track in lap.tracks:
-                for trackpoint in track.trackpoints:
-                    if trackpoint.latitude is None:
-                        # TODO: Empty data in a trackpoint indicates a pause, 
-                        # could display this easily.
-                        continue
-                    f.write("new GLatLng(%s, %s)," % (trackpoint.latitude, 
-                        trackpoint.longitude))
+        f.write("".join(["new GLatLng(%s, %s)," % coord for coord in coords]))
         f.write("""                        ], "#0000ff", 3);""")
         #f.write("""map.addOverlay(new GMarker(new GLatLng(%s, %s)));""" %
         #        (maxLat, maxLon))
@@ -185,29 +166,41 @@ class HtmlGenerator(object):
         f.close()
         return filepath
 
-    def _calculate_center_coords(self, activity):
-        """ Calculate the latitude and longitude to center on. """
-
-        maxLat = None
-        minLat = None
-        maxLon = None
-        minLon = None
-        for lap in self.activity.laps:
+    def _get_coords(self, activity):
+        """
+        Return a list of (latitude, longitude) for every sample in the
+        activity that has a position, in order. Samples are read once
+        whether the tracks are stored packed or as trackpoints.
+        """
+        coords = []
+        for lap in activity.laps:
             for track in lap.tracks:
-                for trackpoint in track.trackpoints:
-                    if trackpoint.latitude is None:
+                for sample in track.get_samples():
+                    if sample.latitude is None:
+                        # TODO: Empty data in a trackpoint indicates a pause,
+                        # could display this easily.
                         continue
-                    if maxLat is None:
-                        # Assume all must be None:
-                        maxLat = trackpoint.latitude
-                        minLat = trackpoint.latitude
-                        maxLon = trackpoint.longitude
-                        minLon = trackpoint.longitude
-                    else:
-                        maxLat = max(maxLat, trackpoint.latitude)
-                        minLat = min(minLat, trackpoint.latitude)
-                        maxLon = max(maxLon, trackpoint.longitude)
-                        minLon = min(minLon, trackpoint.longitude)
+                    coords.append((sample.latitude, sample.longitude))
+        return coords
+
+    def _calculate_center_coords(self, activity, coords):
+        """
+        Calculate the latitude and longitude to center on. Uses the
+        activity's stored bounding box, only falling back to the given
+        coords if it doesn't have one.
+        """
+        if activity.min_latitude is not None:
+            maxLat = activity.max_latitude
+            minLat = activity.min_latitude
+            maxLon = activity.max_longitude
+            minLon = activity.min_longitude
+        else:
+            latitudes = [latitude for (latitude, longitude) in coords]
+            longitudes = [longitude for (latitude, longitude) in coords]
+            maxLat = max(latitudes)
+            minLat = min(latitudes)
+            maxLon = max(longitudes)
+            minLon = min(longitudes)
 
         centerLat = minLat + (maxLat - minLat) / 2
         centerLon = minLon + (maxLon - minLon) / 2
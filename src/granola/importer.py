@@ -19,172 +19,1033 @@
 #   02110-1301  USA
 
 import os
-import dateutil.parser
-from xml.etree.ElementTree import ElementTree
+import time
+import resource
+import collections
+import threading
+import multiprocessing
+
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 
 from granola.model import *
 from granola.log import log
+from granola.util import parse_timestamp, calculate_distance, total_seconds
+from granola.fit import read_messages, to_datetime, MESG_SESSION, \
+        MESG_LAP, MESG_RECORD, FIELD_TIMESTAMP
+from granola.sources import is_archive, uncompressed_name, list_sources, \
+        open_source, source_stat, hash_source
 
 # Assume "running" below this threshold as walking:
 WALK_RUN_THRESHOLD = 6000.0 / 3600.0
 
 
 def debug_activity(activity):
-    """ Log debug info on this activity. """
-    log.debug("Activity: %s" % activity.start_time)
+    """ Log debug info on this activity dict. """
+    log.debug("Activity: %s" % activity['start_time'])
     i = 1
-    for lap in activity.laps:
+    for lap in activity['laps']:
         log.debug("   Lap %s:" % i)
-        log.debug("      Start Time: %s" % lap.start_time)
-        log.debug("      Duration: %s seconds" % lap.duration)
-        log.debug("      Distance: %s meters" % lap.distance)
-        log.debug("      Max speed: %s meters/second" % lap.speed_max)
-        log.debug("      Calories: %s" % lap.calories)
-        log.debug("      Max heart rate: %s bpm" % lap.heart_rate_max)
-        log.debug("      Avg heart rate: %s bpm" % lap.heart_rate_avg)
+        log.debug("      Start Time: %s" % lap['start_time'])
+        log.debug("      Duration: %s seconds" % lap['duration'])
+        log.debug("      Distance: %s meters" % lap['distance'])
+        log.debug("      Max speed: %s meters/second" % lap['speed_max'])
+        log.debug("      Calories: %s" % lap['calories'])
+        log.debug("      Max heart rate: %s bpm" % lap['heart_rate_max'])
+        log.debug("      Avg heart rate: %s bpm" % lap['heart_rate_avg'])
         i += 1
 
 
-class Importer(object):
-    """ Parent Importer class. """
+# Stages of an import we keep timings for, in order:
+#   scan - walking the import folder and checking the manifest
+#   parse - parsing files (in total across all workers)
+#   timestamps - portion of parse spent parsing timestamps
+#   build - preparing parsed data for the database
+#   insert - executing the inserts
+#   commit - committing transactions
+IMPORT_STAGES = ["scan", "parse", "timestamps", "build", "insert", "commit"]
 
-    def scan_dir(self, directory):
-        """ Scan a directory for new data files to import. """
-        pass
+# Files this size or larger are streamed rather than parsed whole, see
+# Importer.import_files:
+STREAM_SIZE = 16 * 1024 * 1024
+
+# Longest a batch of files is left uncommitted during an import, in seconds.
+# Well under the database busy timeout, so the UI can still write while a
+# long import is running:
+BATCH_SECONDS = 1.0
+
+# Files in flight per worker when parsing in parallel, see
+# Importer._parse_files:
+PARSE_WINDOW = 2
+
+# The importer used by each worker process, see _init_worker:
+_worker_importer = None
+
+
+def _init_worker(importer):
+    """
+    Hand the importer to a newly started worker process. Done once per
+    worker rather than per file, the importer carries the set of known
+    activities which can be large.
+    """
+    global _worker_importer
+    _worker_importer = importer
+
+
+def _parse_file(filename):
+    """
+    Parse a single file in a worker process.
+
+    Module level so multiprocessing can pickle it, returns the filename along
+    with the plain activity data (or error) so results can be matched up by
+    the writer.
+    """
+    return _worker_importer._try_parse_file(filename)
+
+
+def activity_fingerprint(start_time):
+    """
+    Return a key identifying an activity no matter which file it came from.
 
-    def import_file(self, filename):
+    Start times are unique per activity in the database, which stores them
+    as naive wall clock times, so that's what we compare.
+    """
+    return start_time.replace(tzinfo=None)
+
+
+class ImportManifest(object):
+    """
+    In-memory copy of the import bookkeeping, loaded with a couple of
+    queries at the start of a scan so checking each file doesn't cost a
+    query of its own.
+
+    Paths are source names, see granola.sources, so each member of an
+    archive is tracked separately. Stats are (size, mtime) tuples as
+    returned by source_stat.
+    """
+
+    def __init__(self, session):
+        # Full path to (size, mtime) for every source we've examined:
+        self.files = {}
+        # Paths of sources that failed to import, tried again every scan as
+        # the cause (i.e. a missing sport) may have been fixed since:
+        self.failed = set()
+        q = session.query(ImportedFile.path, ImportedFile.size,
+                ImportedFile.mtime, ImportedFile.status)
+        for path, size, mtime, status in q:
+            self.files[path] = (size, mtime)
+            if status == IMPORT_STATUS_FAILED:
+                self.failed.add(path)
+
+        # Base filenames recorded by older versions, before the manifest.
+        # Only consulted for paths the manifest doesn't know about:
+        self.identifiers = set([identifier for (identifier, ) in
+            session.query(Import.identifier)])
+
+        # Content hash to path for every file examined, so copies of a file
+        # under another name are caught before they're parsed:
+        self.hashes = {}
+        q = session.query(ImportedFile.content_hash, ImportedFile.path)
+        q = q.filter(ImportedFile.status != IMPORT_STATUS_FAILED)
+        q = q.filter(ImportedFile.content_hash != None)
+        for content_hash, path in q:
+            self.hashes[content_hash] = path
+
+        # Fingerprints of every activity already stored:
+        self.activities = set([activity_fingerprint(start_time) for
+            (start_time, ) in session.query(Activity.start_time)])
+
+        # Activities stored by imports that were interrupted, these count
+        # as stored even if they've since been deleted, so resuming doesn't
+        # bring them back:
+        self.activities.update([activity_fingerprint(start_time) for
+            (start_time, ) in session.query(ImportCheckpoint.start_time)])
+
+        # (content hash, stat) of files found by _check_file but not yet
+        # stored:
+        self.pending = {}
+
+    def is_unchanged(self, path, stat):
         """
-        Import the data in the given file.
+        Return True if the file at the given path has been examined before
+        and has the same size and modification time as it did then. Files
+        that failed to import never count as unchanged.
         """
-        pass
+        return path not in self.failed and self.files.get(path) == tuple(stat)
 
+    def is_imported(self, path):
+        """
+        Return True if an older version imported a file with this name,
+        before the manifest existed. Paths in the manifest are judged by
+        their stat and hash alone, plenty of exports share a name.
+        """
+        return path not in self.files and \
+                os.path.basename(path) in self.identifiers
 
-class GarminTcxImporter(Importer):
+    def record(self, session, path, stat, content_hash, status):
+        """
+        Store the given file's details in the manifest, replacing anything
+        we had for that path.
+        """
+        size, mtime = stat
+        values = {
+            'size': size,
+            'mtime': mtime,
+            'content_hash': content_hash,
+            'status': status,
+        }
+        table = ImportedFile.__table__
+        updated = 0
+        if path in self.files:
+            updated = session.execute(table.update().where(
+                table.c.path == path), values).rowcount
+        # The row may be gone even if we have the path, i.e. rolled back
+        # along with a file that failed to import:
+        if not updated:
+            session.execute(table.insert(), dict(values, path=path))
+        self.files[path] = (size, mtime)
+        if status == IMPORT_STATUS_FAILED:
+            self.failed.add(path)
+            # Don't let a broken file mask a good copy of itself:
+            if self.hashes.get(content_hash) == path:
+                del self.hashes[content_hash]
+        else:
+            self.failed.discard(path)
+            if content_hash is not None:
+                self.hashes.setdefault(content_hash, path)
+
+
+class ImportReport(object):
     """
-    Importer for Garmin TCX XML Documents.
+    Summary of what an import did, returned from scan_dir.
 
-    See: http://developer.garmin.com/schemas/tcx/v2/
+    Also carries timings and throughput for the import so regressions can
+    be spotted, see summary().
     """
-    # TODO: There must be a way to get this off the ElementTree object:
-    xmlns = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
 
-    def scan_dir(self, directory):
-        """ Scan a directory for new data files to import. """
+    def __init__(self):
+        # Files parsed and stored:
+        self.imported = []
+        # Files skipped because they were unchanged or imported before:
+        self.skipped = []
+        # Files skipped because they're a copy of another file:
+        self.duplicates = []
+        # (filename, error message) for files that could not be imported:
+        self.failures = []
+
+        # Dict for each file parsed, with filename, bytes, trackpoints and
+        # the seconds spent on it in each stage:
+        self.files = []
+        # Total seconds spent in each stage:
+        self.stages = dict.fromkeys(IMPORT_STAGES, 0.0)
+        # Wall clock seconds for the whole import:
+        self.elapsed = 0.0
+        # Peak resident memory of this process or any worker, in kilobytes:
+        self.peak_memory = 0
+
+    def add_file(self, timings):
+        """ Record the per file timings dict for a parsed file. """
+        self.files.append(timings)
+        for stage in IMPORT_STAGES:
+            self.stages[stage] += timings.get(stage, 0.0)
+
+    def finish(self, elapsed):
+        """ Note the total time taken and current peak memory use. """
+        self.elapsed = elapsed
+        self.peak_memory = max(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    def summary(self):
+        """ Return a dict summarizing the import, suitable for comparing. """
+        trackpoints = sum([f['trackpoints'] for f in self.files])
+        total_bytes = sum([f['bytes'] for f in self.files])
+        trackpoints_per_second = 0.0
+        bytes_per_second = 0.0
+        if self.elapsed > 0:
+            trackpoints_per_second = trackpoints / self.elapsed
+            bytes_per_second = total_bytes / self.elapsed
+        return {
+            'imported': len(self.imported),
+            'skipped': len(self.skipped),
+            'duplicates': len(self.duplicates),
+            'failed': len(self.failures),
+            'elapsed': self.elapsed,
+            'stages': self.stages.copy(),
+            'trackpoints': trackpoints,
+            'bytes': total_bytes,
+            'trackpoints_per_second': trackpoints_per_second,
+            'bytes_per_second': bytes_per_second,
+            'peak_memory_kb': self.peak_memory,
+        }
+
+    def log(self):
+        """ Log a summary of the import. """
+        log.info("Import finished: %s imported, %s skipped, "
+                "%s duplicates, %s failed." % (len(self.imported),
+                    len(self.skipped), len(self.duplicates),
+                    len(self.failures)))
+        for filename, error in self.failures:
+            log.error("   Failed to import %s: %s" % (filename, error))
+
+        summary = self.summary()
+        log.info("   %.3f seconds, %d trackpoints/second, %d KB/second, "
+                "peak memory %d KB" % (summary['elapsed'],
+                    summary['trackpoints_per_second'],
+                    summary['bytes_per_second'] / 1024,
+                    summary['peak_memory_kb']))
+        log.info("   " + ", ".join(["%s %.3fs" % (stage, self.stages[stage])
+            for stage in IMPORT_STAGES]))
+        for timings in self.files:
+            log.debug("   %s: %d bytes, %d trackpoints, %s" % (
+                timings['filename'], timings['bytes'],
+                timings['trackpoints'],
+                ", ".join(["%s %.3fs" % (stage, timings[stage]) for stage in
+                    IMPORT_STAGES if stage in timings])))
+
+
+class Importer(object):
+    """
+    Parent Importer class.
+
+    Subclasses implement parse_file, returning a list of plain activity
+    dicts (picklable, so parsing can happen in worker processes), the file
+    extension they handle and optionally sniff, to recognise their files by
+    content. Files may also be gzip or bzip2 compressed, or members of a zip
+    archive, see granola.sources. Storing the results in the database is
+    common to all importers and always happens in the calling process.
+
+    Activity dicts carry start_time, sport (a sport name) and laps. Lap
+    dicts carry the Lap column values plus tracks, a list of lists of
+    trackpoint dicts keyed by TrackPoint column names.
+    """
+    extension = None
+
+    def __init__(self, workers=1, batch_size=50, stream_size=STREAM_SIZE,
+            dry_run=False, packed=False, batch_seconds=BATCH_SECONDS):
+        # Number of processes to parse files with, 1 parses serially in
+        # this process.
+        self.workers = workers
+
+        # Number of files to import per transaction during a scan:
+        self.batch_size = batch_size
+
+        # Commit a batch early once it's been open this many seconds, the
+        # database is locked for other writers until then:
+        self.batch_seconds = batch_seconds
+
+        # Files of at least this many bytes on disk are streamed, see
+        # import_files:
+        self.stream_size = stream_size
+
+        # Go through the whole import but roll it back at the end rather
+        # than committing anything:
+        self.dry_run = dry_run
+
+        # Store each track's trackpoints packed into a single compressed
+        # row, see granola.packing:
+        self.packed = packed
+
+        # Fingerprints of activities already stored, parsers may skip
+        # these rather than building data that will be thrown away.
+        self.known_activities = set()
+
+        # Seconds spent parsing timestamps in the current file:
+        self.timestamp_time = 0.0
+
+        # Held while importing, see import_files:
+        self._lock = threading.Lock()
+
+    def scan_dir(self, directory, progress=None):
+        """
+        Scan a directory for new data files to import. See import_files.
+        """
+        return self.import_files(self.find_files(directory), progress)
+
+    def find_files(self, directory):
+        """
+        Return the files under the given directory we may be able to import,
+        in a predictable order.
+        """
         if not os.path.exists(directory):
             raise Exception("No such directory: %s" % directory)
         log.debug("Scanning %s for new data." % directory)
 
+        filenames = []
+        for root, dirs, files in os.walk(directory):
+            # Walk in a predictable order so parallel and serial imports
+            # store activities identically:
+            dirs.sort()
+            for file in sorted(files):
+                if self.accepts(file):
+                    filenames.append(os.path.join(root, file))
+        return filenames
+
+    def import_files(self, filenames, progress=None):
+        """
+        Import any of the given files that are new or changed. Archives
+        are opened and each member we handle is imported as a file of its
+        own.
+
+        Files are committed in batches of batch_size, or whatever has been
+        stored after batch_seconds, each within its own savepoint so a file
+        that fails to import is rolled back and reported without losing the
+        rest of the batch. Returns an ImportReport.
+
+        Files of stream_size bytes or more, i.e. history exports with
+        thousands of activities, are instead parsed and stored one activity
+        at a time, each committed along with a checkpoint. If the import is
+        interrupted the next one resumes after the last activity stored.
+
+        If given, progress is called as progress(done, total, activity_ids)
+        once the new files are known and after each batch or streamed
+        activity is committed, with the number of files processed so far,
+        the number to process and the ids of the activities just committed.
+
+        Only one import runs at a time per importer, others wait for it to
+        finish so they see what it stored.
+        """
+        self._lock.acquire()
+        try:
+            return self._import_files(filenames, progress)
+        finally:
+            self._lock.release()
+
+    def _import_files(self, candidates, progress):
+        start = time.time()
         session = Session()
+        try:
+            report = self._import_sources(session, candidates, progress)
+        finally:
+            session.close()
 
-        for root, dirs, files in os.walk(directory):
-            for file in files:
-                if file.endswith(".tcx"):
-#                    try:
-                        self.import_file(session, os.path.join(root, file))
-                        session.commit()
-#                    except Exception, ex:
-#                        log.error("Error importing: %s" % file)
-#                        log.error(ex)
-#                        session.rollback()
+        report.finish(time.time() - start)
+        report.log()
+        return report
+
+    def _import_sources(self, session, candidates, progress):
+        start = time.time()
+        manifest = ImportManifest(session)
+        report = ImportReport()
+
+        filenames = []
+        # Archive path to (stat, member sources) for each archive opened:
+        archives = {}
+        for candidate in candidates:
+            if is_archive(candidate):
+                # Unchanged archives are skipped without reading their
+                # directory, let alone their members:
+                stat = source_stat(candidate)
+                if manifest.is_unchanged(candidate, stat):
+                    report.skipped.append(candidate)
+                    continue
+                archives[candidate] = (stat, [])
+            for filename, stat in list_sources(candidate, self.handles):
+                if candidate in archives:
+                    archives[candidate][1].append(filename)
+                if self._check_file(session, manifest, filename, stat,
+                        report):
+                    filenames.append(filename)
+        self._commit(session, report)
+        report.stages['scan'] = time.time() - start
+
+        self.known_activities = manifest.activities
+
+        if progress is not None:
+            progress(0, len(filenames), [])
+
+        done = 0
+        batched = 0
+        batch_ids = []
+        batch_start = time.time()
+        for filename, activities, error, timings in \
+                self._parse_files(filenames):
+            if error is None and timings.get('streamed'):
+                # Commits as it goes, so commit the batch so far first:
+                self._commit(session, report)
+                if progress is not None and batch_ids:
+                    progress(done, len(filenames), batch_ids)
+                batched = 0
+                batch_ids = []
+                batch_start = time.time()
+
+                stored = None
+                if progress is not None:
+                    stored = lambda activity_ids: progress(done,
+                            len(filenames), activity_ids)
+                error = self._store_streamed_file(session, manifest,
+                        filename, activities, timings, report, stored)
+            elif error is None:
+                session.begin_nested()
+                try:
+                    activity_ids = self._store_file(session, manifest,
+                            filename, activities, timings)
+                    session.commit()
+                    batch_ids.extend(activity_ids)
+                except Exception, ex:
+                    session.rollback()
+                    error = str(ex)
+
+            if error is None:
+                report.imported.append(filename)
+                report.add_file(timings)
+            else:
+                log.error("Error importing %s: %s" % (filename, error))
+                report.failures.append((filename, error))
+                content_hash, stat = manifest.pending.pop(filename,
+                        (None, None))
+                if stat is None:
+                    stat = source_stat(filename)
+                manifest.record(session, filename, stat, content_hash,
+                        IMPORT_STATUS_FAILED)
+
+            done += 1
+            batched += 1
+            if batched >= self.batch_size or done == len(filenames) or \
+                    time.time() - batch_start >= self.batch_seconds:
+                self._commit(session, report)
+                if progress is not None:
+                    progress(done, len(filenames), batch_ids)
+                batched = 0
+                batch_ids = []
+                batch_start = time.time()
+
+        # Archives are only skipped next time if none of their members
+        # need trying again:
+        for archive, (stat, members) in archives.items():
+            if not manifest.failed.intersection(members):
+                manifest.record(session, archive, stat, None,
+                        IMPORT_STATUS_ARCHIVE)
+        self._commit(session, report)
+        return report
+
+    def handles(self, filename):
+        """
+        Return True if the given file looks like one we can import, once
+        decompressed.
+        """
+        return uncompressed_name(filename).lower().endswith(self.extension)
+
+    def sniff(self, header):
+        """
+        Return True if the given start of a file's (decompressed) contents
+        looks like a file this importer can parse.
+        """
+        return False
+
+    def accepts(self, filename):
+        """
+        Return True if the given file is one we can import, or an archive
+        that may contain some.
+        """
+        return self.handles(filename) or is_archive(filename)
 
     def import_file(self, session, filename):
         """
-        Import the data in the given file.
+        Import the data in the given file or archive member.
         """
-        if not os.path.exists(filename):
+        try:
+            stat = source_stat(filename)
+        except OSError:
             raise Exception("No such file: %s" % filename)
 
-        base_filename = os.path.basename(filename)
+        manifest = ImportManifest(session)
+        if self._check_file(session, manifest, filename, stat,
+                ImportReport()):
+            self.known_activities = manifest.activities
+            self._store_file(session, manifest, filename,
+                    self.parse_file(filename), {})
+
+    def _check_file(self, session, manifest, filename, stat, report):
+        """
+        Return True if the given file, with the given stat, needs to be
+        parsed and imported, otherwise note why it's being skipped in the
+        report.
+
+        Files the manifest says are unchanged are skipped without being
+        opened.
+        """
+        if manifest.is_unchanged(filename, stat):
+            report.skipped.append(filename)
+            return False
 
-        # Check if we've imported this file before. Assume
-        # if an activity exists with a start time equal to the
-        # file name, that way we dont waste time parsing
-        # the XML.
-        if session.query(Import).filter(Import.identifier ==
-                base_filename).first():
-            log.info("Skipping: %s" % base_filename)
+        # Check if we've imported this file before, that way we dont waste
+        # time parsing it.
+        content_hash = hash_source(filename)
+        if manifest.is_imported(filename) or \
+                manifest.hashes.get(content_hash) == filename:
+            log.info("Skipping: %s" % os.path.basename(filename))
+            manifest.record(session, filename, stat, content_hash,
+                    IMPORT_STATUS_IMPORTED)
+            report.skipped.append(filename)
+            return False
+
+        # Same data under another name, i.e. a renamed or copied export:
+        if content_hash in manifest.hashes:
+            log.info("Skipping %s, duplicate of: %s" % (filename,
+                manifest.hashes[content_hash]))
+            manifest.record(session, filename, stat, content_hash,
+                    IMPORT_STATUS_DUPLICATE)
+            report.duplicates.append(filename)
+            return False
+
+        manifest.hashes[content_hash] = filename
+        manifest.pending[filename] = (content_hash, stat)
+        return True
+
+    def parse_file(self, filename):
+        """
+        Parse the given file and return a list of activity dicts. Must not
+        touch the database, this may be running in a worker process.
+        """
+        pass
+
+    def iter_activities(self, filename):
+        """
+        Yield activity dicts from the given file as they're parsed, used
+        for files being streamed. Importers that can parse incrementally
+        should override this, by default the whole file is parsed first.
+        """
+        return iter(self.parse_file(filename))
+
+    def _parse_timestamp(self, text):
+        """
+        Parse a timestamp, keeping track of the time spent doing so.
+        Subclasses should use this rather than calling parse_timestamp.
+        """
+        start = time.time()
+        result = parse_timestamp(text)
+        self.timestamp_time += time.time() - start
+        return result
+
+    def _try_parse_file(self, filename):
+        """
+        Parse the given file, returning (filename, activities, error,
+        timings) so a bad file can be reported without stopping the rest of
+        the import. Timings is a dict of per stage timings for the file.
+        """
+        self.timestamp_time = 0.0
+        start = time.time()
+        try:
+            activities = self.parse_file(filename)
+            error = None
+        except Exception, ex:
+            activities = None
+            error = str(ex)
+        timings = {
+            'filename': filename,
+            'bytes': source_stat(filename)[0],
+            'parse': time.time() - start,
+            'timestamps': self.timestamp_time,
+        }
+        return filename, activities, error, timings
+
+    def _stream_file(self, filename):
+        """
+        Return (filename, activities, error, timings) as _try_parse_file
+        does, but with activities a generator that parses the file as it's
+        consumed. Errors are raised from the generator. Timings are filled
+        in as it goes and marked as streamed.
+        """
+        timings = {
+            'filename': filename,
+            'bytes': source_stat(filename)[0],
+            'parse': 0.0,
+            'timestamps': 0.0,
+            'streamed': True,
+        }
+        return filename, self._timed_activities(filename, timings), None, \
+                timings
+
+    def _timed_activities(self, filename, timings):
+        """ Yield activities from the file, adding parse time to timings. """
+        activities = self.iter_activities(filename)
+        while True:
+            self.timestamp_time = 0.0
+            start = time.time()
+            try:
+                activity = activities.next()
+            except StopIteration:
+                activity = None
+            timings['parse'] += time.time() - start
+            timings['timestamps'] += self.timestamp_time
+            if activity is None:
+                return
+            yield activity
+
+    def _parse_files(self, filenames):
+        """
+        Yield (filename, activities, error, timings) for each of the given
+        files, in order. Error is None if the file parsed successfully.
+
+        Parsing is farmed out to a pool of worker processes if we've been
+        configured with more than one worker. Results still come back in
+        the order given so the single writer stores them deterministically.
+        Files to be streamed are always parsed in this process, as they're
+        stored. At most PARSE_WINDOW files per worker are parsed ahead of
+        the one being stored.
+        """
+        streamed = set([filename for filename in filenames if
+            source_stat(filename)[0] >= self.stream_size])
+        parsed = [filename for filename in filenames if filename not in
+                streamed]
+
+        if self.workers <= 1 or len(parsed) <= 1:
+            for filename in filenames:
+                log.info("Importing: %s" % filename)
+                if filename in streamed:
+                    yield self._stream_file(filename)
+                else:
+                    yield self._try_parse_file(filename)
             return
 
-        log.info("Importing: %s" % filename)
+        log.debug("Parsing %s files with %s workers." % (len(parsed),
+            self.workers))
+        pool = multiprocessing.Pool(min(self.workers, len(parsed)),
+                _init_worker, (self, ))
+        try:
+            # Only hand out a few files per worker at a time, otherwise the
+            # workers race ahead of the writer and parsed files pile up in
+            # memory waiting to be stored:
+            window = PARSE_WINDOW * self.workers
+            queued = iter(parsed)
+            results = collections.deque()
+            for filename in filenames:
+                while len(results) < window:
+                    try:
+                        results.append(pool.apply_async(_parse_file,
+                            (queued.next(), )))
+                    except StopIteration:
+                        break
+                log.info("Importing: %s" % filename)
+                if filename in streamed:
+                    yield self._stream_file(filename)
+                else:
+                    yield results.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
 
-        tree = ElementTree()
-        tree.parse(filename)
-        root = tree.getroot()
-        activities_elem = root.find(self._get_tag("Activities"))
-        if activities_elem is None:
-            raise Exception("Unable to parse %s: No activities found." %
-                    filename)
-        for activity_elem in activities_elem.findall(
-            self._get_tag("Activity")):
-            self._parse_activity(session, activity_elem)
+    def _commit(self, session, report):
+        """
+        Commit the current batch, timing how long it takes. Only flushed on
+        a dry run, the session is rolled back once the import is done.
+        """
+        start = time.time()
+        if self.dry_run:
+            session.flush()
+        else:
+            session.commit()
+        report.stages['commit'] += time.time() - start
+
+    def _store_file(self, session, manifest, filename, activities, timings):
+        """
+        Write the parsed activities from the given file to the database,
+        returning the ids of the new activities.
+
+        Time spent and trackpoints stored are added to the timings dict.
+        """
+        activity_ids, fingerprints = self._store_activities(session,
+                manifest, activities, timings)
+        start = time.time()
+        self._finish_file(session, manifest, filename)
+        timings['insert'] += time.time() - start
+
+        # Only once everything is written, the caller may roll us back:
+        manifest.activities.update(fingerprints)
+        return activity_ids
+
+    def _store_streamed_file(self, session, manifest, filename, activities,
+            timings, report, stored=None):
+        """
+        Write activities to the database as they're parsed from a streamed
+        file, committing each one along with a checkpoint. Returns an error
+        message if the file couldn't be imported, otherwise None.
+
+        Stored, if given, is called with the ids of each activity once
+        committed. Activities committed before an error are kept, the file
+        is tried again on the next scan which carries on from the
+        checkpoint.
+        """
+        table = ImportCheckpoint.__table__
+        try:
+            for activity in activities:
+                activity_ids, fingerprints = self._store_activities(session,
+                        manifest, [activity], timings)
+                for fingerprint in fingerprints:
+                    session.execute(table.insert(), {
+                        'path': filename,
+                        'start_time': fingerprint,
+                    })
+                self._commit(session, report)
+                manifest.activities.update(fingerprints)
+                if activity_ids and stored is not None:
+                    stored(activity_ids)
+
+            self._finish_file(session, manifest, filename)
+            session.execute(table.delete().where(table.c.path == filename))
+            self._commit(session, report)
+        except Exception, ex:
+            session.rollback()
+            return str(ex)
+        return None
+
+    def _store_activities(self, session, manifest, activities, timings):
+        """
+        Write the given activity dicts to the database, skipping any that
+        are already stored. Returns the ids of the new activities and the
+        set of their fingerprints, for the caller to add to the manifest
+        once they're safely written.
 
+        Time spent and trackpoints stored are added to the timings dict.
+        """
+        start = time.time()
+        rows = []
+        fingerprints = set()
+        for activity in activities:
+            # Might already be stored from another file, or another file
+            # earlier in this scan:
+            fingerprint = activity_fingerprint(activity['start_time'])
+            if fingerprint in manifest.activities or \
+                    fingerprint in fingerprints:
+                log.info("Skipping activity already imported: %s" %
+                        activity['start_time'])
+                continue
+            fingerprints.add(fingerprint)
+
+            debug_activity(activity)
+            rows.append({
+                'start_time': activity['start_time'],
+                'sport_id': SPORTS.get_id(session, activity['sport']),
+                'laps': activity['laps'],
+            })
+        timings['build'] = timings.get('build', 0.0) + time.time() - start
+
+        start = time.time()
+        activity_ids = bulk_insert_activities(session, rows, self.packed)
+        timings['trackpoints'] = timings.get('trackpoints', 0) + sum(
+                [len(trackpoints) for row in rows for lap in row['laps']
+                    for trackpoints in lap['tracks']])
+        timings['insert'] = timings.get('insert', 0.0) + time.time() - start
+        return activity_ids, fingerprints
+
+    def _finish_file(self, session, manifest, filename):
+        """ Record that the given file has been imported. """
         # Store that we've imported this file in the past, allowing us to
         # delete in the UI without re-importing it if the file is still laying
         # around in the directory. Manual file import should be made available
         # at some point to correct any delete mistakes.
-        imp = Import(1, base_filename)
-        session.add(imp)
+        content_hash, stat = manifest.pending.pop(filename, (None, None))
+        if content_hash is None:
+            content_hash = hash_source(filename)
+            stat = source_stat(filename)
+        manifest.record(session, filename, stat, content_hash,
+                IMPORT_STATUS_IMPORTED)
+
+    def _get_sport_name(self, sport_name, laps):
+        """
+        Return the name of the sport to store for an activity of the given
+        sport and lap dicts.
+        """
+        # Running slow == walking!
+        if sport_name.lower() == SPORTNAME_RUNNING:
+            distance = sum([lap['distance'] for lap in laps])
+            duration = sum([lap['duration'] for lap in laps])
+            if duration > 0 and \
+                    float(distance) / float(duration) < WALK_RUN_THRESHOLD:
+                return SPORTNAME_WALKING
+        return sport_name
+
+
+class ImportThread(threading.Thread):
+    """
+    Runs an importer's scan_dir in the background, so the UI doesn't have
+    to wait for it. scan_dir uses its own session.
+
+    Progress and finished callbacks are called from the import thread,
+    progress as for scan_dir and finished with the ImportReport, or None if
+    the import failed outright. UIs should hand these off to their main
+    loop.
+    """
+
+    def __init__(self, importer, directory, progress=None, finished=None):
+        threading.Thread.__init__(self, name="granola-import")
+        # Don't hold up application exit for an import in progress:
+        self.setDaemon(True)
+        self.importer = importer
+        self.directory = directory
+        self.progress = progress
+        self.finished = finished
+
+    def run(self):
+        report = None
+        try:
+            report = self.importer.scan_dir(self.directory, self.progress)
+        except Exception, ex:
+            log.exception("Error importing from %s: %s" % (self.directory,
+                ex))
+        if self.finished is not None:
+            self.finished(report)
+
+
+class GarminTcxImporter(Importer):
+    """
+    Importer for Garmin TCX XML Documents.
+
+    See: http://developer.garmin.com/schemas/tcx/v2/
+    """
+    extension = ".tcx"
+
+    # TODO: There must be a way to get this off the ElementTree object:
+    xmlns = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
+
+    def sniff(self, header):
+        return "<TrainingCenterDatabase" in header
+
+    def parse_file(self, filename):
+        """ Parse the given TCX file into a list of activity dicts. """
+        return list(self.iter_activities(filename))
+
+    def iter_activities(self, filename):
+        f = open_source(filename)
+        try:
+            for activity_elem, laps in self._iterparse(f):
+                yield self._parse_activity(activity_elem, laps)
+        finally:
+            f.close()
+
+    def _iterparse(self, source):
+        """
+        Incrementally parse the given TCX file or file object.
+
+        Yields (activity_elem, laps) as each Activity element closes, laps
+        being the lap dicts parsed from it.
+
+        Trackpoints, tracks and laps are parsed as soon as their closing tag
+        is seen and then detached from the tree, so peak memory is bounded
+        by a single activity rather than the whole file.
+
+        Activities in known_activities are recognised from their Id, which
+        precedes the laps, and skipped without parsing the rest.
+        """
+        activities_tag = self._get_tag("Activities")
+        activity_tag = self._get_tag("Activity")
+        id_tag = self._get_tag("Id")
+        lap_tag = self._get_tag("Lap")
+        track_tag = self._get_tag("Track")
+        trackpoint_tag = self._get_tag("Trackpoint")
+
+        # Stack of currently open elements, lets us detach each element from
+        # its parent once we're done with it:
+        open_elems = []
+        found_activities = False
+        skipping = False
+        laps = []
+        tracks = []
+        track = None
 
-    def _parse_activity(self, session, activity_elem):
+        for event, elem in iterparse(source, events=("start", "end")):
+            if event == "start":
+                open_elems.append(elem)
+                if elem.tag == track_tag:
+                    track = []
+                continue
+
+            open_elems.pop()
+            if elem.tag == trackpoint_tag:
+                if not skipping:
+                    track.append(self._parse_trackpoint(elem))
+            elif elem.tag == track_tag:
+                tracks.append(track)
+                track = None
+            elif elem.tag == lap_tag:
+                # Tracks have already been detached, only the lap summary
+                # elements remain:
+                if not skipping:
+                    lap = self._parse_lap(elem)
+                    lap['tracks'] = tracks
+                    laps.append(lap)
+                tracks = []
+            elif elem.tag == activity_tag:
+                if not skipping:
+                    yield elem, laps
+                skipping = False
+                laps = []
+            elif elem.tag == activities_tag:
+                found_activities = True
+            elif elem.tag == id_tag and open_elems[-1].tag == activity_tag:
+                start_time = self._parse_timestamp(elem.text)
+                if activity_fingerprint(start_time) in \
+                        self.known_activities:
+                    log.info("Skipping activity already imported: %s" %
+                            start_time)
+                    skipping = True
+                continue
+            else:
+                # Leave everything else in place for the enclosing element
+                # to read when it closes.
+                continue
+
+            if open_elems:
+                open_elems[-1].remove(elem)
+            elem.clear()
+
+        if not found_activities:
+            raise Exception("Unable to parse %s: No activities found." %
+                    getattr(source, "name", source))
+
+    def _parse_activity(self, activity_elem, laps):
         """ Parse an XML activity element. """
 
         # NOTE: Using the ID for a start time here, it appears to be equal
         # to the start time of the first lap but not sure if this is
         # guaranteed in the XML definition:
         start_time_elem = activity_elem.find(self._get_tag("Id"))
-        start_time = dateutil.parser.parse(start_time_elem.text)
+        start_time = self._parse_timestamp(start_time_elem.text)
 
-        activity = Activity(start_time=start_time, sport=None)
-        lap_elements = activity_elem.findall(self._get_tag("Lap"))
-        for lap_elem in lap_elements:
-            new_lap = self._parse_lap(lap_elem)
-            activity.laps.append(new_lap)
-
-        debug_activity(activity)
-        sport = self._get_activity_sport(session, activity_elem, activity)
-        activity.sport = sport
-        session.add(activity)
+        return {
+            'start_time': start_time,
+            'sport': self._get_activity_sport(activity_elem, laps),
+            'laps': laps,
+        }
 
     def _parse_lap(self, lap_elem):
-        """ Parse an XML lap element. """
-        start_time = dateutil.parser.parse(lap_elem.attrib['StartTime'])
+        """
+        Parse the summary data of an XML lap element. Tracks are parsed
+        separately as they stream past.
+        """
+        start_time = self._parse_timestamp(lap_elem.attrib['StartTime'])
         duration = float(lap_elem.find(self._get_tag("TotalTimeSeconds")).text)
         distance = float(lap_elem.find(self._get_tag("DistanceMeters")).text)
         speed_max = float(lap_elem.find(self._get_tag("MaximumSpeed")).text)
-        calories = lap_elem.find(self._get_tag("Calories")).text
+        calories = int(lap_elem.find(self._get_tag("Calories")).text)
 
         heart_rate_max = None
         max_hr_elem = lap_elem.find(self._get_tag("MaximumHeartRateBpm"))
         if max_hr_elem:
-            heart_rate_max = max_hr_elem.find(self._get_tag("Value")).text
+            heart_rate_max = int(max_hr_elem.find(
+                self._get_tag("Value")).text)
 
         heart_rate_avg = None
         avg_hr_elem = lap_elem.find(self._get_tag("AverageHeartRateBpm"))
         if avg_hr_elem:
-            heart_rate_avg = avg_hr_elem.find(self._get_tag("Value")).text
-
-        lap = Lap(start_time=start_time, duration=duration, distance=distance,
-                speed_max=speed_max, calories=calories,
-                heart_rate_max=heart_rate_max, heart_rate_avg=heart_rate_avg)
+            heart_rate_avg = int(avg_hr_elem.find(
+                self._get_tag("Value")).text)
 
-        track_elements = lap_elem.findall(self._get_tag("Track"))
-        for track_element in track_elements:
-            new_track = self._parse_track(track_element)
-            lap.tracks.append(new_track)
-
-        return lap
-
-    def _parse_track(self, track_elem):
-        trackpoint_elements = track_elem.findall(
-                self._get_tag("Trackpoint"))
-        track = Track()
-        for trackpoint_element in trackpoint_elements:
-            new_trackpoint = self._parse_trackpoint(trackpoint_element)
-            track.trackpoints.append(new_trackpoint)
-        return track
+        return {
+            'start_time': start_time,
+            'duration': duration,
+            'distance': distance,
+            'speed_max': speed_max,
+            'calories': calories,
+            'heart_rate_max': heart_rate_max,
+            'heart_rate_avg': heart_rate_avg,
+        }
 
     def _parse_trackpoint(self, trackpoint_elem):
-        time = dateutil.parser.parse(trackpoint_elem.find(
+        time = self._parse_timestamp(trackpoint_elem.find(
             self._get_tag("Time")).text)
 
         altitude = None
@@ -217,26 +1078,20 @@ class GarminTcxImporter(Importer):
             longitude = float(position_elem.find(
                 self._get_tag("LongitudeDegrees")).text)
         
-        tp = TrackPoint(time=time, latitude=latitude, longitude=longitude, 
-                altitude=altitude, distance=distance, heart_rate=heart_rate)
-        return tp
+        return {
+            'time': time,
+            'latitude': latitude,
+            'longitude': longitude,
+            'altitude': altitude,
+            'distance': distance,
+            'heart_rate': heart_rate,
+        }
 
-    def _get_activity_sport(self, session, activity_elem, activity):
+    def _get_activity_sport(self, activity_elem, laps):
         """
-        Lookup a Sport object for this activity.
+        Return the name of the sport for this activity.
         """
-        xml_sport = activity_elem.attrib['Sport']
-
-        # Running slow == walking!
-        if xml_sport.lower() == SPORTNAME_RUNNING:
-            speed = float(activity.distance) / float(activity.duration)
-            if speed < WALK_RUN_THRESHOLD:
-                xml_sport = SPORTNAME_WALKING
-
-        q = session.query(Sport).filter(Sport.name.like(xml_sport))
-        # Will error out if no sport is found:
-        sport = q.one()
-        return sport
+        return self._get_sport_name(activity_elem.attrib['Sport'], laps)
 
     def _get_tag(self, tag):
         """
@@ -244,3 +1099,478 @@ class GarminTcxImporter(Importer):
         i.e. {XMLNS}Tag
         """
         return "{%s}%s" % (self.xmlns, tag)
+
+
+class GpxImporter(Importer):
+    """
+    Importer for GPX 1.0 and 1.1 documents, as written by most devices and
+    sites other than Garmin's.
+
+    Each track (trk) becomes an activity with a single lap, GPX having no
+    notion of laps, and each track segment (trkseg) a track. GPX doesn't
+    record distance so it's calculated from the positions. Heart rate is
+    read from the Garmin TrackPointExtension, or similar extensions with a
+    heart rate element, when present.
+
+    See: http://www.topografix.com/gpx.asp
+    """
+    extension = ".gpx"
+
+    # Track types we recognise, anything else is stored as other:
+    sports = {
+        "running": SPORTNAME_RUNNING,
+        "run": SPORTNAME_RUNNING,
+        "biking": SPORTNAME_BIKING,
+        "cycling": SPORTNAME_BIKING,
+        "walking": SPORTNAME_WALKING,
+        "hiking": SPORTNAME_WALKING,
+    }
+
+    # Extension elements carrying heart rate, in any namespace:
+    heart_rate_tags = ["hr", "heartrate"]
+
+    def sniff(self, header):
+        return "<gpx" in header
+
+    def parse_file(self, filename):
+        """ Parse the given GPX file into a list of activity dicts. """
+        return list(self.iter_activities(filename))
+
+    def iter_activities(self, filename):
+        f = open_source(filename)
+        try:
+            for activity in self._iterparse(f):
+                yield activity
+        finally:
+            f.close()
+
+    def _iterparse(self, source):
+        """
+        Incrementally parse the given GPX file or file object, yielding an
+        activity dict as each track closes.
+
+        As for TCX, trackpoints are parsed as their closing tag is seen and
+        then detached from the tree. Tracks whose first timestamp is in
+        known_activities are skipped without parsing the rest.
+        """
+        open_elems = []
+        found_gpx = False
+        skipping = False
+        start_time = None
+        tracks = []
+        track = None
+
+        for event, elem in iterparse(source, events=("start", "end")):
+            tag = self._local_name(elem.tag)
+            if event == "start":
+                open_elems.append(elem)
+                if tag == "gpx":
+                    found_gpx = True
+                elif tag == "trk":
+                    skipping = False
+                    start_time = None
+                    tracks = []
+                elif tag == "trkseg":
+                    track = []
+                continue
+
+            open_elems.pop()
+            if tag == "trkpt":
+                if not skipping:
+                    trackpoint = self._parse_trackpoint(elem)
+                    if start_time is None and trackpoint['time'] is not None:
+                        start_time = trackpoint['time']
+                        if activity_fingerprint(start_time) in \
+                                self.known_activities:
+                            log.info("Skipping activity already imported: "
+                                    "%s" % start_time)
+                            skipping = True
+                    track.append(trackpoint)
+            elif tag == "trkseg":
+                if track:
+                    tracks.append(track)
+                track = None
+            elif tag == "trk":
+                if not skipping:
+                    activity = self._build_activity(elem, tracks)
+                    if activity is not None:
+                        yield activity
+                tracks = []
+            else:
+                # Leave everything else in place for the enclosing element
+                # to read when it closes.
+                continue
+
+            if open_elems:
+                open_elems[-1].remove(elem)
+            elem.clear()
+
+        if not found_gpx:
+            raise Exception("Unable to parse %s: Not a GPX document." %
+                    getattr(source, "name", source))
+
+    def _parse_trackpoint(self, trackpoint_elem):
+        """
+        Parse an XML trkpt element. Distance is filled in once the whole
+        track has been read.
+        """
+        time = None
+        altitude = None
+        heart_rate = None
+        for child in trackpoint_elem:
+            tag = self._local_name(child.tag)
+            if tag == "time":
+                time = self._parse_timestamp(child.text.strip())
+            elif tag == "ele":
+                altitude = float(child.text)
+            elif tag == "extensions":
+                for ext_elem in child.getiterator():
+                    if self._local_name(ext_elem.tag).lower() in \
+                            self.heart_rate_tags:
+                        heart_rate = int(ext_elem.text)
+
+        return {
+            'time': time,
+            'latitude': float(trackpoint_elem.attrib['lat']),
+            'longitude': float(trackpoint_elem.attrib['lon']),
+            'altitude': altitude,
+            'distance': None,
+            'heart_rate': heart_rate,
+        }
+
+    def _build_activity(self, track_elem, tracks):
+        """
+        Return an activity dict for the given trk element and its tracks of
+        trackpoint dicts, or None if it can't be stored.
+        """
+        times = [trackpoint['time'] for track in tracks for trackpoint in
+                track if trackpoint['time'] is not None]
+        if not times:
+            log.warn("Skipping track with no timestamps.")
+            return None
+
+        # Cumulative distance, as TCX records it. Gaps between segments,
+        # i.e. lost signal, aren't counted:
+        distance = 0.0
+        speed_max = 0.0
+        heart_rates = []
+        for track in tracks:
+            previous = None
+            for trackpoint in track:
+                if previous is not None:
+                    meters = calculate_distance(previous['latitude'],
+                            previous['longitude'], trackpoint['latitude'],
+                            trackpoint['longitude'])
+                    distance += meters
+                    if previous['time'] is not None and \
+                            trackpoint['time'] is not None:
+                        seconds = total_seconds(trackpoint['time'] -
+                                previous['time'])
+                        if seconds > 0:
+                            speed_max = max(speed_max, meters / seconds)
+                trackpoint['distance'] = distance
+                if trackpoint['heart_rate'] is not None:
+                    heart_rates.append(trackpoint['heart_rate'])
+                previous = trackpoint
+
+        heart_rate_max = None
+        heart_rate_avg = None
+        if heart_rates:
+            heart_rate_max = max(heart_rates)
+            heart_rate_avg = int(round(float(sum(heart_rates)) /
+                len(heart_rates)))
+
+        lap = {
+            'start_time': times[0],
+            'duration': total_seconds(times[-1] - times[0]),
+            'distance': distance,
+            'speed_max': speed_max,
+            'calories': None,
+            'heart_rate_max': heart_rate_max,
+            'heart_rate_avg': heart_rate_avg,
+            'tracks': tracks,
+        }
+
+        sport_name = SPORTNAME_OTHER
+        for child in track_elem:
+            if self._local_name(child.tag) == "type" and child.text:
+                sport_name = self.sports.get(child.text.strip().lower(),
+                        SPORTNAME_OTHER)
+
+        return {
+            'start_time': times[0],
+            'sport': self._get_sport_name(sport_name, [lap]),
+            'laps': [lap],
+        }
+
+    def _local_name(self, tag):
+        """ Return the tag name without its XML namespace. """
+        return tag[tag.rfind("}") + 1:]
+
+
+class FitImporter(Importer):
+    """
+    Importer for Garmin FIT binary files, as found on newer devices.
+
+    Records between two lap messages become that lap's track, laps between
+    two session messages that session's activity. Files without lap or
+    session messages get a single lap or activity built from their records.
+
+    See granola.fit for the decoding itself.
+    """
+    extension = ".fit"
+
+    # FIT sport enum to sport name:
+    sports = {
+        1: SPORTNAME_RUNNING,
+        2: SPORTNAME_BIKING,
+        11: SPORTNAME_WALKING,
+        17: SPORTNAME_WALKING, # hiking
+    }
+
+    # Semicircles to degrees:
+    SEMICIRCLES = 180.0 / 2 ** 31
+
+    def sniff(self, header):
+        return header[8:12] == ".FIT"
+
+    def parse_file(self, filename):
+        """ Parse the given FIT file into a list of activity dicts. """
+        f = open_source(filename)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        activities = []
+        laps = []
+        records = []
+        for number, fields in read_messages(data, (MESG_SESSION, MESG_LAP,
+                MESG_RECORD)):
+            if number == MESG_RECORD:
+                records.append(self._parse_record(fields))
+            elif number == MESG_LAP:
+                laps.append(self._parse_lap(fields, records))
+                records = []
+            elif number == MESG_SESSION:
+                if records:
+                    laps.append(self._parse_lap({}, records))
+                    records = []
+                activity = self._build_activity(fields, laps)
+                if activity is not None:
+                    activities.append(activity)
+                laps = []
+
+        # Files cut short, i.e. by a device crash, may be missing the
+        # closing lap and session:
+        if records:
+            laps.append(self._parse_lap({}, records))
+        if laps:
+            activity = self._build_activity({}, laps)
+            if activity is not None:
+                activities.append(activity)
+        return activities
+
+    def _parse_record(self, fields):
+        """ Return a trackpoint dict for a record message. """
+        time = None
+        if FIELD_TIMESTAMP in fields:
+            time = to_datetime(fields[FIELD_TIMESTAMP])
+
+        latitude = None
+        longitude = None
+        if 0 in fields and 1 in fields:
+            latitude = fields[0] * self.SEMICIRCLES
+            longitude = fields[1] * self.SEMICIRCLES
+
+        # Enhanced altitude replaces the 16 bit field on newer devices:
+        altitude = fields.get(78, fields.get(2))
+        if altitude is not None:
+            altitude = altitude / 5.0 - 500
+
+        distance = fields.get(5)
+        if distance is not None:
+            distance = distance / 100.0
+
+        return {
+            'time': time,
+            'latitude': latitude,
+            'longitude': longitude,
+            'altitude': altitude,
+            'distance': distance,
+            'heart_rate': fields.get(3),
+        }
+
+    def _parse_lap(self, fields, records):
+        """
+        Return a lap dict for a lap message and the records preceding it.
+        Anything missing from the message is worked out from the records.
+        """
+        times = [record['time'] for record in records
+                if record['time'] is not None]
+
+        start_time = None
+        if 2 in fields:
+            start_time = to_datetime(fields[2])
+        elif times:
+            start_time = times[0]
+
+        # Timer time excludes pauses, as TCX's TotalTimeSeconds does:
+        duration = fields.get(8, fields.get(7))
+        if duration is not None:
+            duration = duration / 1000.0
+        elif times:
+            duration = total_seconds(times[-1] - times[0])
+        else:
+            duration = 0.0
+
+        distance = fields.get(9)
+        if distance is not None:
+            distance = distance / 100.0
+        else:
+            distances = [record['distance'] for record in records
+                    if record['distance'] is not None]
+            distance = 0.0
+            if distances:
+                distance = distances[-1] - distances[0]
+
+        speed_max = fields.get(14)
+        if speed_max is not None:
+            speed_max = speed_max / 1000.0
+
+        tracks = []
+        if records:
+            tracks.append(records)
+
+        return {
+            'start_time': start_time,
+            'duration': duration,
+            'distance': distance,
+            'speed_max': speed_max,
+            'calories': fields.get(11),
+            'heart_rate_max': fields.get(16),
+            'heart_rate_avg': fields.get(15),
+            'tracks': tracks,
+        }
+
+    def _build_activity(self, fields, laps):
+        """
+        Return an activity dict for a session message and its laps, or None
+        if there's nothing to store.
+        """
+        start_time = None
+        if 2 in fields:
+            start_time = to_datetime(fields[2])
+        else:
+            for lap in laps:
+                if lap['start_time'] is not None:
+                    start_time = lap['start_time']
+                    break
+        if start_time is None:
+            log.warn("Skipping FIT session with no start time.")
+            return None
+
+        if activity_fingerprint(start_time) in self.known_activities:
+            log.info("Skipping activity already imported: %s" % start_time)
+            return None
+
+        sport_name = self.sports.get(fields.get(5), SPORTNAME_OTHER)
+        return {
+            'start_time': start_time,
+            'sport': self._get_sport_name(sport_name, laps),
+            'laps': laps,
+        }
+
+
+# Importer classes available to MultiFormatImporter, see register_importer:
+IMPORTERS = []
+
+# Generic extensions of files that may be in any format, these are opened
+# and sniffed to find out:
+SNIFF_EXTENSIONS = [".xml"]
+
+# Bytes read from the start of a file to sniff its format:
+SNIFF_SIZE = 1024
+
+
+def register_importer(importer_class):
+    """
+    Make the given Importer subclass available to MultiFormatImporter.
+    """
+    if importer_class not in IMPORTERS:
+        IMPORTERS.append(importer_class)
+
+
+class MultiFormatImporter(Importer):
+    """
+    Imports every format there's a registered importer for, in a single
+    pass over the import folder.
+
+    Each file is handed to the first importer whose sniff recognises its
+    contents, or failing that whose extension it has. Storage, the manifest
+    and the rest are shared as for any importer.
+    """
+
+    def __init__(self, workers=1, batch_size=50, stream_size=STREAM_SIZE,
+            dry_run=False, packed=False, batch_seconds=BATCH_SECONDS,
+            importers=None):
+        Importer.__init__(self, workers, batch_size, stream_size, dry_run,
+                packed, batch_seconds)
+        if importers is None:
+            importers = [importer_class() for importer_class in IMPORTERS]
+        self.importers = importers
+
+    def handles(self, filename):
+        for importer in self.importers:
+            if importer.handles(filename):
+                return True
+        name = uncompressed_name(filename).lower()
+        for extension in SNIFF_EXTENSIONS:
+            if name.endswith(extension):
+                return True
+        return False
+
+    def sniff(self, header):
+        for importer in self.importers:
+            if importer.sniff(header):
+                return True
+        return False
+
+    def parse_file(self, filename):
+        return list(self.iter_activities(filename))
+
+    def iter_activities(self, filename):
+        importer = self._get_importer(filename)
+        importer.known_activities = self.known_activities
+        activities = importer.iter_activities(filename)
+        while True:
+            importer.timestamp_time = 0.0
+            try:
+                activity = activities.next()
+            except StopIteration:
+                activity = None
+            self.timestamp_time += importer.timestamp_time
+            if activity is None:
+                return
+            yield activity
+
+    def _get_importer(self, filename):
+        """ Return the importer to parse the given file with. """
+        f = open_source(filename)
+        try:
+            header = f.read(SNIFF_SIZE)
+        finally:
+            f.close()
+
+        for importer in self.importers:
+            if importer.sniff(header):
+                return importer
+        for importer in self.importers:
+            if importer.handles(filename):
+                return importer
+        raise Exception("Unable to parse %s: Unknown format." % filename)
+
+
+register_importer(GarminTcxImporter)
+register_importer(GpxImporter)
+register_importer(FitImporter)
@@ -19,13 +19,23 @@
 #   02110-1301  USA
 
 import os.path
+import re
+import threading
 
-from granola.log import log
-from granola.const import DATA_DIR, VERSION
+from collections import namedtuple
 
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, \
-        String, ForeignKey, Numeric, DateTime
-from sqlalchemy.orm import mapper, relation, sessionmaker
+from granola.log import log
+from granola.const import DATA_DIR
+from granola.packing import Sample, pack_samples, unpack_samples, \
+        unpack_columns
+
+from sqlalchemy import create_engine, event, MetaData, Table, Column, \
+        Integer, String, ForeignKey, DateTime, Float, LargeBinary, \
+        Index, select
+from sqlalchemy.orm import mapper, relation, sessionmaker, joinedload, \
+        subqueryload_all
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.ext.declarative import declarative_base
 
 SQLITE_DB = "%s/granola.db" % DATA_DIR
@@ -35,18 +45,129 @@ SPORTNAME_BIKING = "biking"
 SPORTNAME_WALKING = "walking"
 SPORTNAME_OTHER = "other"
 
+# ImportedFile statuses:
+IMPORT_STATUS_IMPORTED = 1
+IMPORT_STATUS_DUPLICATE = 2
+IMPORT_STATUS_FAILED = 3
+# An archive all of whose members have been examined:
+IMPORT_STATUS_ARCHIVE = 4
 
-def connect_to_db():
+
+def _disable_pysqlite_transactions(dbapi_con, con_record):
+    """
+    Stop pysqlite from managing transactions itself. It commits whenever it
+    sees a statement it doesn't recognise, SAVEPOINT included, which breaks
+    nested transactions. See _begin_transaction.
+    """
+    dbapi_con.isolation_level = None
+
+
+def _begin_transaction(conn):
+    """ Explicitly begin the transactions pysqlite no longer does for us. """
+    conn.execute("BEGIN")
+
+
+# SQLite PRAGMAs a storage profile can set, in the order they're applied:
+STORAGE_PRAGMAS = ["journal_mode", "synchronous", "cache_size", "mmap_size",
+        "temp_store"]
+
+# Named sets of storage PRAGMAs, selected with the profile option of the
+# [storage] section of granolarc. Negative cache sizes are in KB:
+STORAGE_PROFILES = {
+    # SQLite's defaults, with every commit synced to disk:
+    "safe": {
+        "journal_mode": "delete",
+        "synchronous": "full",
+        "cache_size": "-2000",
+        "mmap_size": "0",
+        "temp_store": "default",
+    },
+    # Fast bulk writes, only syncing at WAL checkpoints. A power cut or OS
+    # crash can lose the last few commits, which the importer's manifest
+    # will simply import again, but leaves the database intact:
+    "fast-import": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": "-65536",
+        "mmap_size": "268435456",
+        "temp_store": "memory",
+    },
+    # Large cache and memory mapped reads for browsing a big history, WAL
+    # so background imports don't block the UI:
+    "read-heavy": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": "-32768",
+        "mmap_size": "268435456",
+        "temp_store": "memory",
+    },
+}
+
+DEFAULT_STORAGE_PROFILE = "safe"
+
+# PRAGMAs applied to every new connection, see set_storage_settings:
+STORAGE_SETTINGS = {}
+
+_PRAGMA_VALUE = re.compile(r"^-?\w+$")
+
+
+def get_storage_settings(profile, overrides=None):
+    """
+    Return the PRAGMA settings of the given storage profile, with any of
+    them replaced by those in the given dict of overrides.
+    """
+    if profile not in STORAGE_PROFILES:
+        raise Exception("Unknown storage profile: %s" % profile)
+    settings = dict(STORAGE_PROFILES[profile])
+    if overrides:
+        for name, value in overrides.items():
+            if name not in STORAGE_PRAGMAS:
+                raise Exception("Unknown storage setting: %s" % name)
+            settings[name] = value
+    for name, value in settings.items():
+        # PRAGMA values can't be bound as parameters:
+        if not _PRAGMA_VALUE.match(str(value)):
+            raise Exception("Invalid value for storage setting %s: %s" %
+                    (name, value))
+    return settings
+
+
+def set_storage_settings(settings):
+    """
+    Apply the given PRAGMA settings to every connection made from now on,
+    including to our database, whose open connections are closed so they
+    pick up the change.
     """
-    Open a connection to our database.
+    global STORAGE_SETTINGS
+    STORAGE_SETTINGS = dict(settings)
+    log.debug("Storage settings: %s" % STORAGE_SETTINGS)
+    DB.dispose()
+
+
+def _apply_storage_settings(dbapi_con, con_record):
+    """ Set the current storage PRAGMAs on a new connection. """
+    cursor = dbapi_con.cursor()
+    for name in STORAGE_PRAGMAS:
+        if name in STORAGE_SETTINGS:
+            cursor.execute("PRAGMA %s = %s" % (name, STORAGE_SETTINGS[name]))
+    cursor.close()
+
+
+def connect_to_db(db_str=None):
+    """
+    Open a connection to our database, or the given database URL.
 
     Should be called only once when this module is first imported.
     """
-    db_str = "sqlite:///%s" % SQLITE_DB
+    if db_str is None:
+        db_str = "sqlite:///%s" % SQLITE_DB
     log.debug("Connecting to database: %s" % db_str)
 
     # Set echo True to see lots of sqlalchemy output:
     db = create_engine(db_str, echo=False)
+    event.listen(db, "connect", _disable_pysqlite_transactions)
+    event.listen(db, "connect", _apply_storage_settings)
+    event.listen(db, "begin", _begin_transaction)
 
     return db
 
@@ -72,17 +193,85 @@ class Sport(Base):
         return self.name
 
 
+class SportCache(object):
+    """
+    Process wide cache of sport ids and names.
+
+    Sports almost never change but are looked up for every imported
+    activity and every time the UI filters by sport, so they're loaded once
+    and kept rather than queried each time. Cleared whenever a Sport is
+    inserted, updated or deleted through the ORM, and reloaded on a miss in
+    case another process added one.
+
+    Only plain ids and names are cached, get returns the Sport from the
+    caller's own session so it can be used with that session's objects.
+    """
+
+    def __init__(self):
+        # Lower cased name to (id, name), None until loaded:
+        self._sports = None
+        self._lock = threading.Lock()
+
+    def get_id(self, session, name):
+        """
+        Return the id of the sport with the given name, ignoring case.
+        Raises an exception if there is no such sport.
+        """
+        sports = self._load(session)
+        if name.lower() not in sports:
+            self.invalidate()
+            sports = self._load(session)
+        if name.lower() not in sports:
+            raise Exception("No such sport: %s" % name)
+        return sports[name.lower()][0]
+
+    def get(self, session, name):
+        """
+        Return the Sport with the given name from the given session,
+        without a query if the session has already loaded it.
+        """
+        return session.query(Sport).get(self.get_id(session, name))
+
+    def names(self, session):
+        """ Return the names of all sports, sorted. """
+        names = [name for (id, name) in self._load(session).values()]
+        names.sort()
+        return names
+
+    def invalidate(self, *args):
+        """ Forget the cached sports, they'll be reloaded when next used. """
+        self._sports = None
+
+    def _load(self, session):
+        self._lock.acquire()
+        try:
+            if self._sports is None:
+                sports = {}
+                for id, name in session.query(Sport.id, Sport.name):
+                    sports[name.lower()] = (id, name)
+                self._sports = sports
+            return self._sports
+        finally:
+            self._lock.release()
+
+
+SPORTS = SportCache()
+event.listen(Sport, "after_insert", SPORTS.invalidate)
+event.listen(Sport, "after_update", SPORTS.invalidate)
+event.listen(Sport, "after_delete", SPORTS.invalidate)
+
+
 class TrackPoint(Base):
 
     __tablename__ = "trackpoint"
 
     id = Column(Integer, primary_key=True)
-    track_id = Column(Integer, ForeignKey('track.id'))
+    track_id = Column(Integer, ForeignKey('track.id'), index=True)
     time = Column(DateTime(timezone=True))
-    latitude = Column(Numeric(9, 6))
-    longitude = Column(Numeric(9, 6))
-    altitude = Column(Numeric(12, 6))
-    distance = Column(Numeric(12, 6))
+    latitude = Column(Float) # degrees
+    longitude = Column(Float) # degrees
+    altitude = Column(Float) # meters
+    distance = Column(Float) # meters
     heart_rate = Column(Integer)
 
     def __init__(self, time=None, latitude=None, longitude=None, 
@@ -100,6 +289,21 @@ class TrackPoint(Base):
                 self.distance, self.heart_rate)
 
 
+class PackedTrack(Base):
+    """
+    A track's samples packed into a single compressed blob, as an optional
+    alternative to a trackpoint row per sample. See granola.packing, and
+    Track.get_samples for reading either.
+    """
+
+    __tablename__ = "packed_track"
+
+    track_id = Column(Integer, ForeignKey('track.id'), primary_key=True)
+    start_time = Column(DateTime(timezone=True))
+    count = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+
 class Track(Base):
     """
     Used to represent pauses in the track. A lap will normally have one track, 
@@ -111,21 +315,48 @@ class Track(Base):
     __tablename__ = "track"
 
     id = Column(Integer, primary_key=True)
-    lap_id = Column(Integer, ForeignKey('lap.id'))
+    lap_id = Column(Integer, ForeignKey('lap.id'), index=True)
 
     trackpoints = relation(TrackPoint, cascade="all")
+    packed = relation(PackedTrack, uselist=False, cascade="all")
+
+    def get_samples(self):
+        """
+        Return this track's samples, whether stored packed or as
+        trackpoints. Either way each has the TrackPoint attributes.
+        """
+        if self.packed is not None:
+            return unpack_samples(self.packed.start_time, self.packed.data)
+        return self.trackpoints
+
+    def get_columns(self):
+        """
+        Return this track's samples as a dict of TrackPoint attribute name
+        to list of values, whether stored packed or as trackpoints.
+        """
+        if self.packed is not None:
+            return unpack_columns(self.packed.start_time, self.packed.data)
+        columns = {}
+        for name in Sample._fields:
+            columns[name] = [getattr(trackpoint, name) for trackpoint in
+                    self.trackpoints]
+        return columns
 
 
 class Lap(Base):
 
     __tablename__ = "lap"
+    __table_args__ = (
+        # An activity's laps, in order:
+        Index("ix_lap_activity_id_start_time", "activity_id", "start_time"),
+    )
 
     id = Column(Integer, primary_key=True)
     activity_id = Column(Integer, ForeignKey('activity.id'))
     start_time = Column(DateTime(timezone=True))
-    duration = Column(Numeric(14, 6)) # seconds
-    distance = Column(Numeric(20, 6)) # meters
-    speed_max = Column(Numeric(9, 6)) # meters per second
+    duration = Column(Float) # seconds
+    distance = Column(Float) # meters
+    speed_max = Column(Float) # meters per second
     calories = Column(Integer)
     heart_rate_max = Column(Integer) # beats per minute
     heart_rate_avg = Column(Integer) # beats per minute
@@ -148,16 +379,39 @@ class Lap(Base):
 
 
 class Activity(Base):
+    """
+    A single workout. The summary columns (distance through max_longitude)
+    are totals over the laps and trackpoints, stored so listing activities
+    doesn't need to load every lap. They're filled in by
+    bulk_insert_activities, and kept up to date by update_summary whenever
+    laps are added, changed or removed through the ORM.
+    """
 
     __tablename__ = "activity"
+    __table_args__ = (
+        # Activities of a sport in order, for the activity list and metrics:
+        Index("ix_activity_sport_id_start_time", "sport_id", "start_time"),
+    )
 
     id = Column(Integer, primary_key=True)
     # Might want to drop this and just use the start time of the first lap:
     start_time = Column(DateTime(timezone=True), nullable=False, unique=True)
     sport_id = Column(Integer, ForeignKey('sport.id'), nullable=False)
 
+    distance = Column(Float) # meters
+    duration = Column(Float) # seconds
+    heart_rate_avg = Column(Integer) # beats per minute, weighted by duration
+    speed_max = Column(Float) # meters per second
+    calories = Column(Integer)
+    # Bounding box of all trackpoints with a position:
+    min_latitude = Column(Float)
+    max_latitude = Column(Float)
+    min_longitude = Column(Float)
+    max_longitude = Column(Float)
+
     sport = relation(Sport)
-    laps = relation(Lap, cascade="all", backref='activity')
+    laps = relation(Lap, cascade="all", backref='activity',
+            order_by=Lap.start_time)
 
     def __init__(self, start_time=None, sport=None):
         self.start_time = start_time
@@ -167,36 +421,97 @@ class Activity(Base):
         return "Activity<%s - %s>" % \
                 (self.id, self.start_time)
 
-    # TODO: All these properties are probably not the best performance wise:
-
-    def _get_distance(self):
-        distance = None
-        for lap in self.laps:
-            if distance == None:
-                distance = lap.distance
-            else:
-                distance += lap.distance
-        return distance
-    distance = property(_get_distance, None)
-
-    def _get_duration(self):
-        duration = None
-        for lap in self.laps:
-            if duration == None:
-                duration = lap.duration
-            else:
-                duration += lap.duration
-        return duration
-    duration = property(_get_duration, None)
-
-    def _get_heart_rate_avg(self):
-        beats = 0
-        for lap in self.laps:
-            if lap.heart_rate_avg is None:
-                return None
-            beats = beats + (lap.heart_rate_avg * (lap.duration / 60))
-        return int(beats / (self.duration / 60))
-    heart_rate_avg = property(_get_heart_rate_avg, None)
+    def update_summary(self, laps=None, bounds=True):
+        """
+        Recalculate the summary columns from the given laps, by default
+        this activity's. Finding the bounding box means reading every
+        sample, so it can be skipped with bounds=False.
+        """
+        if laps is None:
+            laps = self.laps
+        lap_values = []
+        for lap in laps:
+            lap_values.append(dict([(name, getattr(lap, name)) for name in
+                LAP_SUMMARY_COLUMNS]))
+        for name, value in summarize_laps(lap_values).items():
+            setattr(self, name, value)
+
+        if bounds:
+            coords = []
+            for lap in laps:
+                for track in lap.tracks:
+                    coords.extend([(sample.latitude, sample.longitude) for
+                        sample in track.get_samples()])
+            for name, value in summarize_bounds(coords).items():
+                setattr(self, name, value)
+
+
+# Loader options for each way the UI views activities, so a view's query
+# loads everything it displays in a fixed number of queries however many
+# activities it returns, rather than lazily a row at a time. See
+# query_activities:
+ACTIVITY_VIEWS = {
+    # Everything needed to draw an activity on a map, its laps and every
+    # track's samples however they're stored:
+    "map": [joinedload(Activity.sport),
+        subqueryload_all("laps.tracks.trackpoints"),
+        subqueryload_all("laps.tracks.packed")],
+}
+
+
+def query_activities(session, view):
+    """
+    Return a query for activities that loads what the given view, one of
+    ACTIVITY_VIEWS, needs up front.
+    """
+    if view not in ACTIVITY_VIEWS:
+        raise Exception("Unknown activity view: %s" % view)
+    return session.query(Activity).options(*ACTIVITY_VIEWS[view])
+
+
+# A read only summary of an activity, as returned by list_activities:
+ActivityRow = namedtuple("ActivityRow", ["id", "start_time", "sport_id",
+    "sport_name", "distance", "duration", "heart_rate_avg"])
+
+ORDER_NEWEST_FIRST = "newest"
+ORDER_OLDEST_FIRST = "oldest"
+
+
+def list_activities(session, sport=None, offset=None, limit=None,
+        order=ORDER_NEWEST_FIRST, activity_ids=None):
+    """
+    Return ActivityRows for activities of the given Sport, or all sports,
+    in start time order, newest first unless order is ORDER_OLDEST_FIRST.
+    Only the activities with the given ids are returned if any are given.
+    offset and limit select a page of the results.
+
+    Reads plain tuples of the activity summary columns in a single query,
+    without creating ORM objects, for the activity list. Use
+    query_activities for anything that needs the activities themselves.
+    """
+    activity = Activity.__table__
+    sport_table = Sport.__table__
+    q = select([activity.c.id, activity.c.start_time, activity.c.sport_id,
+        sport_table.c.name, activity.c.distance, activity.c.duration,
+        activity.c.heart_rate_avg],
+        from_obj=[activity.join(sport_table)])
+    if sport is not None:
+        q = q.where(activity.c.sport_id == sport.id)
+    if activity_ids is not None:
+        q = q.where(activity.c.id.in_(activity_ids))
+
+    if order == ORDER_NEWEST_FIRST:
+        q = q.order_by(activity.c.start_time.desc())
+    elif order == ORDER_OLDEST_FIRST:
+        q = q.order_by(activity.c.start_time)
+    else:
+        raise Exception("Unknown activity order: %s" % order)
+
+    if offset is not None:
+        q = q.offset(offset)
+    if limit is not None:
+        q = q.limit(limit)
+    return [ActivityRow(*row) for row in session.execute(q).fetchall()]
 
 
 class Constant(Base):
@@ -227,26 +542,244 @@ class Import(Base):
     import_type = Column(Integer)
 
     # Some kind of identifier for what was imported, typically a filename.
-    identifier = Column(String(256))
+    identifier = Column(String(256), index=True)
 
     def __init__(self, import_type, identifier):
         self.import_type = import_type
         self.identifier = identifier
 
 
-def initialize_db():
+class ImportedFile(Base):
     """
-    Open the database, presumably for the first time, and populate the schema.
+    Manifest of files the importer has examined, keyed by full path.
+
+    Size and modification time let a scan skip files that haven't changed
+    without opening them, the content hash identifies the file's data
+    regardless of where it lives.
+    """
+    __tablename__ = "imported_file"
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String(1024), nullable=False, unique=True)
+    size = Column(Integer)
+    mtime = Column(Float)
+    content_hash = Column(String(40), index=True) # SHA-1 hex digest
+    status = Column(Integer, nullable=False)
+
+    def __init__(self, path=None, size=None, mtime=None, content_hash=None,
+            status=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.content_hash = content_hash
+        self.status = status
 
-    Returns the database engine.
+    def __repr__(self):
+        return "ImportedFile<%s - %s>" % (self.path, self.status)
+
+
+class ImportCheckpoint(Base):
+    """
+    An activity already stored from a file whose import hasn't finished,
+    so an interrupted import of a large file can resume where it stopped.
+    Removed once the whole file has been imported.
     """
+    __tablename__ = "import_checkpoint"
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String(1024), nullable=False, index=True)
+    start_time = Column(DateTime(timezone=True), nullable=False)
+
+    def __init__(self, path=None, start_time=None):
+        self.path = path
+        self.start_time = start_time
+
+    def __repr__(self):
+        return "ImportCheckpoint<%s - %s>" % (self.path, self.start_time)
+
+
+# Lap columns the activity summary is calculated from:
+LAP_SUMMARY_COLUMNS = ["distance", "duration", "heart_rate_avg",
+        "speed_max", "calories"]
+
+# Activity columns summarizing its laps and trackpoints:
+ACTIVITY_SUMMARY_COLUMNS = LAP_SUMMARY_COLUMNS + ["min_latitude",
+        "max_latitude", "min_longitude", "max_longitude"]
+
+
+def _sum(values):
+    """ Sum the given values skipping None, None if there are none. """
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return sum(values[1:], values[0])
+
+
+def summarize_laps(laps):
+    """
+    Return a dict of the activity summary columns calculated from the given
+    laps, each a dict with (at least) LAP_SUMMARY_COLUMNS keys.
+
+    The average heart rate is weighted by lap duration, and None unless
+    every lap has one.
+    """
+    duration = _sum([lap['duration'] for lap in laps])
+    heart_rate_avg = None
+    if laps and duration and None not in \
+            [lap['heart_rate_avg'] for lap in laps]:
+        beats = _sum([lap['heart_rate_avg'] * lap['duration'] for lap in
+            laps])
+        heart_rate_avg = int(beats / duration)
+    speed_max = [lap['speed_max'] for lap in laps
+            if lap['speed_max'] is not None]
+    return {
+        'distance': _sum([lap['distance'] for lap in laps]),
+        'duration': duration,
+        'heart_rate_avg': heart_rate_avg,
+        'speed_max': speed_max and max(speed_max) or None,
+        'calories': _sum([lap['calories'] for lap in laps]),
+    }
+
+
+def summarize_bounds(coords):
+    """
+    Return a dict of the activity bounding box columns for the given
+    (latitude, longitude) pairs, ignoring any without a position.
+    """
+    coords = [(latitude, longitude) for (latitude, longitude) in coords
+            if latitude is not None and longitude is not None]
+    if not coords:
+        return {
+            'min_latitude': None,
+            'max_latitude': None,
+            'min_longitude': None,
+            'max_longitude': None,
+        }
+    latitudes = [latitude for (latitude, longitude) in coords]
+    longitudes = [longitude for (latitude, longitude) in coords]
+    return {
+        'min_latitude': min(latitudes),
+        'max_latitude': max(latitudes),
+        'min_longitude': min(longitudes),
+        'max_longitude': max(longitudes),
+    }
+
+
+def _update_summaries(session, flush_context, instances):
+    """
+    Recalculate the summary of any activity whose laps are being added,
+    changed or removed in this flush. The bounding box is only found for
+    new activities, as nothing edits trackpoints once they're stored.
+    """
+    activities = set()
+    for obj in session.new:
+        if isinstance(obj, Activity):
+            activities.add(obj)
+    for obj in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        if isinstance(obj, Lap) and obj.activity is not None:
+            activities.add(obj.activity)
+        elif isinstance(obj, Activity) and obj not in session.deleted and \
+                get_history(obj, 'laps').has_changes():
+            activities.add(obj)
+
+    for activity in activities:
+        if activity in session.deleted:
+            continue
+        laps = [lap for lap in activity.laps if lap not in session.deleted]
+        activity.update_summary(laps, activity in session.new)
+
+event.listen(Session, "before_flush", _update_summaries)
+
+
+def _insert_row(session, table, row):
+    """ Insert a single row into the given table, returning its id. """
+    return session.execute(table.insert(), row).inserted_primary_key[0]
+
+
+def bulk_insert_activities(session, activities, packed=False):
+    """
+    Insert the given activities, along with their laps, tracks and
+    trackpoints, using batched executemany inserts rather than the ORM.
+
+    Creating an ORM object per trackpoint and letting the session flush
+    them one at a time dominates import time for long activities, so the
+    importer writes through here and the mapped classes are only used to
+    read data back.
+
+    Activities are dicts with start_time, sport_id and laps. Laps are dicts
+    of Lap column values plus tracks, a list of lists of trackpoint dicts
+    keyed by TrackPoint column names. The given dicts are not modified.
+    Each activity's summary columns are calculated from its laps.
+
+    Activities, laps and tracks are inserted a row at a time so SQLite
+    assigns their ids, another process may be importing at the same time.
+    Trackpoints, the bulk of the data, are inserted in one batch.
+
+    If packed is True each track's trackpoints are stored as a PackedTrack
+    rather than trackpoint rows.
+
+    Returns the ids of the inserted activities.
+    """
+    activity_table = Activity.__table__
+    lap_table = Lap.__table__
+    track_table = Track.__table__
+    trackpoint_table = TrackPoint.__table__
+    packed_table = PackedTrack.__table__
+
+    activity_ids = []
+    trackpoint_rows = []
+    packed_rows = []
+    for activity in activities:
+        activity_row = {
+            'start_time': activity['start_time'],
+            'sport_id': activity['sport_id'],
+        }
+        activity_row.update(summarize_laps(activity['laps']))
+        activity_row.update(summarize_bounds([(trackpoint['latitude'],
+            trackpoint['longitude']) for lap in activity['laps'] for
+            trackpoints in lap['tracks'] for trackpoint in trackpoints]))
+        activity_id = _insert_row(session, activity_table, activity_row)
+        activity_ids.append(activity_id)
+        for lap in activity['laps']:
+            lap_row = dict(lap, activity_id=activity_id)
+            del lap_row['tracks']
+            lap_id = _insert_row(session, lap_table, lap_row)
+            for trackpoints in lap['tracks']:
+                track_id = _insert_row(session, track_table,
+                        {'lap_id': lap_id})
+                if packed:
+                    start_time, data = pack_samples(trackpoints)
+                    packed_rows.append({
+                        'track_id': track_id,
+                        'start_time': start_time,
+                        'count': len(trackpoints),
+                        'data': data,
+                    })
+                else:
+                    for trackpoint in trackpoints:
+                        trackpoint_rows.append(dict(trackpoint,
+                            track_id=track_id))
+
+    for table, rows in ((trackpoint_table, trackpoint_rows),
+            (packed_table, packed_rows)):
+        if rows:
+            session.execute(table.insert(), rows)
+    return activity_ids
+
+
+def initialize_db(db=None):
+    """
+    Open the database, presumably for the first time, and populate the schema.
+    Uses the given engine if any, otherwise the default database.
+    """
+    if db is None:
+        db = DB
     log.info("Creating the granola database.")
 
-    metadata = Base.metadata
-    metadata.bind = DB
-    metadata.create_all()
+    Base.metadata.create_all(bind=db)
 
-    session = Session()
+    session = Session(bind=db)
 
     # Populate the schema:
     session.add_all([
@@ -256,6 +789,258 @@ def initialize_db():
         Sport(SPORTNAME_OTHER),
     ])
     session.add_all([
-        Constant("schema_version", VERSION),
+        Constant("schema_version", str(SCHEMA_VERSION)),
     ])
     session.commit()
+
+
+def _add_columns(conn, table, names):
+    """
+    Add the given columns of the given table, as defined in the model, to
+    the database unless they're already there. Returns the names of the
+    columns added.
+    """
+    existing = set([row[1] for row in conn.execute(
+        "PRAGMA table_info(%s)" % table.name)])
+    added = []
+    for name in names:
+        if name in existing:
+            continue
+        column = table.columns[name]
+        log.info("Adding column: %s.%s" % (table.name, name))
+        conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table.name, name,
+            column.type.compile(dialect=conn.dialect)))
+        added.append(name)
+    return added
+
+
+def _create_indexes(conn, progress, names):
+    """
+    Create the named indexes as the model defines them, skipping any the
+    database already has.
+    """
+    existing = set([row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'")])
+    indexes = dict([(index.name, index) for table in
+        Base.metadata.sorted_tables for index in table.indexes])
+    missing = [indexes[name] for name in names if name not in existing]
+    for i, index in enumerate(missing):
+        progress(i, len(missing))
+        log.info("Creating index: %s" % index.name)
+        index.create(bind=conn)
+    progress(len(missing), len(missing))
+
+
+# Fills in the activity summary columns of a range of activities from their
+# laps and trackpoints, rather than loading each activity:
+BACKFILL_SUMMARY_SQL = """
+UPDATE activity SET
+    distance = (SELECT SUM(distance) FROM lap
+        WHERE lap.activity_id = activity.id),
+    duration = (SELECT SUM(duration) FROM lap
+        WHERE lap.activity_id = activity.id),
+    heart_rate_avg = (SELECT CASE
+            WHEN COUNT(*) = 0 OR COUNT(heart_rate_avg) < COUNT(*)
+                OR SUM(duration) = 0 THEN NULL
+            ELSE CAST(SUM(heart_rate_avg * duration) / SUM(duration)
+                AS INTEGER) END
+        FROM lap WHERE lap.activity_id = activity.id),
+    speed_max = (SELECT MAX(speed_max) FROM lap
+        WHERE lap.activity_id = activity.id),
+    calories = (SELECT SUM(calories) FROM lap
+        WHERE lap.activity_id = activity.id),
+    min_latitude = (SELECT MIN(trackpoint.latitude) %(trackpoints)s),
+    max_latitude = (SELECT MAX(trackpoint.latitude) %(trackpoints)s),
+    min_longitude = (SELECT MIN(trackpoint.longitude) %(trackpoints)s),
+    max_longitude = (SELECT MAX(trackpoint.longitude) %(trackpoints)s)
+WHERE activity.id >= :first_id AND activity.id < :last_id
+""" % {'trackpoints': """FROM trackpoint
+        JOIN track ON trackpoint.track_id = track.id
+        JOIN lap ON track.lap_id = lap.id
+        WHERE lap.activity_id = activity.id
+            AND trackpoint.longitude IS NOT NULL"""}
+
+# Number of activities backfilled per statement:
+BACKFILL_BATCH_SIZE = 200
+
+
+def _no_progress(done, total):
+    pass
+
+
+def backfill_activity_summaries(bind, progress=_no_progress,
+        batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Calculate the summary columns of every activity already in the
+    database, as when the columns have just been added, batch_size
+    activities at a time. bind is an engine, or a connection to run in
+    its current transaction. progress is called with (done, total)
+    activities after each batch.
+    """
+    session = Session(bind=bind)
+    try:
+        (min_id, max_id, total) = session.execute(
+                "SELECT MIN(id), MAX(id), COUNT(*) FROM activity").fetchone()
+        if total == 0:
+            progress(0, 0)
+            return
+
+        for first_id in range(min_id, max_id + 1, batch_size):
+            last_id = first_id + batch_size
+            session.execute(BACKFILL_SUMMARY_SQL, {'first_id': first_id,
+                'last_id': last_id})
+
+            # Packed tracks can only be read in Python:
+            packed_ids = session.query(Lap.activity_id).join(Track).join(
+                    PackedTrack)
+            packed_ids = packed_ids.filter(Lap.activity_id >= first_id)
+            packed_ids = packed_ids.filter(Lap.activity_id < last_id)
+            q = session.query(Activity).filter(Activity.id.in_(packed_ids))
+            for activity in q:
+                activity.update_summary()
+            session.flush()
+
+            done = session.execute("SELECT COUNT(*) FROM activity "
+                    "WHERE id < :last_id", {'last_id': last_id}).scalar()
+            progress(done, total)
+        session.commit()
+    finally:
+        session.close()
+
+
+def _create_import_tables(conn, progress):
+    Base.metadata.create_all(bind=conn, tables=[ImportedFile.__table__,
+        ImportCheckpoint.__table__, PackedTrack.__table__])
+
+
+def _add_activity_summaries(conn, progress):
+    if _add_columns(conn, Activity.__table__, ACTIVITY_SUMMARY_COLUMNS):
+        backfill_activity_summaries(conn, progress)
+
+
+def _index_imports(conn, progress):
+    _create_indexes(conn, progress, ["ix_import_identifier",
+        "ix_imported_file_content_hash", "ix_import_checkpoint_path"])
+
+
+def _index_activity_data(conn, progress):
+    _create_indexes(conn, progress, ["ix_lap_activity_id_start_time",
+        "ix_track_lap_id", "ix_trackpoint_track_id",
+        "ix_activity_sport_id_start_time"])
+
+
+def _rebuild_table(conn, table):
+    """
+    Recreate the given table as the model now defines it, copying its rows
+    over. SQLite can't change a column's type in place.
+    """
+    log.info("Rebuilding table: %s" % table.name)
+    new_name = "%s_new" % table.name
+    # Indexes keep their names, drop them so they can be recreated:
+    for index in table.indexes:
+        conn.execute("DROP INDEX IF EXISTS %s" % index.name)
+    ddl = unicode(CreateTable(table).compile(dialect=conn.dialect))
+    conn.execute(ddl.replace("CREATE TABLE %s " % table.name,
+        "CREATE TABLE %s " % new_name, 1))
+
+    columns = ", ".join([column.name for column in table.columns])
+    conn.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (new_name,
+        columns, columns, table.name))
+    conn.execute("DROP TABLE %s" % table.name)
+    conn.execute("ALTER TABLE %s RENAME TO %s" % (new_name, table.name))
+    for index in table.indexes:
+        index.create(bind=conn)
+
+
+def _store_floats(conn, progress):
+    # Columns declared NUMERIC store whole numbers as integers, which would
+    # come back as ints rather than floats. Rebuild the tables so their
+    # columns are REAL:
+    tables = [TrackPoint.__table__, Lap.__table__, Activity.__table__]
+    for i, table in enumerate(tables):
+        progress(i, len(tables))
+        _rebuild_table(conn, table)
+    progress(len(tables), len(tables))
+
+
+# Ordered changes to bring an existing database up to date, each a
+# description and a function called with a connection in a transaction and
+# a progress callback taking (done, total). A database's schema_version
+# constant is the number of these applied to it. Append new migrations to
+# the end, never reorder or remove them:
+MIGRATIONS = [
+    ("Create import manifest tables", _create_import_tables),
+    ("Add activity summary columns", _add_activity_summaries),
+    ("Index import manifest tables", _index_imports),
+    ("Index laps, tracks, trackpoints and activities by sport",
+        _index_activity_data),
+    ("Store numbers as floating point", _store_floats),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(bind):
+    """
+    Return the number of migrations applied to the database. Databases
+    from before there were migrations stored the application version, and
+    are at schema version 0.
+    """
+    value = bind.execute("SELECT value FROM constant "
+            "WHERE name = 'schema_version'").scalar()
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _set_schema_version(conn, version):
+    if conn.execute("UPDATE constant SET value = ? "
+            "WHERE name = 'schema_version'", str(version)).rowcount == 0:
+        conn.execute("INSERT INTO constant (name, value) "
+                "VALUES ('schema_version', ?)", str(version))
+
+
+def _log_progress(description, done, total):
+    log.info("%s: %s of %s" % (description, done, total))
+
+
+def upgrade_db(db=None, progress=_log_progress):
+    """
+    Bring an existing database, by default ours, up to date by applying
+    any migrations it hasn't had yet. Each runs in its own transaction
+    along with recording the new schema version, so an interrupted upgrade
+    picks up where it stopped. Safe to call on every startup.
+
+    progress is called with (description, done, total) as each migration
+    goes along.
+    """
+    if db is None:
+        db = DB
+
+    conn = db.connect()
+    try:
+        version = get_schema_version(conn)
+        if version > SCHEMA_VERSION:
+            raise Exception("Database schema version %s is newer than this "
+                    "version of granola supports (%s)." % (version,
+                        SCHEMA_VERSION))
+
+        for version in range(version, SCHEMA_VERSION):
+            (description, migrate) = MIGRATIONS[version]
+            log.info("Upgrading database to schema version %s: %s" %
+                    (version + 1, description))
+
+            def migration_progress(done, total):
+                progress(description, done, total)
+
+            trans = conn.begin()
+            try:
+                migrate(conn, migration_progress)
+                _set_schema_version(conn, version + 1)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+    finally:
+        conn.close()
@@ -0,0 +1,146 @@
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+"""
+Packed storage for a track's samples.
+
+Rather than a trackpoint row per sample, a packed track stores each column
+(time, latitude, longitude, ...) as an array of integers, scaled to the
+precision the trackpoint table keeps. Each value is stored as the
+difference from the previous one, and the whole thing is zlib compressed.
+Neighbouring GPS samples differ very little so this packs down to a few
+bytes per sample.
+"""
+
+import sys
+import zlib
+import array
+import struct
+
+from datetime import timedelta
+from collections import namedtuple
+
+from granola.util import total_seconds
+
+# Columns of a packed track, and the factor each is multiplied by to store
+# it as an integer. Times are stored in milliseconds after the track's
+# start time:
+COLUMNS = [
+    ("time", 1000),
+    ("latitude", 1000000),
+    ("longitude", 1000000),
+    ("altitude", 1000),
+    ("distance", 1000),
+    ("heart_rate", 1),
+]
+
+# A single sample, with the same attributes as a TrackPoint:
+Sample = namedtuple("Sample", [name for (name, scale) in COLUMNS])
+
+FORMAT_VERSION = 1
+
+# Stored in place of missing values:
+MISSING = -2 ** 31
+
+_HEADER = struct.Struct("<BI")
+
+
+def _wrap(value):
+    """ Wrap the given integer into the range of a signed 32 bit int. """
+    return (value + 2 ** 31) % 2 ** 32 - 2 ** 31
+
+
+def _start_time(trackpoints):
+    for trackpoint in trackpoints:
+        if trackpoint['time'] is not None:
+            return trackpoint['time']
+    return None
+
+
+def pack_samples(trackpoints):
+    """
+    Pack the given trackpoint dicts, keyed by TrackPoint column names.
+    Returns (start_time, data), start_time being the time of the first
+    sample that has one, which packed times are relative to.
+    """
+    start_time = _start_time(trackpoints)
+    columns = []
+    for name, scale in COLUMNS:
+        values = array.array("i")
+        previous = 0
+        for trackpoint in trackpoints:
+            value = trackpoint[name]
+            if value is None:
+                value = MISSING
+            elif name == "time":
+                value = int(round(total_seconds(value - start_time) * scale))
+            else:
+                value = int(round(float(value) * scale))
+            values.append(_wrap(value - previous))
+            previous = value
+        if sys.byteorder == "big":
+            values.byteswap()
+        columns.append(values.tostring())
+
+    header = _HEADER.pack(FORMAT_VERSION, len(trackpoints))
+    return start_time, zlib.compress(header + "".join(columns))
+
+
+def unpack_columns(start_time, data):
+    """
+    Unpack the given data, returning a dict of column name to list of
+    values. Times are datetimes relative to start_time, the rest floats,
+    or ints for heart rate. Missing values are None.
+    """
+    data = zlib.decompress(data)
+    version, count = _HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise Exception("Unknown packed track format: %s" % version)
+
+    columns = {}
+    offset = _HEADER.size
+    for name, scale in COLUMNS:
+        values = array.array("i")
+        values.fromstring(data[offset:offset + count * values.itemsize])
+        offset += count * values.itemsize
+        if sys.byteorder == "big":
+            values.byteswap()
+
+        result = []
+        value = 0
+        for delta in values:
+            value = _wrap(value + delta)
+            if value == MISSING:
+                result.append(None)
+            elif name == "time":
+                result.append(start_time + timedelta(milliseconds=value))
+            elif scale == 1:
+                result.append(value)
+            else:
+                result.append(value / float(scale))
+        columns[name] = result
+    return columns
+
+
+def unpack_samples(start_time, data):
+    """ Unpack the given data into a list of Samples. """
+    columns = unpack_columns(start_time, data)
+    return [Sample(*values) for values in zip(*[columns[name] for
+        (name, scale) in COLUMNS])]
@@ -0,0 +1,191 @@
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+"""
+Import sources: the files, compressed files and archive members we can
+import data from.
+
+A source is identified by a string. For plain and compressed files this is
+just the path, for archive members it's the path to the archive and the
+member name joined with ARCHIVE_SEPARATOR, i.e.:
+
+    /home/dev/exports/2009.zip!2009-05-02-123725.tcx
+
+Everything is decompressed as it's read, nothing is extracted to disk.
+"""
+
+import os
+import bz2
+import calendar
+import gzip
+import hashlib
+import zipfile
+import threading
+
+ARCHIVE_SEPARATOR = "!"
+
+# Single file compression formats, by extension:
+COMPRESSED_EXTENSIONS = {
+    ".gz": lambda path: gzip.GzipFile(path, "rb"),
+    ".bz2": lambda path: bz2.BZ2File(path, "r"),
+}
+
+ARCHIVE_EXTENSIONS = [".zip"]
+
+# The archive read most recently, as ((path, size, mtime), ZipFile), see
+# _read_archive:
+_archive = None
+_archive_lock = threading.Lock()
+
+
+def is_archive(path):
+    """ Return True if the given path is an archive we can look inside. """
+    return os.path.splitext(path)[1].lower() in ARCHIVE_EXTENSIONS
+
+
+def uncompressed_name(name):
+    """
+    Return the given file name without any compression extension, i.e.
+    the name of the file it decompresses to.
+    """
+    base, ext = os.path.splitext(name)
+    if ext.lower() in COMPRESSED_EXTENSIONS:
+        return base
+    return name
+
+
+def list_sources(path, matches):
+    """
+    Return (source, stat) for each source found at the given path, the path
+    itself or the members of an archive, with stat as returned by
+    source_stat. Only archive members whose name is accepted by the matches
+    function are returned.
+    """
+    if not is_archive(path):
+        return [(path, source_stat(path))]
+
+    def list_members(archive, stat):
+        return [(path + ARCHIVE_SEPARATOR + info.filename,
+            _member_stat(info)) for info in archive.infolist()
+            if matches(info.filename)]
+    return _read_archive(path, list_members)
+
+
+def _read_archive(path, read):
+    """
+    Return read(archive, stat) for the zip archive at the given path, where
+    stat is the archive's os.stat result.
+
+    The archive read last is kept open, so going through its members one
+    after another, as an import does, reads its directory once rather than
+    once per member. It's opened again if it has changed on disk.
+    """
+    global _archive
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    _archive_lock.acquire()
+    try:
+        if _archive is None or _archive[0] != key:
+            if _archive is not None:
+                _archive[1].close()
+                _archive = None
+            _archive = (key, zipfile.ZipFile(path))
+        return read(_archive[1], stat)
+    finally:
+        _archive_lock.release()
+
+
+def _member_stat(info):
+    """
+    Return (size, mtime) for the archive member with the given ZipInfo.
+    Zip timestamps have no time zone, they're converted as if UTC as
+    they're only compared with each other.
+    """
+    return (info.file_size, float(calendar.timegm(info.date_time + (0, 0,
+        0))))
+
+
+def _split_source(source):
+    """
+    Return (path, member) for the given source, member may be None. The
+    archive path ends at the first separator following an archive
+    extension, so directories may have the separator in their names.
+    """
+    start = 0
+    while True:
+        index = source.find(ARCHIVE_SEPARATOR, start)
+        if index == -1:
+            return source, None
+        if is_archive(source[:index]):
+            return source[:index], source[index + 1:]
+        start = index + 1
+
+
+def open_source(source):
+    """ Return a file object for reading the source's decompressed data. """
+    path, member = _split_source(source)
+    if member is not None:
+        # Opens its own handle on the archive, fine if ours is closed:
+        return _read_archive(path, lambda archive, stat: archive.open(member))
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext in COMPRESSED_EXTENSIONS:
+        return COMPRESSED_EXTENSIONS[ext](path)
+    return open(path, "rb")
+
+
+def source_stat(source):
+    """
+    Return (size, mtime) for the given source, used to tell if it changed.
+
+    Archive members report their uncompressed size and their own
+    modification time, as stored in the archive, so changes to the rest of
+    the archive don't affect them. Raises OSError if the source doesn't
+    exist.
+    """
+    path, member = _split_source(source)
+    if member is None:
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime)
+
+    def member_stat(archive, stat):
+        try:
+            info = archive.getinfo(member)
+        except KeyError:
+            raise OSError("No such archive member: %s" % source)
+        return _member_stat(info)
+    return _read_archive(path, member_stat)
+
+
+def hash_source(source):
+    """
+    Return the SHA-1 hex digest of the source's decompressed contents, so
+    the same data compressed or not hashes the same.
+    """
+    sha = hashlib.sha1()
+    f = open_source(source)
+    try:
+        chunk = f.read(65536)
+        while chunk:
+            sha.update(chunk)
+            chunk = f.read(65536)
+    finally:
+        f.close()
+    return sha.hexdigest()
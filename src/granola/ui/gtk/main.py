@@ -27,10 +27,13 @@ import gobject
 import os
 import sys
 
-from decimal import Decimal
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
 
 from granola.log import log
 from granola.model import *
+from granola.importer import ImportThread
+from granola.watcher import watch_import_folder
 from granola.ui.gtk.browser import *
 from granola import write_config
 from granola.season import *
@@ -66,9 +69,12 @@ class GranolaMainWindow(object):
 
     def __init__(self, config):
         log.debug("Starting GTK UI.")
+        gobject.threads_init()
         gtk.gdk.threads_init()
         self.config = config
-        self.session = Session()
+        # Autocommit so we never sit on an open read transaction, which
+        # would block background imports from committing:
+        self.session = Session(autocommit=True)
 
         glade_file = 'granola/glade/mainwindow.glade'
         self.glade_xml = gtk.Builder()
@@ -93,6 +99,10 @@ class GranolaMainWindow(object):
                 'metrics_sport_combo')
         self.metrics_timeslice_combo = self.glade_xml.get_object(
                 'metrics_timeslice_combo')
+        self.statusbar = self.glade_xml.get_object('statusbar')
+
+        # Watches the import folder for new files, if enabled:
+        self.watcher = None
 
         self.init_ui()
 
@@ -119,10 +129,8 @@ class GranolaMainWindow(object):
         self.glade_xml.connect_signals(signals)
 
 
-        self.running = self.session.query(Sport).filter(
-                Sport.name == RUNNING).one()
-        self.biking = self.session.query(Sport).filter(
-                Sport.name == BIKING).one()
+        self.running = SPORTS.get(self.session, RUNNING)
+        self.biking = SPORTS.get(self.session, BIKING)
 
         self.browser_widget = BrowserWidget()
         self.activity_hbox.pack_start(self.browser_widget)
@@ -136,8 +144,88 @@ class GranolaMainWindow(object):
         """ Launch the GTK main loop. """
         gtk.main()
 
+    def import_in_background(self, importer, directory, watch=False):
+        """
+        Scan the given directory for new data with a background thread,
+        adding activities to the list as they're imported. If watch is True
+        the directory is watched for new files once the scan is done.
+        """
+        then = None
+        if watch:
+            then = lambda: self.watch_import_folder(importer, directory)
+        progress, finished = self._import_callbacks(then)
+
+        self.set_status("Scanning %s for new data..." % directory)
+        thread = ImportThread(importer, directory, progress, finished)
+        thread.start()
+
+    def watch_import_folder(self, importer, directory):
+        """
+        Import new files as they appear in the given directory, adding
+        activities to the list as they're imported.
+        """
+        progress, finished = self._import_callbacks()
+        try:
+            self.watcher = watch_import_folder(importer, directory, progress,
+                    finished)
+        except Exception, ex:
+            log.error("Unable to watch %s: %s" % (directory, ex))
+
+    def _import_callbacks(self, then=None):
+        """
+        Return progress and finished callbacks for a background import,
+        handing each off to the main loop. Then, if given, is called in the
+        main loop once the import has finished.
+        """
+        def progress(done, total, activity_ids):
+            gobject.idle_add(self.import_progress_cb, done, total,
+                    activity_ids)
+
+        def finished(report):
+            gobject.idle_add(self.import_finished_cb, report, then)
+
+        return progress, finished
+
+    def import_progress_cb(self, done, total, activity_ids):
+        """
+        Called in the main loop as each batch of a background import is
+        committed.
+        """
+        if total > 0:
+            self.set_status("Importing: %s of %s files" % (done, total))
+        if activity_ids:
+            for row in list_activities(self.session,
+                    activity_ids=activity_ids):
+                self.insert_activity(row)
+        # Don't call again:
+        return False
+
+    def import_finished_cb(self, report, then=None):
+        """ Called in the main loop when a background import finishes. """
+        if report is None:
+            self.set_status("Import failed, see log for details.")
+        elif report.failures:
+            self.set_status("Imported %s files, %s failed." %
+                    (len(report.imported), len(report.failures)))
+        else:
+            self.set_status("Imported %s files." % len(report.imported))
+
+        if report is not None and report.imported:
+            self.populate_metrics()
+        if then is not None:
+            then()
+        return False
+
+    def set_status(self, text):
+        """ Display the given text in the status bar. """
+        context_id = self.statusbar.get_context_id("granola")
+        self.statusbar.pop(context_id)
+        self.statusbar.push(context_id, text)
+
     def shutdown(self, widget):
         """ Closes the application. """
+        if self.watcher is not None:
+            self.watcher.stop()
         gtk.main_quit()
 
     def init_ui(self):
@@ -274,18 +362,17 @@ class GranolaMainWindow(object):
         self.metrics_sport_combo.add_attribute(cell, 'text', 0)
         #self.metrics_sport_combo.append_text("all")
 
-        q = self.session.query(Sport).order_by(Sport.name)
-        sports = q.all()
-        for sport in sports:
-            self.sport_filter_combobox.append_text(sport.name)
-            self.metrics_sport_combo.append_text(sport.name)
+        names = SPORTS.names(self.session)
+        for name in names:
+            self.sport_filter_combobox.append_text(name)
+            self.metrics_sport_combo.append_text(name)
 
         # Activate the first item for All:
         iter = sports_liststore.get_iter_first()
         self.sport_filter_combobox.set_active_iter(iter)
         iter = sports_liststore2.get_iter_first()
         self.metrics_sport_combo.set_active_iter(iter)
-        self.metrics_sport = sports[0]
+        self.metrics_sport = SPORTS.get(self.session, names[0])
 
     def populate_activities(self):
         """ 
@@ -333,7 +420,8 @@ class GranolaMainWindow(object):
     def get_selected_activity(self):
         """
         Return an activity object for the currently selected row on the 
-        Activities tab.
+        Activities tab, with everything needed to display its details and
+        map loaded.
 
         We auto-select the first row, so it's reasonable to assume there
         always will be a value to return here.
@@ -342,8 +430,8 @@ class GranolaMainWindow(object):
         (model, iter) = tree_selection.get_selected()
 
         activity_id = model.get_value(iter, 0)
-        activity = self.session.query(Activity).filter(Activity.id ==
-                activity_id).one()
+        activity = query_activities(self.session, "map").filter(
+                Activity.id == activity_id).one()
         return activity
 
     def build_activity_liststore(self):
@@ -360,27 +448,50 @@ class GranolaMainWindow(object):
                 str, # pace
                 str, # avg heart rate
         )
-        q = self.session.query(Activity).order_by(Activity.start_time.desc())
-        if self.filter_sport is not None:
-            q = q.filter(Activity.sport == self.filter_sport)
-        #q = self.session.query(Activity).filter(Activity.sport ==
-        #        sport).order_by(Activity.start_time.desc())
-        for run in q.all():
-            duration_seconds = run.duration
-
-            list_store.append([
-                run.id,
-                run.start_time.strftime("%Y-%m-%d %H:%M"),
-                "%.2f" % (run.distance / 1000),
-                format_time_str(duration_seconds),
-                "%.2f" % (calculate_speed(self.session, run.distance, duration_seconds)),
-                run.sport.name,
-                "%.2f" % (calculate_pace(self.session, run.distance, duration_seconds) / 60),
-                run.heart_rate_avg,
-            ])
+        for run in list_activities(self.session, self.filter_sport):
+            list_store.append(self.build_activity_row(run))
 
         return list_store
 
+    def build_activity_row(self, run):
+        """ Return the activity list columns for the given ActivityRow. """
+        duration_seconds = run.duration
+        return [
+            run.id,
+            run.start_time.strftime("%Y-%m-%d %H:%M"),
+            "%.2f" % (run.distance / 1000),
+            format_time_str(duration_seconds),
+            "%.2f" % (calculate_speed(self.session, run.distance, duration_seconds)),
+            run.sport_name,
+            "%.2f" % (calculate_pace(self.session, run.distance, duration_seconds) / 60),
+            run.heart_rate_avg,
+        ]
+
+    def insert_activity(self, activity):
+        """
+        Add the ActivityRow of a newly imported activity to the activity
+        list, keeping it sorted newest first. Selects it if nothing was
+        selected yet.
+        """
+        if self.filter_sport is not None and \
+                activity.sport_id != self.filter_sport.id:
+            return
+
+        row = self.build_activity_row(activity)
+        model = self.activity_tv.get_model()
+        # Find the first (newer first) row that's older than this one:
+        position = 0
+        iter = model.get_iter_first()
+        while iter is not None and model.get_value(iter, 1) > row[1]:
+            position += 1
+            iter = model.iter_next(iter)
+        iter = model.insert(position, row)
+
+        tree_selection = self.activity_tv.get_selection()
+        if tree_selection.get_selected()[1] is None:
+            tree_selection.select_iter(iter)
+            self.display_activity(self.get_selected_activity())
+
     def populate_metrics(self):
         """ 
         Populate metrics. 
@@ -455,20 +566,20 @@ class GranolaMainWindow(object):
         timeslice, and add the appropriate column values to the provided list 
         store.
         """
-        q = self.session.query(Activity)
+        # Totalled by the database from the activity summary columns,
+        # rather than loading each activity and its laps:
+        q = self.session.query(func.count(Activity.id),
+                func.sum(Activity.distance), func.sum(Activity.duration))
         q = q.filter(Activity.start_time >= sl.start_date)
         q = q.filter(Activity.start_time <= sl.end_date)
         q = q.filter(Activity.sport == self.metrics_sport)
-        activities = q.all()
-        log.debug("Found %s activities for slice: %s" % (len(activities), sl.season.name))
+        (count, total_distance, total_duration) = q.one()
+        log.debug("Found %s activities for slice: %s" % (count, sl.season.name))
 
-        total_distance = Decimal("0")
-        total_duration = Decimal("0")
-
-        for acti in activities:
-            log.debug("   %s - %s" % (acti.start_time, acti.sport.name))
-            total_distance += acti.distance
-            total_duration += acti.duration
+        if total_distance is None:
+            total_distance = 0.0
+        if total_duration is None:
+            total_duration = 0.0
 
         speed = calculate_speed(self.session, total_distance, total_duration)
         pace = calculate_pace(self.session, total_distance, total_duration)
@@ -532,12 +643,8 @@ class GranolaMainWindow(object):
                 # path[0] appears to be the row here:
                 treeview.grab_focus()
                 treeview.set_cursor(path, col, 0)
-                selection = self.activity_tv.get_selection()
-                (model, iter) = selection.get_selected()
                 # Lookup the activity object rather than rely on model columns:
-                activity = self.session.query(Activity).filter(Activity.id ==
-                        model.get_value(iter, 0)).one()
-                self.display_activity(activity)
+                self.display_activity(self.get_selected_activity())
 
             # Now handle only right clicks:
             if event.button == 3:
@@ -560,18 +667,16 @@ class GranolaMainWindow(object):
                 str, # avg hr
                 str, # max hr
         )
-        q = self.session.query(Lap)
-        q = q.filter(Lap.activity == activity)
-        q = q.order_by(Lap.start_time)
         i = 1
-        for lap in q.all():
+        for lap in activity.laps:
             duration_seconds = lap.duration
 
             lap_liststore.append([
                 i,
                 "%.2f" % (lap.distance / 1000),
                 format_time_str(duration_seconds),
-                "%.2f" % ((lap.distance / 1000) / (duration_seconds / 3600)),
+                "%.2f" % (calculate_speed(self.session, lap.distance,
+                    duration_seconds)),
                 lap.heart_rate_avg,
                 lap.heart_rate_max,
             ])
@@ -583,11 +688,8 @@ class GranolaMainWindow(object):
         """
         Open details window to display map for this activity.
         """
-        selection = self.activity_tv.get_selection()
-        (model, iter) = selection.get_selected()
         # Lookup the activity object rather than rely on model columns:
-        activity = self.session.query(Activity).filter(Activity.id ==
-                model.get_value(iter, 0)).one()
+        activity = self.get_selected_activity()
 
         activity_details_window = BrowserWindow(activity)
         activity_details_window.show_all()
@@ -606,8 +708,18 @@ class GranolaMainWindow(object):
         if result == gtk.RESPONSE_ACCEPT:
             activity = self.get_selected_activity()
             log.debug("Deleting! %s" % activity)
+            self.session.begin()
             self.session.delete(activity)
-            self.session.commit()
+            try:
+                self.session.commit()
+            except OperationalError, ex:
+                # Most likely a background import holding the database for
+                # longer than the busy timeout:
+                log.error("Unable to delete %s: %s" % (activity, ex))
+                self.session.rollback()
+                self.set_status("Could not delete the activity while an "
+                        "import is running, please try again.")
+                return
 
             # TODO: More expensive than it needs to be, could just delete row from
             # model?
@@ -634,8 +746,7 @@ class GranolaMainWindow(object):
         if filter_name == FILTER_ALL:
             self.filter_sport = None
         else:
-            self.filter_sport = self.session.query(Sport).filter(
-                    Sport.name == filter_name).one()
+            self.filter_sport = SPORTS.get(self.session, filter_name)
 
         self.populate_activities()
 
@@ -648,8 +759,7 @@ class GranolaMainWindow(object):
         if filter_name == FILTER_ALL:
             self.metrics_sport = None
         else:
-            self.metrics_sport = self.session.query(Sport).filter(
-                    Sport.name == filter_name).one()
+            self.metrics_sport = SPORTS.get(self.session, filter_name)
 
         self.populate_metrics()
 
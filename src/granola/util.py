@@ -20,37 +20,100 @@
 
 """ Various utility functions. """
 
+import re
+import math
+import dateutil.parser
+
+from datetime import datetime
 from decimal import Decimal
+from dateutil.tz import tzutc, tzoffset
+
+# Shared tzinfo objects for parsed timestamps, rather than one per call:
+UTC = tzutc()
+_TZ_OFFSETS = {}
+
+# Mean radius of the earth, in meters:
+EARTH_RADIUS = 6371000.0
+
+# The fixed format Garmin devices write, i.e. 2009-05-02T12:37:25Z, with
+# optional fractional seconds and numeric offset:
+TIMESTAMP_RE = re.compile(r"^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)"
+        r"(?:\.(\d+))?(?:(Z)|([+-])(\d\d):?(\d\d))$")
+
+
+def parse_timestamp(text):
+    """
+    Parse an ISO 8601 timestamp into a timezone aware datetime.
+
+    Handles the fixed format found in TCX/GPX files directly, which is
+    many times faster than dateutil's generic parser and matters when
+    called for every trackpoint. Anything else falls back to dateutil.
+    """
+    match = TIMESTAMP_RE.match(text)
+    if match is None:
+        return dateutil.parser.parse(text)
+
+    (year, month, day, hour, minute, second, fraction, zulu, sign,
+            offset_hours, offset_minutes) = match.groups()
+
+    microsecond = 0
+    if fraction:
+        microsecond = int(fraction[:6].ljust(6, "0"))
+
+    if zulu:
+        tz = UTC
+    else:
+        offset = int(offset_hours) * 3600 + int(offset_minutes) * 60
+        if sign == "-":
+            offset = -offset
+        tz = _TZ_OFFSETS.get(offset)
+        if tz is None:
+            tz = _TZ_OFFSETS.setdefault(offset, tzoffset(None, offset))
+
+    return datetime(int(year), int(month), int(day), int(hour), int(minute),
+            int(second), microsecond, tz)
+
 
 def calculate_speed(session, meters, seconds):
     """
     Calculate speed in km/h or mph depending on user preference.
-    Returns a Decimal, and expects meters and seconds to be Decimal 
-    as well.
+    Returns a float for float (or int) meters and seconds, as stored in the
+    database, or a mix of those and Decimal. If both are Decimal the
+    calculation is done, and returned, in Decimal instead.
 
     Session passed in here, currently unused as we don't yet have 
     configurable units, but when we do they'll be in the db.
     """
-    speed = Decimal('0.0')
-    # Watch for division by 0: 
-    if seconds > 0 and meters > 0: 
-        speed = (meters / 1000) / (seconds / 3600)
-    return speed
+    if isinstance(meters, Decimal) and isinstance(seconds, Decimal):
+        speed = Decimal('0.0')
+        # Watch for division by 0: 
+        if seconds > 0 and meters > 0: 
+            speed = (meters / 1000) / (seconds / 3600)
+        return speed
+
+    if seconds > 0 and meters > 0:
+        return (float(meters) * 3.6) / float(seconds)
+    return 0.0
 
 def calculate_pace(session, meters, seconds):
     """
     Calculate pace in seconds per km or mile, depending on user preference.
-    Returns a Decimal, and expects meters and seconds to be Decimal 
-    as well.
+    Returns a float for float (or int) meters and seconds, or a mix of
+    those and Decimal, or a Decimal if both are Decimal.
 
     Session passed in here, currently unused as we don't yet have 
     configurable units, but when we do they'll be in the db.
     """
-    pace = Decimal('0.0')
-    # Watch for division by 0: 
-    if seconds > 0 and meters > 0: 
-        pace = (seconds * 1000) / meters
-    return pace
+    if isinstance(meters, Decimal) and isinstance(seconds, Decimal):
+        pace = Decimal('0.0')
+        # Watch for division by 0: 
+        if seconds > 0 and meters > 0: 
+            pace = (seconds * 1000) / meters
+        return pace
+
+    if seconds > 0 and meters > 0:
+        return (float(seconds) * 1000.0) / float(meters)
+    return 0.0
 
 def format_time_str(seconds):
     """
@@ -61,6 +124,21 @@ def format_time_str(seconds):
     seconds = seconds % 60
 
     return "%02i:%02i:%02i" % (hours, minutes, seconds)
-        
 
 
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """
+    Return the distance in meters between two points given in degrees,
+    using the haversine formula. Floats in, float out, as this is called
+    for every trackpoint of formats that don't record distance.
+    """
+    lat1 = math.radians(lat1)
+    lat2 = math.radians(lat2)
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * \
+            math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def total_seconds(delta):
+    """ Return the given timedelta as a number of seconds. """
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
@@ -0,0 +1,228 @@
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+"""
+Watch the import folder for new files.
+
+Uses inotify on Linux when pyinotify is installed, otherwise falls back to
+periodically polling the folder.
+"""
+
+import os
+import time
+import threading
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from granola.log import log
+
+
+class Watcher(threading.Thread):
+    """
+    Parent watcher class, runs in its own thread.
+
+    Subclasses report paths that were created or changed, which we hold
+    on to until they've stopped changing for settle_time seconds, so files
+    still being written by a sync tool aren't picked up half finished.
+    Settled files are then passed to callback as a sorted list.
+
+    Only files accepted by the matches function, given a file name, are
+    considered.
+    """
+
+    def __init__(self, directory, callback, matches, settle_time=2.0,
+            poll_interval=1.0):
+        threading.Thread.__init__(self, name="granola-watcher")
+        self.setDaemon(True)
+        self.directory = directory
+        self.callback = callback
+        self.matches = matches
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+
+        # Path to ((size, mtime), time that changed) for files we're
+        # waiting on:
+        self.pending = {}
+        self._stopped = threading.Event()
+
+    def run(self):
+        log.info("Watching %s for new files." % self.directory)
+        self._start_watching()
+        while not self._stopped.isSet():
+            for path in self._wait_for_changes(self.poll_interval):
+                if self.matches(os.path.basename(path)):
+                    self.pending.setdefault(path, (None, time.time()))
+
+            ready = self._settled_files()
+            if ready:
+                log.debug("New files ready for import: %s" % ready)
+                try:
+                    self.callback(ready)
+                except Exception, ex:
+                    log.exception("Error importing new files: %s" % ex)
+        self._stop_watching()
+
+    def stop(self):
+        """ Stop watching, the thread exits shortly after. """
+        self._stopped.set()
+
+    def _settled_files(self):
+        """
+        Return pending files that haven't changed for settle_time seconds,
+        and forget about them.
+        """
+        now = time.time()
+        ready = []
+        for path, (last_stat, changed) in self.pending.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed or moved away before we got to it:
+                del self.pending[path]
+                continue
+
+            current = (stat.st_size, stat.st_mtime)
+            if current != last_stat:
+                self.pending[path] = (current, now)
+            elif now - changed >= self.settle_time:
+                ready.append(path)
+                del self.pending[path]
+        ready.sort()
+        return ready
+
+    def _start_watching(self):
+        """ Called in the watcher thread before waiting for changes. """
+        pass
+
+    def _stop_watching(self):
+        """ Called in the watcher thread once we've been stopped. """
+        pass
+
+    def _wait_for_changes(self, timeout):
+        """
+        Wait up to timeout seconds and return a list of paths created or
+        changed in the meantime.
+        """
+        pass
+
+
+class PollingWatcher(Watcher):
+    """
+    Watcher that walks the directory every poll_interval seconds, comparing
+    sizes and modification times with the previous walk.
+    """
+
+    def _start_watching(self):
+        self.snapshot = self._walk()
+
+    def _wait_for_changes(self, timeout):
+        self._stopped.wait(timeout)
+        snapshot = self._walk()
+        changed = [path for path, stat in snapshot.iteritems()
+                if self.snapshot.get(path) != stat]
+        self.snapshot = snapshot
+        return changed
+
+    def _walk(self):
+        """ Return a dict of path to (size, mtime) for matching files. """
+        snapshot = {}
+        for root, dirs, files in os.walk(self.directory):
+            for file in files:
+                if not self.matches(file):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_size, stat.st_mtime)
+        return snapshot
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watcher notified by the kernel of files created, written or moved into
+    the directory, or any directory created under it.
+    """
+
+    def _start_watching(self):
+        self.changed = []
+        watcher = self
+
+        class EventHandler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if not event.dir:
+                    watcher.changed.append(event.pathname)
+
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watch_manager,
+                EventHandler())
+        mask = pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE | \
+                pyinotify.IN_MOVED_TO
+        self.watch_manager.add_watch(self.directory, mask, rec=True,
+                auto_add=True)
+
+    def _stop_watching(self):
+        self.notifier.stop()
+
+    def _wait_for_changes(self, timeout):
+        if self.notifier.check_events(int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        changed = self.changed
+        self.changed = []
+        return changed
+
+
+def create_watcher(directory, callback, matches, **kwargs):
+    """
+    Return a watcher for the given directory, using inotify if available.
+    Remaining keyword arguments are passed to the watcher.
+    """
+    if not os.path.exists(directory):
+        raise Exception("No such directory: %s" % directory)
+    if pyinotify is not None:
+        return InotifyWatcher(directory, callback, matches, **kwargs)
+    log.debug("pyinotify not available, polling for new files.")
+    return PollingWatcher(directory, callback, matches, **kwargs)
+
+
+def watch_import_folder(importer, directory, progress=None, finished=None,
+        **kwargs):
+    """
+    Start watching the given directory, importing new files as they show up
+    with the given importer. Returns the running watcher.
+
+    Progress is called as for Importer.import_files, finished is called
+    with the ImportReport after each set of new files is imported. Both are
+    called from the watcher thread.
+    """
+    def import_new_files(filenames):
+        report = importer.import_files(filenames, progress)
+        if finished is not None:
+            finished(report)
+
+    watcher = create_watcher(directory, import_new_files, importer.accepts,
+            **kwargs)
+    watcher.start()
+    return watcher
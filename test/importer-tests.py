@@ -0,0 +1,973 @@
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+""" Tests for Granola's importer module. """
+
+import bz2
+import gzip
+import os.path
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+from datetime import datetime
+
+
+from granola.model import *
+from granola.importer import *
+from granola.watcher import *
+from granola.sources import *
+from granola.fit import *
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+EXPORTS_DIR = os.path.join(DATA_DIR, "exports")
+RUNNING_TCX = os.path.join(EXPORTS_DIR, "running.tcx")
+HISTORY_TCX = os.path.join(EXPORTS_DIR, "history.tcx")
+TRACK_GPX = os.path.join(DATA_DIR, "track.gpx")
+
+
+class ImporterTestCase(unittest.TestCase):
+    """ Point the model at a fresh temporary database for each test. """
+
+    def setUp(self):
+        (fd, self.db_file) = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.engine = connect_to_db("sqlite:///%s" % self.db_file)
+        Session.configure(bind=self.engine)
+        Base.metadata.create_all(bind=self.engine)
+        self.session = Session()
+        self.session.add_all([
+            Sport(SPORTNAME_RUNNING),
+            Sport(SPORTNAME_BIKING),
+            Sport(SPORTNAME_WALKING),
+            Sport(SPORTNAME_OTHER),
+        ])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        Session.configure(bind=DB)
+        os.remove(self.db_file)
+
+
+class CountingTcxImporter(GarminTcxImporter):
+    """ Remembers which files it actually parsed. """
+
+    def __init__(self, *args, **kwargs):
+        GarminTcxImporter.__init__(self, *args, **kwargs)
+        self.parsed = []
+
+    def parse_file(self, filename):
+        self.parsed.append(filename)
+        return GarminTcxImporter.parse_file(self, filename)
+
+
+class FailingTcxImporter(GarminTcxImporter):
+    """ Fails after writing the running file, to test rolling back. """
+
+    def _store_file(self, session, manifest, filename, activities, timings):
+        activity_ids = GarminTcxImporter._store_file(self, session, manifest,
+                filename, activities, timings)
+        if filename.endswith("running.tcx"):
+            raise Exception("Failed after storing.")
+        return activity_ids
+
+
+class CrashingTcxImporter(GarminTcxImporter):
+    """ Dies after the first activity of each file, as if killed. """
+
+    def iter_activities(self, filename):
+        for activity in GarminTcxImporter.iter_activities(self, filename):
+            yield activity
+            raise KeyboardInterrupt()
+
+
+class GarminTcxImporterTests(ImporterTestCase):
+
+    def test_import_file(self):
+        importer = GarminTcxImporter()
+        importer.import_file(self.session, RUNNING_TCX)
+        self.session.commit()
+
+        activity = self.session.query(Activity).one()
+        self.assertEquals(SPORTNAME_RUNNING, activity.sport.name)
+        self.assertEquals(2, len(activity.laps))
+        self.assertEquals(2100, activity.distance)
+        self.assertEquals(600, activity.duration)
+        self.assertEquals(2, len(activity.laps[0].tracks))
+        self.assertEquals(1, len(activity.laps[1].tracks))
+
+        trackpoints = activity.laps[0].tracks[0].trackpoints
+        self.assertEquals(6, len(trackpoints))
+        self.assertEquals(140, trackpoints[0].heart_rate)
+        self.assertEquals(None, trackpoints[5].latitude)
+        self.assertEquals(17, self.session.query(TrackPoint).count())
+
+        self.assertEquals(1, self.session.query(ImportedFile).count())
+
+    def test_import_file_packed(self):
+        GarminTcxImporter(packed=True).import_file(self.session, RUNNING_TCX)
+        self.session.commit()
+        self.assertEquals(0, self.session.query(TrackPoint).count())
+        self.assertEquals(3, self.session.query(PackedTrack).count())
+
+        activity = self.session.query(Activity).one()
+        samples = activity.laps[0].tracks[0].get_samples()
+        self.assertEquals(6, len(samples))
+        self.assertEquals(140, samples[0].heart_rate)
+        self.assertEquals(None, samples[5].latitude)
+
+        self.tearDown()
+        self.setUp()
+        GarminTcxImporter().import_file(self.session, RUNNING_TCX)
+        self.session.commit()
+        track = self.session.query(Activity).one().laps[0].tracks[0]
+        for trackpoint, sample in zip(track.trackpoints, samples):
+            self.assertEquals(trackpoint.time, sample.time)
+            if trackpoint.latitude is not None:
+                self.assertAlmostEquals(float(trackpoint.latitude),
+                        sample.latitude, 6)
+        self.assertEquals(track.get_columns()['heart_rate'],
+                [sample.heart_rate for sample in samples])
+
+    def test_import_history_file(self):
+        importer = GarminTcxImporter()
+        importer.import_file(self.session, HISTORY_TCX)
+        self.session.commit()
+
+        activities = self.session.query(Activity).order_by(
+                Activity.start_time).all()
+        self.assertEquals(2, len(activities))
+        self.assertEquals(SPORTNAME_BIKING, activities[0].sport.name)
+        # Slow running is walking:
+        self.assertEquals(SPORTNAME_WALKING, activities[1].sport.name)
+        self.assertEquals(None, activities[0].laps[0].heart_rate_avg)
+
+    def test_import_file_twice(self):
+        importer = GarminTcxImporter()
+        importer.import_file(self.session, RUNNING_TCX)
+        self.session.commit()
+        importer.import_file(self.session, RUNNING_TCX)
+        self.session.commit()
+        self.assertEquals(1, self.session.query(Activity).count())
+
+    def test_no_activities(self):
+        importer = GarminTcxImporter()
+        self.assertRaises(Exception, importer.import_file, self.session,
+                os.path.join(DATA_DIR, "empty.tcx"))
+
+    def test_scan_dir_skips_unchanged_files(self):
+        importer = CountingTcxImporter()
+        importer.scan_dir(EXPORTS_DIR)
+        self.assertEquals(2, len(importer.parsed))
+        self.assertEquals(2, self.session.query(ImportedFile).count())
+
+        importer = CountingTcxImporter()
+        importer.scan_dir(EXPORTS_DIR)
+        self.assertEquals([], importer.parsed)
+
+    def test_scan_dir_legacy_imports(self):
+        # Files recorded by name before the manifest existed are not parsed
+        # again, just added to the manifest:
+        self.session.add(Import(1, "running.tcx"))
+        self.session.commit()
+        importer = CountingTcxImporter()
+        importer.scan_dir(EXPORTS_DIR)
+        self.assertEquals([HISTORY_TCX], importer.parsed)
+        imported_file = self.session.query(ImportedFile).filter(
+                ImportedFile.path == RUNNING_TCX).one()
+        self.assertEquals(IMPORT_STATUS_IMPORTED, imported_file.status)
+        self.assertEquals(hash_source(RUNNING_TCX), imported_file.content_hash)
+
+    def test_scan_dir_grown_export(self):
+        # A history export re-written with new activities is imported again,
+        # only the new activities are stored:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, "History.tcx")
+            shutil.copy(HISTORY_TCX, filename)
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals([filename], report.imported)
+
+            data = open(HISTORY_TCX).read()
+            start = data.index("    <Activity ")
+            end = data.index("    <Activity ", start + 1)
+            activity = data[start:end].replace("2009-06-14", "2009-06-20")
+            f = open(filename, "w")
+            f.write(data.replace("  </Activities>",
+                activity + "  </Activities>"))
+            f.close()
+
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals([filename], report.imported)
+            self.assertEquals(3, self.session.query(Activity).count())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_scan_dir_duplicate_files(self):
+        # The same export twice under different names is only parsed once:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy(RUNNING_TCX, os.path.join(temp_dir, "a.tcx"))
+            shutil.copy(RUNNING_TCX, os.path.join(temp_dir, "b.tcx"))
+            importer = CountingTcxImporter()
+            importer.scan_dir(temp_dir)
+            self.assertEquals([os.path.join(temp_dir, "a.tcx")],
+                    importer.parsed)
+            self.assertEquals(1, self.session.query(Activity).count())
+            imported_file = self.session.query(ImportedFile).filter(
+                    ImportedFile.path == os.path.join(temp_dir, "b.tcx")).one()
+            self.assertEquals(IMPORT_STATUS_DUPLICATE, imported_file.status)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_import_duplicate_activity(self):
+        # Activities already stored are skipped even if the file differs:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            copy = os.path.join(temp_dir, "copy.tcx")
+            f = open(copy, "w")
+            f.write(open(RUNNING_TCX).read().replace("Forerunner 305",
+                "Forerunner 405"))
+            f.close()
+
+            importer = GarminTcxImporter()
+            importer.import_file(self.session, RUNNING_TCX)
+            self.session.commit()
+            self.assertEquals([], importer.parse_file(copy))
+            importer.import_file(self.session, copy)
+            self.session.commit()
+            self.assertEquals(1, self.session.query(Activity).count())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_scan_dir_failures(self):
+        # Bad files are reported and rolled back without losing the others:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy(HISTORY_TCX, temp_dir)
+            broken = os.path.join(temp_dir, "broken.tcx")
+            f = open(broken, "w")
+            f.write(open(RUNNING_TCX).read()[:2000])
+            f.close()
+            swimming = os.path.join(temp_dir, "swimming.tcx")
+            f = open(swimming, "w")
+            f.write(open(RUNNING_TCX).read().replace('Sport="Running"',
+                'Sport="Swimming"'))
+            f.close()
+
+            report = GarminTcxImporter(batch_size=2).scan_dir(temp_dir)
+            self.assertEquals([os.path.join(temp_dir, "history.tcx")],
+                    report.imported)
+            self.assertEquals([broken, swimming],
+                    [filename for (filename, error) in report.failures])
+            self.assertEquals(2, self.session.query(Activity).count())
+            self.assertEquals(0, self.session.query(Lap).filter(
+                Lap.activity_id == None).count())
+            imported_file = self.session.query(ImportedFile).filter(
+                    ImportedFile.path == swimming).one()
+            self.assertEquals(IMPORT_STATUS_FAILED, imported_file.status)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_scan_dir_retries_failures(self):
+        # Unchanged files that failed are tried again, the cause may have
+        # been fixed since:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            swimming = os.path.join(temp_dir, "swimming.tcx")
+            f = open(swimming, "w")
+            f.write(open(RUNNING_TCX).read().replace('Sport="Running"',
+                'Sport="Swimming"'))
+            f.close()
+
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals([(swimming, "No such sport: Swimming")],
+                    report.failures)
+
+            self.session.add(Sport("Swimming"))
+            self.session.commit()
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals([swimming], report.imported)
+            self.assertEquals([], report.failures)
+            activity = self.session.query(Activity).one()
+            self.assertEquals("Swimming", activity.sport.name)
+            imported_file = self.session.query(ImportedFile).filter(
+                    ImportedFile.path == swimming).one()
+            self.assertEquals(IMPORT_STATUS_IMPORTED, imported_file.status)
+
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals([swimming], report.skipped)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_scan_dir_compressed(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            f = gzip.GzipFile(os.path.join(temp_dir, "running.tcx.gz"), "wb")
+            f.write(open(RUNNING_TCX).read())
+            f.close()
+            f = bz2.BZ2File(os.path.join(temp_dir, "history.tcx.bz2"), "w")
+            f.write(open(HISTORY_TCX).read())
+            f.close()
+
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals(2, len(report.imported))
+            self.assertEquals([], report.failures)
+            self.assertEquals(3, self.session.query(Activity).count())
+            self.assertEquals(29, self.session.query(TrackPoint).count())
+
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals(2, len(report.skipped))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_scan_dir_zip_archive(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(temp_dir, "exports.zip")
+            f = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+            f.write(RUNNING_TCX, "2009/running.tcx")
+            f.write(HISTORY_TCX, "history.tcx")
+            f.writestr("README.txt", "Not an export.")
+            f.close()
+            # Same data as one of the members:
+            shutil.copy(RUNNING_TCX, temp_dir)
+
+            importer = CountingTcxImporter()
+            report = importer.scan_dir(temp_dir)
+            running = archive + ARCHIVE_SEPARATOR + "2009/running.tcx"
+            history = archive + ARCHIVE_SEPARATOR + "history.tcx"
+            self.assertEquals([running, history], importer.parsed)
+            self.assertEquals([os.path.join(temp_dir, "running.tcx")],
+                    report.duplicates)
+            self.assertEquals(3, self.session.query(Activity).count())
+
+            # Each member is tracked on its own:
+            imported_file = self.session.query(ImportedFile).filter(
+                    ImportedFile.path == running).one()
+            self.assertEquals(IMPORT_STATUS_IMPORTED, imported_file.status)
+            self.assertEquals(hash_source(RUNNING_TCX),
+                    imported_file.content_hash)
+
+            importer = CountingTcxImporter()
+            report = importer.scan_dir(temp_dir)
+            self.assertEquals([], importer.parsed)
+            # The archive is skipped as a whole:
+            self.assertEquals([archive, os.path.join(temp_dir,
+                "running.tcx")], report.skipped)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_scan_dir_zip_archive_failures(self):
+        # Archives with members that failed are opened again next time:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(temp_dir, "exports.zip")
+            f = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+            f.write(HISTORY_TCX, "history.tcx")
+            f.writestr("swimming.tcx", open(RUNNING_TCX).read().replace(
+                'Sport="Running"', 'Sport="Swimming"'))
+            f.close()
+            swimming = archive + ARCHIVE_SEPARATOR + "swimming.tcx"
+
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals([swimming],
+                    [filename for (filename, error) in report.failures])
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals([swimming],
+                    [filename for (filename, error) in report.failures])
+
+            self.session.add(Sport("Swimming"))
+            self.session.commit()
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals([swimming], report.imported)
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals([archive], report.skipped)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_scan_dir_zip_archive_appended(self):
+        # Members already examined are skipped when others are added:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(temp_dir, "exports.zip")
+            f = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+            f.write(RUNNING_TCX, "running.tcx")
+            f.close()
+            GarminTcxImporter().scan_dir(temp_dir)
+            running = archive + ARCHIVE_SEPARATOR + "running.tcx"
+            stat = source_stat(running)
+
+            f = zipfile.ZipFile(archive, "a", zipfile.ZIP_DEFLATED)
+            f.write(HISTORY_TCX, "history.tcx")
+            f.close()
+            # Without being read or hashed again:
+            self.assertEquals(stat, source_stat(running))
+            importer = CountingTcxImporter()
+            report = importer.scan_dir(temp_dir)
+            history = archive + ARCHIVE_SEPARATOR + "history.tcx"
+            self.assertEquals([history], importer.parsed)
+            self.assertEquals([running], report.skipped)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_scan_dir_separator_in_path(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            directory = os.path.join(temp_dir, "runs!2009")
+            os.mkdir(directory)
+            archive = os.path.join(directory, "exports.zip")
+            f = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+            f.write(RUNNING_TCX, "running!1.tcx")
+            f.close()
+            running = archive + ARCHIVE_SEPARATOR + "running!1.tcx"
+
+            self.assertEquals(hash_source(RUNNING_TCX), hash_source(running))
+            self.assertEquals(os.path.getsize(RUNNING_TCX),
+                    source_stat(running)[0])
+            report = GarminTcxImporter().scan_dir(temp_dir)
+            self.assertEquals([running], report.imported)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_list_sources(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(temp_dir, "exports.zip")
+            f = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+            f.write(RUNNING_TCX, "running.tcx")
+            f.writestr("README.txt", "Not an export.")
+            f.close()
+            running = archive + ARCHIVE_SEPARATOR + "running.tcx"
+
+            sources = list_sources(archive, GarminTcxImporter().handles)
+            self.assertEquals([(running, source_stat(running))], sources)
+            self.assertEquals(os.path.getsize(RUNNING_TCX),
+                    sources[0][1][0])
+            self.assertEquals([(RUNNING_TCX, source_stat(RUNNING_TCX))],
+                    list_sources(RUNNING_TCX, GarminTcxImporter().handles))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_scan_dir_rollback(self):
+        report = FailingTcxImporter().scan_dir(EXPORTS_DIR)
+        self.assertEquals([HISTORY_TCX], report.imported)
+        self.assertEquals([(RUNNING_TCX, "Failed after storing.")],
+                report.failures)
+        self.assertEquals(2, self.session.query(Activity).count())
+        self.assertEquals(1, self.session.query(ImportedFile).filter(
+            ImportedFile.status == IMPORT_STATUS_IMPORTED).count())
+        imported_file = self.session.query(ImportedFile).filter(
+                ImportedFile.path == RUNNING_TCX).one()
+        self.assertEquals(IMPORT_STATUS_FAILED, imported_file.status)
+
+    def test_scan_dir_report(self):
+        report = GarminTcxImporter().scan_dir(EXPORTS_DIR)
+        summary = report.summary()
+        self.assertEquals(2, summary['imported'])
+        self.assertEquals(29, summary['trackpoints'])
+        self.assertEquals(os.path.getsize(RUNNING_TCX) +
+                os.path.getsize(HISTORY_TCX), summary['bytes'])
+        self.assertTrue(summary['trackpoints_per_second'] > 0)
+        self.assertTrue(summary['peak_memory_kb'] > 0)
+        self.assertEquals(set(IMPORT_STAGES), set(summary['stages'].keys()))
+        self.assertTrue(summary['stages']['parse'] >=
+                summary['stages']['timestamps'] > 0)
+        self.assertEquals([HISTORY_TCX, RUNNING_TCX],
+                [timings['filename'] for timings in report.files])
+
+    def test_scan_dir_progress(self):
+        calls = []
+        def progress(done, total, activity_ids):
+            # Each batch must be committed by the time we hear about it:
+            session = Session()
+            calls.append((done, total, [activity.start_time for activity in
+                session.query(Activity).filter(Activity.id.in_(
+                    activity_ids or [-1])).order_by(Activity.start_time)]))
+            session.close()
+
+        GarminTcxImporter(batch_size=1).scan_dir(EXPORTS_DIR, progress)
+        self.assertEquals([
+            (0, 2, []),
+            (1, 2, [datetime(2009, 6, 14, 9, 5),
+                datetime(2009, 6, 15, 18, 30)]),
+            (2, 2, [datetime(2009, 5, 2, 12, 37, 25)]),
+        ], calls)
+
+    def test_scan_dir_batch_seconds(self):
+        # Batches are committed early once they've been open long enough:
+        calls = []
+        def progress(done, total, activity_ids):
+            calls.append(done)
+        GarminTcxImporter(batch_seconds=0).scan_dir(EXPORTS_DIR, progress)
+        self.assertEquals([0, 1, 2], calls)
+
+    def test_scan_dir_streamed(self):
+        calls = []
+        def progress(done, total, activity_ids):
+            calls.append((done, total, len(activity_ids)))
+
+        report = CountingTcxImporter(stream_size=0).scan_dir(EXPORTS_DIR,
+                progress)
+        self.assertEquals(2, len(report.imported))
+        self.assertEquals(3, self.session.query(Activity).count())
+        self.assertEquals(0, self.session.query(ImportCheckpoint).count())
+        self.assertEquals(29, report.summary()['trackpoints'])
+        # Each activity is committed as it's stored:
+        self.assertEquals([(0, 2, 0), (0, 2, 1), (0, 2, 1), (1, 2, 1),
+            (2, 2, 0)], calls)
+
+    def test_scan_dir_resume(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy(HISTORY_TCX, temp_dir)
+            history = os.path.join(temp_dir, "history.tcx")
+            self.assertRaises(KeyboardInterrupt,
+                    CrashingTcxImporter(stream_size=0).scan_dir, temp_dir)
+            self.assertEquals(1, self.session.query(Activity).count())
+            checkpoint = self.session.query(ImportCheckpoint).one()
+            self.assertEquals(history, checkpoint.path)
+            self.assertEquals(0, self.session.query(ImportedFile).count())
+
+            # Activities deleted in the meantime aren't brought back:
+            self.session.delete(self.session.query(Activity).one())
+            self.session.commit()
+
+            report = GarminTcxImporter(stream_size=0).scan_dir(temp_dir)
+            self.assertEquals([history], report.imported)
+            activity = self.session.query(Activity).one()
+            self.assertEquals(datetime(2009, 6, 15, 18, 30),
+                    activity.start_time)
+            self.assertEquals(0, self.session.query(ImportCheckpoint).count())
+            imported_file = self.session.query(ImportedFile).one()
+            self.assertEquals(IMPORT_STATUS_IMPORTED, imported_file.status)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_scan_dir_streamed_failure(self):
+        # Activities before a parse error are kept:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            broken = os.path.join(temp_dir, "broken.tcx")
+            f = open(broken, "w")
+            f.write(open(HISTORY_TCX).read().replace("</Activities>", ""))
+            f.close()
+            report = GarminTcxImporter(stream_size=0).scan_dir(temp_dir)
+            self.assertEquals([broken], [filename for (filename, error) in
+                report.failures])
+            self.assertEquals(2, self.session.query(Activity).count())
+            self.assertEquals(2, self.session.query(ImportCheckpoint).count())
+            self.session.commit()
+
+            # Tried again as is, nothing is stored twice:
+            report = GarminTcxImporter(stream_size=0).scan_dir(temp_dir)
+            self.assertEquals([broken], [filename for (filename, error) in
+                report.failures])
+            self.assertEquals(2, self.session.query(Activity).count())
+            self.session.commit()
+
+            # Once fixed the import carries on from the checkpoint:
+            data = open(HISTORY_TCX).read()
+            start = data.index("    <Activity ")
+            end = data.index("    <Activity ", start + 1)
+            f = open(broken, "w")
+            f.write(data.replace("  </Activities>", data[start:end].replace(
+                "2009-06-14", "2009-06-20") + "  </Activities>"))
+            f.close()
+            report = GarminTcxImporter(stream_size=0).scan_dir(temp_dir)
+            self.assertEquals([broken], report.imported)
+            self.assertEquals(3, self.session.query(Activity).count())
+            self.assertEquals(datetime(2009, 6, 20, 9, 5),
+                    self.session.query(Activity).order_by(
+                        Activity.id.desc()).first().start_time)
+            self.assertEquals(0, self.session.query(ImportCheckpoint).count())
+            imported_file = self.session.query(ImportedFile).one()
+            self.assertEquals(IMPORT_STATUS_IMPORTED, imported_file.status)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_scan_dir_dry_run(self):
+        for stream_size in (STREAM_SIZE, 0):
+            report = GarminTcxImporter(stream_size=stream_size,
+                    dry_run=True).scan_dir(EXPORTS_DIR)
+            self.assertEquals(2, len(report.imported))
+            self.assertEquals(29, report.summary()['trackpoints'])
+            self.assertEquals(0, self.session.query(Activity).count())
+            self.assertEquals(0, self.session.query(ImportedFile).count())
+            self.assertEquals(0, self.session.query(ImportCheckpoint).count())
+
+    def test_import_thread(self):
+        finished = []
+        thread = ImportThread(GarminTcxImporter(), EXPORTS_DIR,
+                finished=finished.append)
+        thread.start()
+        thread.join()
+        self.assertEquals(2, len(finished[0].imported))
+
+        thread = ImportThread(GarminTcxImporter(), "/no/such/dir",
+                finished=finished.append)
+        thread.start()
+        thread.join()
+        self.assertEquals(None, finished[1])
+
+    def test_scan_dir_parallel(self):
+        # Parallel parsing must store exactly what a serial scan would:
+        GarminTcxImporter().scan_dir(EXPORTS_DIR)
+        serial = self._dump_activities()
+
+        self.tearDown()
+        self.setUp()
+        GarminTcxImporter(workers=2).scan_dir(EXPORTS_DIR)
+        self.assertEquals(serial, self._dump_activities())
+        self.assertEquals(3, len(serial))
+
+    def test_scan_dir_parallel_window(self):
+        # More files than are parsed ahead at once, all stored in order:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            data = open(RUNNING_TCX).read()
+            for year in range(2001, 2008):
+                f = open(os.path.join(temp_dir, "%s.tcx" % year), "w")
+                f.write(data.replace("2009-", "%s-" % year))
+                f.close()
+            report = GarminTcxImporter(workers=2).scan_dir(temp_dir)
+            self.assertEquals(7, len(report.imported))
+            activities = self.session.query(Activity).order_by(Activity.id)
+            self.assertEquals(range(2001, 2008),
+                    [activity.start_time.year for activity in activities])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def _dump_activities(self):
+        """ Return a comparable summary of every stored activity. """
+        session = Session()
+        result = []
+        for activity in session.query(Activity).order_by(Activity.id):
+            trackpoints = []
+            for lap in activity.laps:
+                for track in lap.tracks:
+                    trackpoints.append([(tp.id, tp.time, tp.latitude,
+                        tp.heart_rate) for tp in track.trackpoints])
+            result.append((activity.id, activity.start_time,
+                activity.sport.name, trackpoints))
+        session.close()
+        return result
+
+
+class GpxImporterTests(ImporterTestCase):
+
+    def test_import_file(self):
+        importer = GpxImporter()
+        importer.import_file(self.session, TRACK_GPX)
+        self.session.commit()
+
+        activities = self.session.query(Activity).order_by(
+                Activity.start_time).all()
+        self.assertEquals(2, len(activities))
+        self.assertEquals(SPORTNAME_RUNNING, activities[0].sport.name)
+        self.assertEquals(SPORTNAME_OTHER, activities[1].sport.name)
+        self.assertEquals(datetime(2009, 7, 4, 15, 0, 0),
+                activities[0].start_time)
+
+        lap = activities[0].laps[0]
+        self.assertEquals(1, len(activities[0].laps))
+        self.assertEquals(2, len(lap.tracks))
+        self.assertEquals(90, lap.duration)
+        # 0.001 and 0.002 degrees of latitude, the gap isn't counted:
+        self.assertEquals(334, int(round(lap.distance)))
+        self.assertEquals(150, lap.heart_rate_max)
+        self.assertEquals(137, lap.heart_rate_avg)
+
+        trackpoints = lap.tracks[1].trackpoints
+        self.assertEquals(150, trackpoints[0].heart_rate)
+        self.assertEquals(None, trackpoints[1].heart_rate)
+        self.assertEquals(334, int(round(trackpoints[1].distance)))
+
+    def test_scan_dir_same_name(self):
+        # Different files that happen to share a name are both imported:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            first = os.path.join(temp_dir, "a", "activity.gpx")
+            second = os.path.join(temp_dir, "b", "activity.gpx")
+            os.mkdir(os.path.dirname(first))
+            os.mkdir(os.path.dirname(second))
+            shutil.copy(TRACK_GPX, first)
+            GpxImporter().scan_dir(temp_dir)
+
+            f = open(second, "w")
+            f.write(open(TRACK_GPX).read().replace("2009-07", "2010-07"))
+            f.close()
+            report = GpxImporter().scan_dir(temp_dir)
+            self.assertEquals([second], report.imported)
+            self.assertEquals(4, self.session.query(Activity).count())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_gpx_1_0(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            old = os.path.join(temp_dir, "old.gpx")
+            f = open(old, "w")
+            f.write(open(TRACK_GPX).read().replace("GPX/1/1", "GPX/1/0"))
+            f.close()
+            self.assertEquals(2, len(GpxImporter().parse_file(old)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_skips_known_activities(self):
+        importer = GpxImporter()
+        importer.import_file(self.session, TRACK_GPX)
+        self.session.commit()
+        self.assertEquals([], importer.parse_file(TRACK_GPX))
+
+    def test_not_gpx(self):
+        self.assertRaises(Exception, GpxImporter().parse_file, RUNNING_TCX)
+
+
+class FitWriter(object):
+    """ Builds small FIT files for testing. """
+
+    def __init__(self):
+        self.data = []
+        self.formats = {}
+
+    def define(self, local_type, global_number, fields):
+        """ Fields is a list of (field number, base type, struct format). """
+        self.data.append(struct.pack("<BBBHB", 0x40 | local_type, 0, 0,
+            global_number, len(fields)))
+        for number, base_type, fmt in fields:
+            self.data.append(struct.pack("<BBB", number,
+                struct.calcsize("<" + fmt), base_type))
+        self.formats[local_type] = "<" + "".join([fmt for (number,
+            base_type, fmt) in fields])
+
+    def message(self, local_type, *values):
+        self.data.append(chr(local_type))
+        self.data.append(struct.pack(self.formats[local_type], *values))
+
+    def compressed(self, local_type, timestamp, *values):
+        """ Write a message with a compressed timestamp header. """
+        self.data.append(chr(0x80 | local_type << 5 | timestamp & 0x1F))
+        self.data.append(struct.pack(self.formats[local_type], *values))
+
+    def contents(self):
+        body = "".join(self.data)
+        return struct.pack("<BBHI4s", 12, 16, 100, len(body), ".FIT") + \
+                body + "\0\0"
+
+
+# 2009-08-01 10:00:00 UTC as a FIT timestamp:
+FIT_START = 618055200
+
+
+def running_fit():
+    """ Return a FIT file of a run, two 20 second laps at 4 meters/second. """
+    writer = FitWriter()
+    writer.define(0, MESG_RECORD, [(253, 0x86, "I"), (0, 0x85, "i"),
+        (1, 0x85, "i"), (2, 0x84, "H"), (3, 0x02, "B"), (5, 0x86, "I")])
+    writer.define(1, MESG_RECORD, [(0, 0x85, "i"), (1, 0x85, "i"),
+        (3, 0x02, "B"), (5, 0x86, "I")])
+    writer.define(2, MESG_LAP, [(253, 0x86, "I"), (2, 0x86, "I"),
+        (7, 0x86, "I"), (8, 0x86, "I"), (9, 0x86, "I"), (11, 0x84, "H"),
+        (14, 0x84, "H"), (15, 0x02, "B"), (16, 0x02, "B")])
+    writer.define(3, MESG_SESSION, [(253, 0x86, "I"), (2, 0x86, "I"),
+        (5, 0x00, "B")])
+
+    # 49.28 degrees north, 123.12 west in semicircles:
+    lat, lon = 587933300, -1468878815
+    writer.message(0, FIT_START, lat, lon, 2525, 140, 0)
+    writer.message(0, FIT_START + 10, lat, lon, 2530, 0xFF, 4000)
+    writer.compressed(1, FIT_START + 20, lat, lon, 150, 8000)
+    writer.message(2, FIT_START + 20, FIT_START, 20000, 20000, 8000, 5,
+            4000, 145, 150)
+    writer.message(0, FIT_START + 30, lat, lon, 2535, 150, 12000)
+    writer.message(0, FIT_START + 50, lat, lon, 2540, 155, 20000)
+    writer.message(2, FIT_START + 50, FIT_START + 30, 20000, 20000,
+            8000, 5, 4000, 152, 155)
+    writer.message(3, FIT_START + 50, FIT_START, 1)
+    return writer.contents()
+
+
+class FitImporterTests(ImporterTestCase):
+
+    def setUp(self):
+        ImporterTestCase.setUp(self)
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        ImporterTestCase.tearDown(self)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.temp_dir, name)
+        f = open(path, "wb")
+        f.write(contents)
+        f.close()
+        return path
+
+
+    def test_import_file(self):
+        path = self._write("running.fit", running_fit())
+        importer = FitImporter()
+        importer.import_file(self.session, path)
+        self.session.commit()
+
+        activity = self.session.query(Activity).one()
+        self.assertEquals(SPORTNAME_RUNNING, activity.sport.name)
+        self.assertEquals(datetime(2009, 8, 1, 10, 0, 0), activity.start_time)
+        self.assertEquals(2, len(activity.laps))
+        self.assertEquals(160, activity.distance)
+        self.assertEquals(40, activity.duration)
+
+        lap = activity.laps[0]
+        self.assertEquals(145, lap.heart_rate_avg)
+        self.assertEquals(4, lap.speed_max)
+        trackpoints = lap.tracks[0].trackpoints
+        self.assertEquals(3, len(trackpoints))
+        self.assertEquals(None, trackpoints[1].heart_rate)
+        self.assertEquals(5, trackpoints[0].altitude)
+        self.assertEquals(49.28, round(trackpoints[0].latitude, 4))
+        self.assertEquals(-123.12, round(trackpoints[0].longitude, 4))
+        # Compressed timestamp:
+        self.assertEquals(datetime(2009, 8, 1, 10, 0, 20),
+                trackpoints[2].time)
+
+    def test_records_only(self):
+        # No lap or session messages, i.e. the device died mid run:
+        writer = FitWriter()
+        writer.define(0, MESG_RECORD, [(253, 0x86, "I"), (5, 0x86, "I")])
+        writer.message(0, FIT_START, 0)
+        writer.message(0, FIT_START + 100, 40000)
+        activities = FitImporter().parse_file(self._write("CRASHED.FIT",
+            writer.contents()))
+        self.assertEquals(1, len(activities))
+        self.assertEquals(SPORTNAME_OTHER, activities[0]['sport'])
+        lap = activities[0]['laps'][0]
+        self.assertEquals(100, lap['duration'])
+        self.assertEquals(400, lap['distance'])
+
+    def test_handles(self):
+        # Devices use upper case names:
+        self.assertTrue(FitImporter().handles("2009-08-01-10-00-00.FIT"))
+        self.assertTrue(FitImporter().handles("running.fit.gz"))
+        self.assertFalse(FitImporter().handles("running.tcx"))
+
+    def test_truncated(self):
+        path = self._write("truncated.fit", running_fit()[:100])
+        self.assertRaises(Exception, FitImporter().parse_file, path)
+        path = self._write("running.tcx.fit", open(RUNNING_TCX).read())
+        self.assertRaises(Exception, FitImporter().parse_file, path)
+
+
+class MultiFormatImporterTests(ImporterTestCase):
+
+    def setUp(self):
+        ImporterTestCase.setUp(self)
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        ImporterTestCase.tearDown(self)
+
+    def test_scan_dir(self):
+        shutil.copy(RUNNING_TCX, self.temp_dir)
+        shutil.copy(TRACK_GPX, self.temp_dir)
+        f = open(os.path.join(self.temp_dir, "running.fit"), "wb")
+        f.write(running_fit())
+        f.close()
+        # Recognised by content rather than name:
+        shutil.copy(HISTORY_TCX, os.path.join(self.temp_dir, "history.xml"))
+        f = open(os.path.join(self.temp_dir, "unknown.xml"), "w")
+        f.write("<unknown/>")
+        f.close()
+        open(os.path.join(self.temp_dir, "notes.txt"), "w").close()
+
+        report = MultiFormatImporter().scan_dir(self.temp_dir)
+        self.assertEquals(["history.xml", "running.fit", "running.tcx",
+            "track.gpx"], [os.path.basename(filename) for filename in
+                report.imported])
+        self.assertEquals([os.path.join(self.temp_dir, "unknown.xml")],
+                [filename for (filename, error) in report.failures])
+        self.assertEquals(6, self.session.query(Activity).count())
+        self.assertTrue(report.stages['timestamps'] > 0)
+
+    def test_sniff_before_extension(self):
+        # A GPX file with the wrong extension is still parsed as GPX:
+        misnamed = os.path.join(self.temp_dir, "track.tcx")
+        shutil.copy(TRACK_GPX, misnamed)
+        activities = MultiFormatImporter().parse_file(misnamed)
+        self.assertEquals(2, len(activities))
+
+    def test_register_importer(self):
+        register_importer(GpxImporter)
+        self.assertEquals(1, IMPORTERS.count(GpxImporter))
+        importer = MultiFormatImporter()
+        self.assertTrue(importer.handles("running.fit.gz"))
+        self.assertTrue(importer.handles("export.xml"))
+        self.assertFalse(importer.handles("notes.txt"))
+
+
+class WatcherTests(ImporterTestCase):
+
+    def setUp(self):
+        ImporterTestCase.setUp(self)
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        ImporterTestCase.tearDown(self)
+
+    def test_polling_watcher_imports_new_files(self):
+        reports = []
+        imported = threading.Event()
+        def finished(report):
+            reports.append(report)
+            imported.set()
+
+        importer = GarminTcxImporter()
+        callback = lambda filenames: finished(importer.import_files(filenames))
+        watcher = PollingWatcher(self.temp_dir, callback, importer.handles,
+                settle_time=0.2, poll_interval=0.05)
+        watcher.start()
+        try:
+            # Partially written files are left alone until they settle:
+            partial = os.path.join(self.temp_dir, "running.tcx")
+            f = open(partial, "w")
+            f.write(open(RUNNING_TCX).read()[:1000])
+            f.flush()
+            time.sleep(0.1)
+            f.write(open(RUNNING_TCX).read()[1000:])
+            f.close()
+            open(os.path.join(self.temp_dir, "notes.txt"), "w").close()
+
+            imported.wait(5)
+        finally:
+            watcher.stop()
+            watcher.join()
+
+        self.assertEquals([partial], reports[0].imported)
+        self.assertEquals([], reports[0].failures)
+        self.assertEquals(1, self.session.query(Activity).count())
@@ -0,0 +1,472 @@
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+""" Tests for Granola's model module. """
+
+import os
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from granola.model import *
+
+
+class ModelTestCase(unittest.TestCase):
+    """
+    Point the model at a fresh temporary database for each test, counting
+    the statements executed.
+    """
+
+    def setUp(self):
+        (fd, self.db_file) = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.engine = connect_to_db("sqlite:///%s" % self.db_file)
+        Session.configure(bind=self.engine)
+        Base.metadata.create_all(bind=self.engine)
+        self.session = Session()
+        self.session.add_all([
+            Sport(SPORTNAME_RUNNING),
+            Sport(SPORTNAME_BIKING),
+            Sport(SPORTNAME_WALKING),
+            Sport(SPORTNAME_OTHER),
+        ])
+        self.session.commit()
+
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute",
+                self._count_statement)
+
+    def _count_statement(self, conn, cursor, statement, parameters,
+            context, executemany):
+        self.statements.append(statement)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        Session.configure(bind=DB)
+        os.remove(self.db_file)
+
+
+class SportCacheTests(ModelTestCase):
+
+    def test_get_id(self):
+        biking_id = self.session.query(Sport).filter(
+                Sport.name == SPORTNAME_BIKING).one().id
+        self.statements = []
+        self.assertEquals(biking_id, SPORTS.get_id(self.session, "Biking"))
+        self.assertEquals(biking_id, SPORTS.get_id(self.session, "biking"))
+        self.assertEquals(1, len(self.statements))
+        self.assertRaises(Exception, SPORTS.get_id, self.session,
+                "Swimming")
+
+    def test_get(self):
+        sport = SPORTS.get(self.session, SPORTNAME_RUNNING)
+        self.assertEquals(SPORTNAME_RUNNING, sport.name)
+        self.assertTrue(sport is SPORTS.get(self.session, "Running"))
+
+    def test_names(self):
+        self.assertEquals([SPORTNAME_BIKING, SPORTNAME_OTHER,
+            SPORTNAME_RUNNING, SPORTNAME_WALKING],
+            SPORTS.names(self.session))
+
+    def test_invalidated_on_change(self):
+        SPORTS.get_id(self.session, SPORTNAME_RUNNING)
+        self.session.add(Sport("swimming"))
+        self.session.commit()
+        self.assertTrue("swimming" in SPORTS.names(self.session))
+
+        sport = SPORTS.get(self.session, "swimming")
+        sport.name = "rowing"
+        self.session.commit()
+        self.assertFalse("swimming" in SPORTS.names(self.session))
+        self.assertEquals(sport.id, SPORTS.get_id(self.session, "rowing"))
+
+
+def lap(start_time, duration, distance, heart_rate_avg, coords):
+    """ Return a lap dict, with one track of the given coords. """
+    return {
+        'start_time': start_time,
+        'duration': duration,
+        'distance': distance,
+        'speed_max': distance / duration,
+        'calories': 10,
+        'heart_rate_max': heart_rate_avg,
+        'heart_rate_avg': heart_rate_avg,
+        'tracks': [[{
+            'time': start_time + timedelta(seconds=i),
+            'latitude': latitude,
+            'longitude': longitude,
+            'altitude': None,
+            'distance': None,
+            'heart_rate': None,
+        } for i, (latitude, longitude) in enumerate(coords)]],
+    }
+
+
+class ActivityTestCase(ModelTestCase):
+    """ Start with one stored activity of two laps. """
+
+    def setUp(self):
+        ModelTestCase.setUp(self)
+        start_time = datetime(2009, 6, 1, 12, 0, 0)
+        laps = [
+            lap(start_time, 600.0, 2000.0, 150, [(45.0, -75.5),
+                (None, None), (45.25, -75.0)]),
+            lap(start_time + timedelta(minutes=10), 300.0, 1500.0, 120,
+                [(44.5, -75.25)]),
+        ]
+        (self.activity_id,) = bulk_insert_activities(self.session, [{
+            'start_time': start_time,
+            'sport_id': SPORTS.get_id(self.session, SPORTNAME_RUNNING),
+            'laps': laps,
+        }])
+        self.session.commit()
+
+    def _assert_summary(self, activity):
+        self.assertEquals(3500, activity.distance)
+        self.assertEquals(900, activity.duration)
+        self.assertEquals(140, activity.heart_rate_avg)
+        self.assertEquals(5, activity.speed_max)
+        self.assertEquals(20, activity.calories)
+        self.assertEquals(44.5, activity.min_latitude)
+        self.assertEquals(45.25, activity.max_latitude)
+        self.assertEquals(-75.5, activity.min_longitude)
+        self.assertEquals(-75.0, activity.max_longitude)
+
+
+class ActivitySummaryTests(ActivityTestCase):
+
+    def test_bulk_insert(self):
+        self.statements = []
+        activity = self.session.query(Activity).one()
+        self._assert_summary(activity)
+        # Without loading any laps:
+        self.assertEquals(1, len([statement for statement in self.statements
+            if statement.startswith("SELECT")]))
+
+    def test_update_on_lap_changes(self):
+        activity = self.session.query(Activity).one()
+        activity.laps[1].heart_rate_avg = None
+        self.session.commit()
+        self.assertEquals(3500, activity.distance)
+        self.assertEquals(None, activity.heart_rate_avg)
+
+        self.session.delete(activity.laps[1])
+        self.session.commit()
+        self.assertEquals(2000, activity.distance)
+        self.assertEquals(150, activity.heart_rate_avg)
+        self.assertEquals(45.25, activity.max_latitude)
+
+    def test_new_activity(self):
+        activity = Activity(datetime(2009, 6, 2), SPORTS.get(self.session,
+            SPORTNAME_BIKING))
+        activity.laps.append(Lap(datetime(2009, 6, 2), 60, 1000, 10, 5,
+            None, None))
+        self.session.add(activity)
+        self.session.commit()
+        self.assertEquals(1000, activity.distance)
+        self.assertEquals(None, activity.heart_rate_avg)
+        self.assertEquals(None, activity.min_latitude)
+
+    def test_backfill(self):
+        self.session.execute("UPDATE activity SET %s" % ", ".join(
+            ["%s = NULL" % name for name in ACTIVITY_SUMMARY_COLUMNS]))
+        self.session.commit()
+        backfill_activity_summaries(self.engine)
+        self._assert_summary(self.session.query(Activity).one())
+
+    def test_backfill_packed(self):
+        activity = self.session.query(Activity).one()
+        laps = [lap(activity.start_time, 60.0, 100.0, 100, [(10.0, 20.0),
+            (11.0, 21.0)])]
+        bulk_insert_activities(self.session, [{
+            'start_time': datetime(2009, 6, 2),
+            'sport_id': activity.sport_id,
+            'laps': laps,
+        }], packed=True)
+        self.session.execute("UPDATE activity SET min_latitude = NULL")
+        self.session.commit()
+        backfill_activity_summaries(self.engine)
+        self.session.expire_all()
+        (first, second) = self.session.query(Activity).order_by(
+                Activity.id).all()
+        self.assertEquals(44.5, first.min_latitude)
+        self.assertEquals(10, second.min_latitude)
+
+    def test_backfill_batches(self):
+        for i in range(4):
+            bulk_insert_activities(self.session, [{
+                'start_time': datetime(2009, 7, i + 1),
+                'sport_id': SPORTS.get_id(self.session, SPORTNAME_WALKING),
+                'laps': [lap(datetime(2009, 7, i + 1), 100.0, 100.0 * i,
+                    None, [])],
+            }])
+        self.session.execute("UPDATE activity SET distance = NULL")
+        self.session.commit()
+
+        progress = []
+        backfill_activity_summaries(self.engine,
+                lambda done, total: progress.append((done, total)), 2)
+        self.assertEquals([(2, 5), (4, 5), (5, 5)], progress)
+        self.assertEquals([3500, 0, 100, 200, 300], [activity.distance for
+            activity in self.session.query(Activity).order_by(Activity.id)])
+
+
+class ActivitiesTestCase(ActivityTestCase):
+    """ Add four more activities of other sports, half of them packed. """
+
+    def setUp(self):
+        ActivityTestCase.setUp(self)
+        for day in range(2, 6):
+            start_time = datetime(2009, 6, day)
+            bulk_insert_activities(self.session, [{
+                'start_time': start_time,
+                'sport_id': SPORTS.get_id(self.session, [SPORTNAME_BIKING,
+                    SPORTNAME_WALKING][day % 2]),
+                'laps': [lap(start_time, 60.0, 100.0, 100, [(45.0, -75.0)]),
+                    lap(start_time + timedelta(minutes=1), 60.0, 100.0, 100,
+                        [(45.5, -75.5)])],
+            }], packed=(day % 2 == 0))
+        self.session.commit()
+
+
+class ActivityViewTests(ActivitiesTestCase):
+
+    def _count_queries(self, view, use, activity_ids):
+        """
+        Return the number of queries run to load the given activities in
+        the given view and use them as it would.
+        """
+        self.session.expunge_all()
+        self.statements = []
+        q = query_activities(self.session, view).filter(
+                Activity.id.in_(activity_ids))
+        for activity in q.all():
+            use(activity)
+        return len([statement for statement in self.statements
+            if statement.startswith("SELECT")])
+
+    def _assert_queries(self, expected, view, use):
+        self.assertEquals(expected, self._count_queries(view, use, [1]))
+        self.assertEquals(expected, self._count_queries(view, use,
+            range(1, 6)))
+
+    def test_map(self):
+        def use(activity):
+            activity.sport.name
+            for lap in activity.laps:
+                for track in lap.tracks:
+                    self.assertTrue(track.get_samples())
+        self._assert_queries(5, "map", use)
+
+    def test_laps_in_order(self):
+        activity = query_activities(self.session, "map").filter(
+                Activity.id == 1).one()
+        self.assertEquals([2000, 1500], [lap.distance for lap in
+            activity.laps])
+
+    def test_unknown_view(self):
+        self.assertRaises(Exception, query_activities, self.session, "graph")
+
+
+class ListActivitiesTests(ActivitiesTestCase):
+
+    def _ids(self, rows):
+        return [row.id for row in rows]
+
+    def test_list_activities(self):
+        self.statements = []
+        rows = list_activities(self.session)
+        self.assertEquals(1, len([statement for statement in self.statements
+            if statement.startswith("SELECT")]))
+        self.assertEquals([5, 4, 3, 2, 1], self._ids(rows))
+
+        row = rows[-1]
+        self.assertEquals(ActivityRow(1, datetime(2009, 6, 1, 12, 0, 0),
+            SPORTS.get_id(self.session, SPORTNAME_RUNNING),
+            SPORTNAME_RUNNING, 3500, 900, 140), row)
+        self.assertEquals(SPORTNAME_RUNNING, row.sport_name)
+
+    def test_list_activities_filtered(self):
+        biking = SPORTS.get(self.session, SPORTNAME_BIKING)
+        self.assertEquals([4, 2], self._ids(list_activities(self.session,
+            biking)))
+        self.assertEquals([2, 4], self._ids(list_activities(self.session,
+            biking, order=ORDER_OLDEST_FIRST)))
+        self.assertEquals([4, 1], self._ids(list_activities(self.session,
+            activity_ids=[1, 4])))
+        self.assertEquals([], list_activities(self.session,
+            SPORTS.get(self.session, SPORTNAME_OTHER)))
+
+    def test_list_activities_paged(self):
+        self.assertEquals([4, 3], self._ids(list_activities(self.session,
+            offset=1, limit=2)))
+        self.assertEquals([1], self._ids(list_activities(self.session,
+            offset=4, limit=2)))
+        self.assertEquals([1, 2], self._ids(list_activities(self.session,
+            limit=2, order=ORDER_OLDEST_FIRST)))
+        self.assertRaises(Exception, list_activities, self.session,
+                order="longest")
+
+
+class MigrationTests(ActivityTestCase):
+
+    def _downgrade(self):
+        """ Put the database back as it was before any migrations. """
+        self.session.close()
+        # The activity table as it was, without the summary columns:
+        self.engine.execute("CREATE TABLE activity_old ("
+                "id INTEGER NOT NULL PRIMARY KEY, "
+                "start_time DATETIME NOT NULL UNIQUE, "
+                "sport_id INTEGER NOT NULL REFERENCES sport (id))")
+        self.engine.execute("INSERT INTO activity_old "
+                "SELECT id, start_time, sport_id FROM activity")
+        self.engine.execute("DROP TABLE activity")
+        self.engine.execute("ALTER TABLE activity_old RENAME TO activity")
+        self.engine.execute("DROP INDEX ix_imported_file_content_hash")
+        self.engine.execute("DROP TABLE import_checkpoint")
+        self.engine.execute("INSERT INTO constant (name, value) "
+                "VALUES ('schema_version', '0.1')")
+
+    def _upgrade(self):
+        progress = []
+        upgrade_db(self.engine, lambda description, done, total:
+                progress.append(description))
+        return progress
+
+    def test_initialize_db(self):
+        self.assertEquals(0, get_schema_version(self.engine))
+        initialize_db(self.engine)
+        self.assertEquals(SCHEMA_VERSION, get_schema_version(self.engine))
+        self.assertEquals([], self._upgrade())
+
+    def test_upgrade(self):
+        self._downgrade()
+        self.assertEquals(0, get_schema_version(self.engine))
+        progress = self._upgrade()
+        self.assertTrue("Add activity summary columns" in progress)
+        self.assertEquals(SCHEMA_VERSION, get_schema_version(self.engine))
+
+        self._assert_summary(self.session.query(Activity).one())
+        self.assertEquals(0, self.session.query(ImportCheckpoint).count())
+        self.assertEquals("ix_imported_file_content_hash", self.engine.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND "
+            "name = 'ix_imported_file_content_hash'").scalar())
+
+        # Nothing left to do:
+        self.assertEquals([], self._upgrade())
+
+    def test_upgrade_floats(self):
+        # Put back the lap table as it was, with NUMERIC columns:
+        self.session.close()
+        ddl = self.engine.execute("SELECT sql FROM sqlite_master "
+                "WHERE name = 'lap'").scalar()
+        self.engine.execute(ddl.replace("FLOAT", "NUMERIC(14, 6)").replace(
+            "CREATE TABLE lap ", "CREATE TABLE lap_numeric "))
+        self.engine.execute("INSERT INTO lap_numeric SELECT * FROM lap")
+        self.engine.execute("DROP TABLE lap")
+        self.engine.execute("ALTER TABLE lap_numeric RENAME TO lap")
+        self.engine.execute("INSERT INTO constant (name, value) "
+                "VALUES ('schema_version', '%s')" % (SCHEMA_VERSION - 1))
+        self.assertEquals(600, self.session.query(Lap.duration).first()[0])
+        self.assertEquals("integer", self.engine.execute(
+            "SELECT typeof(duration) FROM lap").scalar())
+        self.session.close()
+
+        self.assertEquals(["Store numbers as floating point"] * 4,
+                self._upgrade())
+        self.assertEquals("real", self.engine.execute(
+            "SELECT typeof(duration) FROM lap").scalar())
+        duration = self.session.query(Lap.duration).first()[0]
+        self.assertTrue(isinstance(duration, float))
+        self._assert_summary(self.session.query(Activity).one())
+        # Other tables still refer to the rebuilt ones:
+        self.assertTrue("REFERENCES lap (id)" in self.engine.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'track'").scalar())
+        self.assertEquals(["ix_lap_activity_id_start_time"], [row[0] for row
+            in self.engine.execute("SELECT name FROM sqlite_master WHERE "
+                "type = 'index' AND tbl_name = 'lap'")])
+
+    def test_upgrade_indexes(self):
+        # Each step only creates the indexes it was added for:
+        self.session.close()
+        self.engine.execute("DROP INDEX ix_track_lap_id")
+        self.engine.execute("DROP INDEX ix_imported_file_content_hash")
+        self.engine.execute("INSERT INTO constant (name, value) "
+                "VALUES ('schema_version', '%s')" % (SCHEMA_VERSION - 2))
+        self.assertEquals(["Index laps, tracks, trackpoints and activities "
+            "by sport"] * 2 + ["Store numbers as floating point"] * 4,
+            self._upgrade())
+        self.assertEquals(["ix_track_lap_id"], [row[0] for row in
+            self.engine.execute("SELECT name FROM sqlite_master WHERE "
+                "type = 'index' AND name IN ('ix_track_lap_id', "
+                "'ix_imported_file_content_hash')")])
+
+    def test_upgrade_newer_database(self):
+        self.engine.execute("INSERT INTO constant (name, value) "
+                "VALUES ('schema_version', '%s')" % (SCHEMA_VERSION + 1))
+        self.assertRaises(Exception, upgrade_db, self.engine)
+
+
+class StorageSettingsTests(ModelTestCase):
+
+    def tearDown(self):
+        set_storage_settings({})
+        ModelTestCase.tearDown(self)
+
+    def test_get_storage_settings(self):
+        for profile in STORAGE_PROFILES:
+            self.assertEquals(set(STORAGE_PRAGMAS),
+                    set(get_storage_settings(profile).keys()))
+        settings = get_storage_settings("fast-import",
+                {'synchronous': 'off'})
+        self.assertEquals("wal", settings['journal_mode'])
+        self.assertEquals("off", settings['synchronous'])
+        self.assertEquals("normal",
+                STORAGE_PROFILES["fast-import"]['synchronous'])
+
+    def test_invalid_storage_settings(self):
+        self.assertRaises(Exception, get_storage_settings, "fastest")
+        self.assertRaises(Exception, get_storage_settings, "safe",
+                {'page_size': '4096'})
+        self.assertRaises(Exception, get_storage_settings, "safe",
+                {'cache_size': '1; DROP TABLE activity'})
+
+    def test_set_storage_settings(self):
+        set_storage_settings(get_storage_settings("read-heavy",
+            {'cache_size': '-1234'}))
+        # Only new connections are affected:
+        self.engine.dispose()
+        self.assertEquals("wal", self.engine.execute(
+            "PRAGMA journal_mode").scalar())
+        self.assertEquals(-1234, self.engine.execute(
+            "PRAGMA cache_size").scalar())
+        self.assertEquals(2, self.engine.execute(
+            "PRAGMA temp_store").scalar())
+
+        set_storage_settings(get_storage_settings("safe"))
+        self.engine.dispose()
+        self.assertEquals("delete", self.engine.execute(
+            "PRAGMA journal_mode").scalar())
+        self.assertEquals(2, self.engine.execute(
+            "PRAGMA synchronous").scalar())
@@ -0,0 +1,93 @@
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+
+""" Tests for Granola's packing module. """
+
+import unittest
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from granola.packing import *
+
+START = datetime(2009, 6, 1, 12, 0, 0)
+
+
+def trackpoint(seconds, latitude=None, longitude=None, altitude=None,
+        distance=None, heart_rate=None):
+    return {
+        'time': START + timedelta(seconds=seconds),
+        'latitude': latitude,
+        'longitude': longitude,
+        'altitude': altitude,
+        'distance': distance,
+        'heart_rate': heart_rate,
+    }
+
+
+class PackingTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        trackpoints = [
+            trackpoint(0, Decimal("45.123456"), Decimal("-75.654321"),
+                Decimal("80.5"), Decimal("0"), 120),
+            trackpoint(1.5, Decimal("45.123501"), Decimal("-75.654299"),
+                Decimal("80.25"), Decimal("5.125"), 121),
+            trackpoint(3, Decimal("-45.5"), Decimal("179.999999"),
+                Decimal("-10.001"), Decimal("123456.789"), 190),
+        ]
+        (start_time, data) = pack_samples(trackpoints)
+        self.assertEquals(START, start_time)
+
+        samples = unpack_samples(start_time, data)
+        self.assertEquals(3, len(samples))
+        for original, sample in zip(trackpoints, samples):
+            self.assertEquals(original['time'], sample.time)
+            for name in ('latitude', 'longitude', 'altitude', 'distance'):
+                self.assertAlmostEquals(float(original[name]),
+                        getattr(sample, name), 6)
+            self.assertEquals(original['heart_rate'], sample.heart_rate)
+
+    def test_missing_values(self):
+        trackpoints = [
+            trackpoint(0, Decimal("45.1"), Decimal("-75.6"), heart_rate=120),
+            trackpoint(1),
+            trackpoint(2, Decimal("45.2"), Decimal("-75.7")),
+        ]
+        trackpoints[1]['time'] = None
+        samples = unpack_samples(*pack_samples(trackpoints))
+        self.assertEquals(None, samples[1].time)
+        self.assertEquals(None, samples[1].latitude)
+        self.assertEquals(None, samples[2].heart_rate)
+        self.assertEquals(START + timedelta(seconds=2), samples[2].time)
+        self.assertAlmostEquals(45.2, samples[2].latitude, 6)
+
+    def test_columns(self):
+        trackpoints = [trackpoint(i, distance=i * 2.5) for i in range(100)]
+        columns = unpack_columns(*pack_samples(trackpoints))
+        self.assertEquals(set(Sample._fields), set(columns.keys()))
+        self.assertEquals([i * 2.5 for i in range(100)], columns['distance'])
+        self.assertEquals([None] * 100, columns['heart_rate'])
+
+    def test_empty(self):
+        (start_time, data) = pack_samples([])
+        self.assertEquals(None, start_time)
+        self.assertEquals([], unpack_samples(start_time, data))
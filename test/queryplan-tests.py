@@ -0,0 +1,213 @@
+#   Granola - GPS Enabled Open Source Workout/Adventure Log
+#
+#   Copyright (C) 2009 Devan Goodwin <dgoodwin@dangerouslyinc.com>
+#
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#   02110-1301  USA
+
+
+"""
+Check the query plans of the queries the UI and importer run often, so a
+missing index shows up as a failing test rather than a slow UI.
+
+Each test runs the real query, capturing the SQL actually executed, and
+fails if SQLite's plan for any of it reads a whole table or sorts rows
+rather than walking an index.
+"""
+
+import os
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func
+
+from granola.model import *
+from granola.importer import *
+
+EXPORTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "data", "exports")
+
+# Tables it's fine to read in full: there are only a handful of sports, and
+# the importer loads its whole manifest once per import:
+FULL_SCAN_TABLES = ["sport", "imported_file", "import", "import_checkpoint"]
+
+
+def trackpoints(start_time, count):
+    return [{
+        'time': start_time + timedelta(seconds=i),
+        'latitude': 45 + i / 1000.0,
+        'longitude': -75 - i / 1000.0,
+        'altitude': 100,
+        'distance': i * 3.0,
+        'heart_rate': 140,
+    } for i in range(count)]
+
+
+class QueryPlanTests(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.db_file) = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.engine = connect_to_db("sqlite:///%s" % self.db_file)
+        Session.configure(bind=self.engine)
+        initialize_db(self.engine)
+        self.session = Session()
+
+        activities = []
+        for day in range(20):
+            start_time = datetime(2009, 6, 1) + timedelta(days=day)
+            activities.append({
+                'start_time': start_time,
+                'sport_id': SPORTS.get_id(self.session, [SPORTNAME_RUNNING,
+                    SPORTNAME_BIKING][day % 2]),
+                'laps': [{
+                    'start_time': start_time + timedelta(minutes=lap),
+                    'duration': 60.0,
+                    'distance': 180.0,
+                    'speed_max': 3.5,
+                    'calories': 10,
+                    'heart_rate_max': 150,
+                    'heart_rate_avg': 140,
+                    'tracks': [trackpoints(start_time, 60)],
+                } for lap in range(3)],
+            })
+        bulk_insert_activities(self.session, activities[:10])
+        bulk_insert_activities(self.session, activities[10:], packed=True)
+        self.session.commit()
+
+        self.executed = []
+        event.listen(self.engine, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context,
+            executemany):
+        if not executemany:
+            self.executed.append((statement, parameters))
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        Session.configure(bind=DB)
+        os.remove(self.db_file)
+
+    def _get_plan(self, statement, parameters):
+        """ Return the lines of SQLite's plan for the given statement. """
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("EXPLAIN QUERY PLAN %s" % statement, parameters)
+            return [row[-1] for row in cursor.fetchall()]
+        finally:
+            connection.close()
+
+    def assertIndexed(self, run, allow_sort=False):
+        """
+        Call the given function and fail if any statement it executed
+        scans a table, or sorts its results, rather than using an index.
+        Sorting is fine when only a handful of rows are read, as when
+        eager loading a single activity, if allow_sort is True.
+        """
+        self.executed = []
+        run()
+        self.assertTrue(self.executed, "Nothing was executed.")
+        for statement, parameters in self.executed:
+            if statement.split()[0] not in ("SELECT", "UPDATE", "DELETE"):
+                continue
+            for line in self._get_plan(statement, parameters):
+                words = line.split()
+                # SQLite before 3.24 says "SCAN TABLE x" rather than
+                # "SCAN x":
+                if words[1:2] == ["TABLE"]:
+                    del words[1]
+                if words[0] == "SCAN" and "USING" not in words and \
+                        words[1] not in FULL_SCAN_TABLES:
+                    self.fail("Full scan of %s in:\n%s" % (words[1],
+                        statement))
+                if line.startswith("USE TEMP B-TREE") and not allow_sort:
+                    self.fail("Results sorted without an index (%s) in:\n%s"
+                            % (line, statement))
+
+    def _query_activities(self, sport=None):
+        q = self.session.query(Activity).order_by(Activity.start_time.desc())
+        if sport is not None:
+            q = q.filter(Activity.sport == sport)
+        return q
+
+    def test_activity_list(self):
+        self.assertIndexed(lambda: self._query_activities().all())
+        running = SPORTS.get(self.session, SPORTNAME_RUNNING)
+        self.assertIndexed(lambda: self._query_activities(running).all())
+
+    def test_list_activities(self):
+        running = SPORTS.get(self.session, SPORTNAME_RUNNING)
+        self.assertIndexed(lambda: list_activities(self.session))
+        self.assertIndexed(lambda: list_activities(self.session, running,
+            offset=5, limit=5, order=ORDER_OLDEST_FIRST))
+        # Sorting just the activities asked for is fine:
+        self.assertIndexed(lambda: list_activities(self.session,
+            activity_ids=[1, 2]), True)
+
+    def test_metrics(self):
+        running = SPORTS.get(self.session, SPORTNAME_RUNNING)
+        self.assertIndexed(lambda: self.session.query(Activity).order_by(
+            Activity.start_time).filter(Activity.sport == running).first())
+        self.assertIndexed(lambda: self._query_activities(running).first())
+
+        q = self.session.query(func.count(Activity.id),
+                func.sum(Activity.distance), func.sum(Activity.duration))
+        q = q.filter(Activity.start_time >= datetime(2009, 6, 1))
+        q = q.filter(Activity.start_time <= datetime(2009, 6, 30))
+        q = q.filter(Activity.sport == running)
+        self.assertIndexed(q.one)
+
+    def test_activity_details(self):
+        activity = self.session.query(Activity).filter(Activity.id == 2).one()
+        self.assertIndexed(lambda: self.session.query(Lap).filter(
+            Lap.activity == activity).order_by(Lap.start_time).all())
+        self.assertIndexed(lambda: self.session.query(Activity).filter(
+            Activity.id.in_([1, 2, 3])).all())
+
+    def test_load_samples(self):
+        for activity_id in (1, 20):
+            activity = self.session.query(Activity).get(activity_id)
+            self.assertIndexed(lambda: [track.get_samples() for lap in
+                activity.laps for track in lap.tracks])
+            self.session.expire_all()
+
+    def test_activity_views(self):
+        # All for the selected activity:
+        for view in ACTIVITY_VIEWS:
+            for activity_id in (1, 20):
+                self.session.expunge_all()
+                self.assertIndexed(lambda: query_activities(self.session,
+                    view).filter(Activity.id == activity_id).one(), True)
+
+    def test_delete_activity(self):
+        def delete():
+            for activity_id in (1, 20):
+                self.session.delete(self.session.query(Activity).get(
+                    activity_id))
+            self.session.commit()
+        self.assertIndexed(delete)
+
+    def test_import(self):
+        self.session.commit()
+        self.assertIndexed(lambda: GarminTcxImporter().scan_dir(EXPORTS_DIR))
+        self.assertIndexed(lambda: GarminTcxImporter().scan_dir(EXPORTS_DIR))
+
+    def test_upgrade_backfill(self):
+        self.assertIndexed(lambda: backfill_activity_summaries(self.engine))
@@ -23,7 +23,9 @@
 import unittest
 
 from granola.util import *
+from datetime import datetime
 from decimal import Decimal, ROUND_UP
+from dateutil.tz import tzoffset
 
 class UtilTests(unittest.TestCase):
 
@@ -41,10 +43,67 @@ class UtilTests(unittest.TestCase):
         self.assertEquals(Decimal(0), calculate_pace(None, Decimal(0), 
             Decimal(1086)).quantize(Decimal('1')))
 
+    def test_calculate_speed_float(self):
+        self.assertEquals(100.0, calculate_speed(None, 100000.0, 3600.0))
+        self.assertAlmostEquals(8.42, calculate_speed(None, 2540.0, 1086), 2)
+        self.assertEquals(0.0, calculate_speed(None, 0.0, 1086.0))
+        self.assertTrue(isinstance(calculate_speed(None, 2540, 1086), float))
+
+    def test_calculate_pace_float(self):
+        self.assertAlmostEquals(427.56, calculate_pace(None, 2540.0, 1086.0),
+                2)
+        self.assertEquals(0.0, calculate_pace(None, 2540.0, 0.0))
+        self.assertTrue(isinstance(calculate_pace(None, 2540, 1086), float))
+
+    def test_calculate_mixed_types(self):
+        # Decimals from older rows alongside floats:
+        self.assertEquals(100.0, calculate_speed(None, Decimal(100000),
+            3600.0))
+        self.assertEquals(100.0, calculate_speed(None, 100000.0,
+            Decimal(3600)))
+        self.assertAlmostEquals(427.56, calculate_pace(None, Decimal(2540),
+            1086.0), 2)
+        self.assertAlmostEquals(427.56, calculate_pace(None, 2540.0,
+            Decimal(1086)), 2)
+        self.assertTrue(isinstance(calculate_pace(None, Decimal(2540), 1086),
+            float))
+
+    def test_format_time_str_float(self):
+        self.assertEquals("01:00:00", format_time_str(3600.0))
+        self.assertEquals("00:18:06", format_time_str(1086.5))
+
     def test_format_time_str(self):
         self.assertEquals("01:00:00", format_time_str(3600))
         self.assertEquals("00:50:00", format_time_str(3000))
         self.assertEquals("00:00:00", format_time_str(0))
         self.assertEquals("100:00:00", format_time_str(360000))
 
+    def test_parse_timestamp(self):
+        self.assertEquals(datetime(2009, 5, 2, 12, 37, 25, tzinfo=UTC),
+                parse_timestamp("2009-05-02T12:37:25Z"))
+        self.assertEquals(datetime(2009, 5, 2, 12, 37, 25, 120000,
+            tzinfo=UTC), parse_timestamp("2009-05-02T12:37:25.12Z"))
+        self.assertEquals(datetime(2009, 5, 2, 12, 37, 25,
+            tzinfo=tzoffset(None, -12600)),
+            parse_timestamp("2009-05-02T12:37:25-03:30"))
+
+        # Timezones are shared rather than created per timestamp:
+        self.assertTrue(parse_timestamp("2009-05-02T12:37:25Z").tzinfo is
+                parse_timestamp("2009-05-03T08:00:00Z").tzinfo)
+        self.assertTrue(parse_timestamp("2009-05-02T12:37:25+02:00").tzinfo
+                is parse_timestamp("2009-05-03T08:00:00+02:00").tzinfo)
+
+    def test_parse_timestamp_fallback(self):
+        # Odd formats are still handled by dateutil:
+        self.assertEquals(datetime(2009, 5, 2, 12, 37, 25, tzinfo=UTC),
+                parse_timestamp("2009-05-02 12:37:25 UTC"))
+        self.assertRaises(ValueError, parse_timestamp, "2009-05-02T25:00:00Z")
 
+    def test_calculate_distance(self):
+        self.assertEquals(0.0, calculate_distance(49.0, -123.0, 49.0,
+            -123.0))
+        # One degree of latitude is roughly 111.2 km:
+        self.assertEquals(111195, round(calculate_distance(49.0, -123.0,
+            50.0, -123.0)))
+        self.assertEquals(111195, round(calculate_distance(0.0, 179.5, 0.0,
+            -179.5)))